@@ -1,36 +1,375 @@
 """
 Use the Apriori Algorithm on the Vietnam War THOR dataset
 
+missions are one-hot encoded straight from their categorical codes into a
+sparse matrix, so memory grows with the number of missions and not with
+the number of distinct values
+frequent itemsets can be mined with apriori or FP-growth and turned into
+association rules with their confidence and lift, for the whole war or for
+each year, target country or rolling window of months in parallel
+
 Thomas Whittam
 """
 
 
+import concurrent.futures
+import inspect
+from multiprocessing import shared_memory
+
+import numpy as np
 import pandas as pd
-from mlxtend.frequent_patterns import apriori
-from mlxtend.preprocessing import TransactionEncoder
+
+import dataset
+import instrument
+
+
+COLS2PROCESS = [
+    'MILSERVICE', 'VALID_AIRCRAFT_ROOT', 'TGTTYPE',
+    'MFUNC_DESC', 'TGTCOUNTRY', 'WEAPONTYPE']
 
 
-def main():
+_SHARED = {}
+
+
+def encode_item_codes(df, columns=COLS2PROCESS):
     """
-    main program code
+    give every distinct value in the columns an item id
+
+    a value found in more than one column gets a single item id
+
+    Args:
+        df(pandas dataframe): missions with no missing values in columns
+        columns(list): the columns that make up each transaction
+
+    Returns:
+        itemcodes(numpy array): one row per mission, one item id per column
+        items(list): the item for each id, in sorted order
+    """
+    categoricals = [df[column].astype('category') for column in columns]
+    items = sorted(set().union(
+        *[set(column.cat.categories) for column in categoricals]))
+    itemids = {item: itemid for itemid, item in enumerate(items)}
+    itemcodes = np.empty((len(df), len(columns)), dtype=np.int32)
+    for position, column in enumerate(categoricals):
+        lookup = np.array(
+            [itemids[item] for item in column.cat.categories],
+            dtype=np.int32)
+        itemcodes[:, position] = lookup[column.cat.codes.to_numpy()]
+    return itemcodes, items
+
+
+def transactions_from_codes(itemcodes, items):
+    """
+    one-hot encode rows of item ids into a sparse dataframe
+
+    Args:
+        itemcodes(numpy array): one row per mission, one item id per column
+        items(list): the item for each id
+
+    Returns:
+        transactions(pandas dataframe): sparse boolean dataframe, one row
+                                        per mission, one column per item
+                                        that appears, in sorted order
+    """
+    from scipy import sparse
+    nrows, ncols = itemcodes.shape
+    rows = np.repeat(np.arange(nrows, dtype=np.int64), ncols)
+    matrix = sparse.csr_matrix(
+        (np.ones(nrows * ncols, dtype=bool), (rows, itemcodes.ravel())),
+        shape=(nrows, len(items)))
+    used = np.flatnonzero(matrix.getnnz(axis=0))
+    matrix = matrix[:, used]
+    return pd.DataFrame.sparse.from_spmatrix(
+        matrix, columns=[items[itemid] for itemid in used])
+
+
+def encode_transactions(df, columns=COLS2PROCESS):
+    """
+    one-hot encode each mission as a transaction of its values
+
+    the same as mlxtend's TransactionEncoder but built from categorical
+    codes without any intermediate python lists, a value found in more
+    than one column is a single item
+
+    Args:
+        df(pandas dataframe): missions with no missing values in columns
+        columns(list): the columns that make up each transaction
+
+    Returns:
+        transactions(pandas dataframe): sparse boolean dataframe, one row
+                                        per mission, one column per item
+                                        in sorted order
     """
-    filename = 'thor_data_vietnam.csv'
-    cols2process = [
-        'MILSERVICE', 'VALID_AIRCRAFT_ROOT', 'TGTTYPE',
-        'MFUNC_DESC', 'TGTCOUNTRY', 'WEAPONTYPE', 'MFUNC_DESC_CLASS']
-    df = pd.read_csv(filename, usecols=cols2process)
+    itemcodes, items = encode_item_codes(df, columns)
+    return transactions_from_codes(itemcodes, items)
+
+
+def frequent_itemsets(transactions, min_support=0.1, engine='apriori'):
+    """
+    find the itemsets that appear in at least min_support of transactions
+
+    Args:
+        transactions(pandas dataframe): from encode_transactions
+        min_support(float): minimum fraction of transactions
+        engine(str): 'apriori' or 'fpgrowth', FP-growth needs far less
+                     memory at low min_support
+
+    Returns:
+        itemsets(pandas dataframe): support and itemsets columns
+    """
+    # mlxtend is slow to import, only load it once we mine
+    from mlxtend.frequent_patterns import apriori, fpgrowth
+    if engine == 'apriori':
+        return apriori(
+            transactions, min_support=min_support, use_colnames=True,
+            low_memory=True)
+    if engine == 'fpgrowth':
+        return fpgrowth(
+            transactions, min_support=min_support, use_colnames=True)
+    raise ValueError('unknown engine {}'.format(engine))
+
+
+def rules_from_itemsets(itemsets, ntransactions, min_confidence=0.5):
+    """
+    generate association rules from frequent itemsets
+
+    Args:
+        itemsets(pandas dataframe): from frequent_itemsets
+        ntransactions(int): number of transactions the itemsets came from
+        min_confidence(float): minimum confidence of a rule
+
+    Returns:
+        rules(pandas dataframe): antecedents, consequents, support,
+                                 confidence and lift of each rule
+    """
+    columns = ['antecedents', 'consequents', 'support', 'confidence', 'lift']
+    if itemsets.empty:
+        return pd.DataFrame(columns=columns)
+    from mlxtend.frequent_patterns import association_rules
+    kwargs = {}
+    # newer versions of mlxtend need the number of transactions
+    if 'num_itemsets' in inspect.signature(association_rules).parameters:
+        kwargs['num_itemsets'] = ntransactions
+    rules = association_rules(
+        itemsets, metric='confidence', min_threshold=min_confidence,
+        **kwargs)
+    return rules[columns]
+
+
+def segment_keys(df, segmentby, windowmonths=6, stepmonths=3):
+    """
+    work out which segment each mission belongs to
+
+    Args:
+        df(pandas dataframe): the missions
+        segmentby(str): 'year' or 'rolling' to segment by MSNDATE, or the
+                        name of a column such as 'TGTCOUNTRY'
+        windowmonths(int): length of each rolling window in months
+        stepmonths(int): months between the start of each rolling window
+
+    Returns:
+        keys(numpy array): integer key of each mission, -1 for none
+        segments(list): (segment name, keys in the segment) of each segment
+    """
+    if segmentby in ('year', 'rolling'):
+        dates, invalid, rejected = dataset.clean_dates(df['MSNDATE'])
+        years = dates.dt.year.fillna(-1).to_numpy(dtype=np.int64)
+        if segmentby == 'year':
+            keys = years
+            segments = [
+                (str(year), [year]) for year in np.unique(years[years >= 0])]
+            return keys, segments
+        months = dates.dt.month.fillna(1).to_numpy(dtype=np.int64)
+        keys = np.where(years >= 0, years * 12 + months - 1, -1)
+        segments = []
+        if (keys >= 0).any():
+            first = keys[keys >= 0].min()
+            last = keys.max()
+            for start in range(first, last + 1, stepmonths):
+                end = start + windowmonths - 1
+                name = '{}-{:02d} to {}-{:02d}'.format(
+                    start // 12, start % 12 + 1, end // 12, end % 12 + 1)
+                segments.append((name, list(range(start, end + 1))))
+        return keys, segments
+    codes, uniques = pd.factorize(df[segmentby], sort=True)
+    segments = [
+        (str(value), [code]) for code, value in enumerate(uniques)]
+    return codes.astype(np.int64), segments
+
+
+def _share_array(array):
+    """
+    copy an array into shared memory
+
+    Args:
+        array(numpy array): the array to share
+
+    Returns:
+        sharedmemory(SharedMemory): the block, close and unlink it when done
+        spec(tuple): name, shape and dtype needed to attach to the block
+    """
+    sharedmemory = shared_memory.SharedMemory(
+        create=True, size=max(array.nbytes, 1))
+    sharedarray = np.ndarray(
+        array.shape, dtype=array.dtype, buffer=sharedmemory.buf)
+    sharedarray[:] = array
+    return sharedmemory, (sharedmemory.name, array.shape, array.dtype.str)
+
+
+def _init_segment_worker(codesspec, keysspec, items):
+    """
+    attach a worker process to the shared item codes and segment keys
+    """
+    for name, spec in (('itemcodes', codesspec), ('keys', keysspec)):
+        blockname, shape, dtype = spec
+        block = shared_memory.SharedMemory(name=blockname)
+        _SHARED[name + 'block'] = block
+        _SHARED[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    _SHARED['items'] = items
+
+
+def mine_segment(segmentname, segmentkeys, min_support, min_confidence,
+                 engine):
+    """
+    mine one segment of the shared transactions
+
+    Args:
+        segmentname(str): name of the segment
+        segmentkeys(list): keys of the missions in this segment
+        min_support(float): minimum fraction of the segment's missions
+        min_confidence(float): minimum confidence of a rule
+        engine(str): 'apriori' or 'fpgrowth'
+
+    Returns:
+        itemsets(pandas dataframe): frequent itemsets with a segment column
+        rules(pandas dataframe): association rules with a segment column
+    """
+    rows = np.isin(_SHARED['keys'], segmentkeys)
+    transactions = transactions_from_codes(
+        _SHARED['itemcodes'][rows], _SHARED['items'])
+    itemsets = frequent_itemsets(transactions, min_support, engine)
+    rules = rules_from_itemsets(itemsets, len(transactions), min_confidence)
+    for table in (itemsets, rules):
+        table.insert(0, 'missions', len(transactions))
+        table.insert(0, 'segment', segmentname)
+    return itemsets, rules
+
+
+def mine_segments(df, segmentby='year', min_support=0.1, min_confidence=0.5,
+                  engine='fpgrowth', windowmonths=6, stepmonths=3,
+                  workers=None):
+    """
+    mine itemsets and rules separately for each segment of the missions
+
+    the missions are encoded once into a matrix of item ids held in shared
+    memory, the segments are mined concurrently in a process pool and each
+    worker reads the rows of its segment from the shared matrix
+
+    Args:
+        df(pandas dataframe): the missions, see kinetic_missions
+        segmentby(str): 'year' or 'rolling' to segment by MSNDATE, or the
+                        name of a column such as 'TGTCOUNTRY'
+        min_support(float): minimum fraction of a segment's missions
+        min_confidence(float): minimum confidence of a rule
+        engine(str): 'apriori' or 'fpgrowth'
+        windowmonths(int): length of each rolling window in months
+        stepmonths(int): months between the start of each rolling window
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        itemsets(pandas dataframe): frequent itemsets of every segment
+        rules(pandas dataframe): association rules of every segment
+    """
+    itemcodes, items = encode_item_codes(df)
+    keys, segments = segment_keys(df, segmentby, windowmonths, stepmonths)
+    codesblock, codesspec = _share_array(itemcodes)
+    keysblock, keysspec = _share_array(keys)
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_segment_worker,
+                initargs=(codesspec, keysspec, items)) as pool:
+            futures = [
+                pool.submit(
+                    mine_segment, segmentname, segmentkeys, min_support,
+                    min_confidence, engine)
+                for segmentname, segmentkeys in segments
+                if np.isin(keys, segmentkeys).any()]
+            results = [future.result() for future in futures]
+    finally:
+        for block in (codesblock, keysblock):
+            block.close()
+            block.unlink()
+    if not results:
+        return pd.DataFrame(), pd.DataFrame()
+    itemsets = pd.concat(
+        [result[0] for result in results], ignore_index=True)
+    rules = pd.concat([result[1] for result in results], ignore_index=True)
+    return itemsets, rules
+
+
+def kinetic_missions(filename, extracolumns=()):
+    """
+    load the kinetic missions with a value in every column we mine
+
+    Args:
+        filename(str): path to the dataset CSV file
+        extracolumns(list): other columns to load, e.g. MSNDATE or UNIT
+                            for segmenting, these may be missing
+
+    Returns:
+        df(pandas dataframe): the missions
+    """
+    columns = list(dict.fromkeys(
+        COLS2PROCESS + ['MFUNC_DESC_CLASS'] + list(extracolumns)))
+    df = dataset.load_dataset(filename, columns=columns)
     df = df[df['MFUNC_DESC_CLASS'] == 'KINETIC']
-    df = df.drop(['MFUNC_DESC_CLASS'], axis=1)
-    cleandf = df.dropna()
-    preparedlist = cleandf.values.tolist()
+    if 'MFUNC_DESC_CLASS' not in extracolumns:
+        df = df.drop(['MFUNC_DESC_CLASS'], axis=1)
+    return df.dropna(subset=COLS2PROCESS)
 
-    te = TransactionEncoder()
-    te_ary = te.fit(preparedlist).transform(preparedlist)
-    df2 = pd.DataFrame(te_ary, columns=te.columns_)
 
-    results = apriori(df2, min_support=0.1, use_colnames=True)
+def main(min_support=0.1, min_confidence=0.5, engine='apriori',
+         segmentby=None, filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    Args:
+        min_support(float): minimum fraction of missions for an itemset
+        min_confidence(float): minimum confidence of a rule
+        engine(str): 'apriori' or 'fpgrowth'
+        segmentby(str): mine each 'year', 'rolling' window of months or
+                        value of a column separately, None for the whole war
+        filename(str): path to the dataset CSV file
+    """
+    if segmentby is not None:
+        with instrument.stage('load kinetic missions') as timer:
+            extracolumns = ['MSNDATE']
+            if segmentby not in ('year', 'rolling'):
+                extracolumns.append(segmentby)
+            cleandf = kinetic_missions(filename, extracolumns)
+            timer.rowsout = len(cleandf)
+        with instrument.stage('mine segments', rowsin=len(cleandf)):
+            results, rules = mine_segments(
+                cleandf, segmentby, min_support, min_confidence, engine)
+        print(results)
+        print(rules)
+        return
+    with instrument.stage('load kinetic missions') as timer:
+        cleandf = kinetic_missions(filename)
+        timer.rowsout = len(cleandf)
+    with instrument.stage('encode transactions', rowsin=len(cleandf)):
+        transactions = encode_transactions(cleandf)
+    with instrument.stage(
+            'frequent itemsets', rowsin=len(transactions)) as timer:
+        results = frequent_itemsets(transactions, min_support, engine)
+        timer.rowsout = len(results)
     print(results)
+    with instrument.stage('association rules', rowsin=len(results)) as timer:
+        rules = rules_from_itemsets(
+            results, len(transactions), min_confidence)
+        timer.rowsout = len(rules)
+    print(rules)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)
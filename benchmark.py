@@ -0,0 +1,538 @@
+"""
+benchmark every stage of the analysis on a THOR-shaped CSV
+
+each stage is timed and its memory use measured, the results are written
+as JSON named after the dataset and the git commit so runs of different
+versions can be compared with --compare
+run it on the real thor_data_vietnam.csv or on a synthetic dataset from
+synthdata.py, e.g.
+
+    python benchmark.py 1m
+    python benchmark.py --compare Benchmarks/a.json Benchmarks/b.json
+
+--startup instead measures how long each script takes to import with
+python -X importtime and checks it against a budget, and that no script
+loads matplotlib, mlxtend, scipy or scikit-learn before it needs them
+"""
+
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import apriori
+import crosstabs
+import dataset
+import densitymap
+import export
+import geoclusters
+import instrument
+import operationsmap
+import rollup
+import spatialindex
+import synthdata
+import tallyfields
+import timeseries
+
+
+RESULTSDIR = 'Benchmarks'
+
+# milliseconds to import each entry point, the best of several runs, with
+# room to spare over a laptop where pandas alone takes about 450ms
+STARTUP_BUDGETS_MS = {
+    'apriori': 800,
+    'benchmark': 900,
+    'cachefiles': 100,
+    'charts': 800,
+    'densitymap': 800,
+    'export': 800,
+    'extractoperations': 800,
+    'geoclusters': 800,
+    'instrument': 100,
+    'kml': 100,
+    'operationsmap': 800,
+    'piecharts': 800,
+    'superoverlay': 800,
+    'synthdata': 800,
+    'tallyfields': 800,
+    'thor': 150,
+    'timeseries': 800,
+}
+
+# milliseconds for a whole thor.py run that skips every stage, from
+# starting the interpreter to exiting
+SKIPPED_RUN_BUDGET_MS = 400
+
+# only imported by the code that uses them
+HEAVY_MODULES = ['matplotlib', 'mlxtend', 'scipy', 'sklearn']
+
+# import nothing outside the standard library
+DEPENDENCY_FREE = ['cachefiles', 'instrument', 'kml', 'thor']
+
+THIRD_PARTY_MODULES = HEAVY_MODULES + ['numpy', 'pandas', 'pyarrow']
+
+
+def measure(records, stage, rows, func, *args, **kwargs):
+    """
+    run one stage and record how long it took and how much memory it used
+
+    peak RSS is a high water mark for the whole run, so it only grows when
+    a stage needs more memory than every stage before it, the tracemalloc
+    peak is reset for each stage
+
+    Args:
+        records(list): the record of this stage is appended to it
+        stage(str): name of the stage
+        rows(int): number of missions going into the stage
+        func(function): the stage
+        args: passed on to func
+        kwargs: passed on to func
+
+    Returns:
+        result: whatever func returned
+    """
+    print('benchmarking {} on {} rows'.format(stage, rows))
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        tracedbefore = tracemalloc.get_traced_memory()[0]
+    cpustart = instrument.cpu_seconds()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    cpu = instrument.cpu_seconds() - cpustart
+    record = {
+        'stage': stage,
+        'rows': rows,
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4)}
+    if tracing:
+        record['traced_peak_mb'] = round(
+            (tracemalloc.get_traced_memory()[1] - tracedbefore) / 2 ** 20, 2)
+    own, children = instrument.peak_rss_mb()
+    if own is not None:
+        record['peak_rss_mb'] = round(own, 2)
+        record['children_peak_rss_mb'] = round(children, 2)
+    records.append(record)
+    print('  {:.3f}s wall {:.3f}s cpu'.format(wall, cpu))
+    return result
+
+
+def git_commit():
+    """
+    the commit of the code being benchmarked
+
+    Returns:
+        commit(str): short commit hash with -dirty if there are local
+                     changes, None outside a git checkout
+    """
+    repodir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], cwd=repodir,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit or None
+
+
+def kml_missions(df, kmlrows):
+    """
+    the first missions with co-ordinates and a mission type, dated the way
+    the maps expect
+
+    Args:
+        df(pandas dataframe): missions with cleaned datetime dates
+        kmlrows(int): maximum number of missions
+
+    Returns:
+        missions(pandas dataframe): the missions to map
+    """
+    missions = df.dropna(subset=geoclusters.COORDS + ['MFUNC_DESC'])
+    missions = missions.head(kmlrows).copy()
+    missions['MSNDATE'] = missions['MSNDATE'].dt.strftime('%Y-%m-%d')
+    return missions
+
+
+def run_benchmark(filename, workers=None, kmeanssample=200000,
+                  kmlrows=100000, engine='apriori', min_support=0.1,
+                  trace=True):
+    """
+    run every stage of the analysis on a dataset
+
+    output files of the stages are written to a temporary directory and
+    thrown away
+
+    Args:
+        filename(str): path to the dataset CSV file
+        workers(int): number of processes for the parallel stages,
+                      defaults to the number of cores
+        kmeanssample(int): fit K-means on a sample of this many points,
+                           None to fit on all of them
+        kmlrows(int): number of missions to write to the KML map
+        engine(str): 'apriori' or 'fpgrowth'
+        min_support(float): minimum fraction of missions for an itemset
+        trace(bool): measure allocations with tracemalloc, slows numpy and
+                     pandas down a little
+
+    Returns:
+        results(dict): details of the run and a record for each stage
+    """
+    import matplotlib
+    filename = os.path.abspath(filename)
+    matplotlib.use('Agg')
+    records = []
+    startedat = datetime.datetime.now().isoformat(timespec='seconds')
+    if trace:
+        tracemalloc.start()
+    workdir = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            measure(records, 'build_cache', None, dataset.build_cache,
+                    filename)
+            df = measure(records, 'load', None, dataset.load_dataset,
+                         filename)
+            rows = len(df)
+            for record in records:
+                record['rows'] = rows
+            dates, invalid, rejected = measure(
+                records, 'clean_date', rows, dataset.clean_dates,
+                df['MSNDATE'])
+            df['MSNDATE'] = dates
+            df = df[~invalid]
+            measure(records, 'tallies', rows, tallyfields.tally_fields,
+                    filename, list(tallyfields.FIELDS.values()),
+                    workers=workers)
+            measure(records, 'crosstabs', len(df),
+                    tallyfields.frequency_tables, df)
+            measure(records, 'all_crosstabs', len(df),
+                    crosstabs.crosstab_pairs, df,
+                    crosstabs.all_pairs(list(tallyfields.FIELDS.values())))
+            measure(records, 'rollup', len(df), rollup.rollup_missions, df)
+            measure(records, 'time_series', len(df),
+                    timeseries.time_series_matrix, df, 'TGTCOUNTRY')
+            index = spatialindex.SpatialIndex.from_dataframe(df)
+            indochina = df.iloc[index.query_bbox(**spatialindex.INDOCHINA)]
+            measure(records, 'kmeans', len(indochina), geoclusters.kmeans,
+                    indochina, samplesize=kmeanssample, seed=0)
+            measure(records, 'dbscan', len(indochina), geoclusters.dbscan,
+                    indochina)
+            kinetic = df[df['MFUNC_DESC_CLASS'] == 'KINETIC'].dropna(
+                subset=apriori.COLS2PROCESS)
+            measure(records, 'apriori', len(kinetic), mine_rules,
+                    kinetic, engine, min_support)
+            missions = kml_missions(df, kmlrows)
+            measure(records, 'kml', len(missions), operationsmap.create_map,
+                    'benchmark.kml',
+                    operationsmap.split_by_mission_type(missions))
+            located = df.dropna(subset=geoclusters.COORDS)
+            measure(records, 'density', len(located),
+                    densitymap.create_density_map, 'density', located)
+            measure(records, 'export', len(df), export.export_subset, df,
+                    'export', ['year'], 'csv.gz', workers=workers)
+    finally:
+        os.chdir(workdir)
+        if trace:
+            tracemalloc.stop()
+    results = {
+        'dataset': os.path.basename(filename),
+        'size_bytes': os.path.getsize(filename),
+        'rows': rows,
+        'commit': git_commit(),
+        'started': startedat,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpus': os.cpu_count(),
+        'workers': workers,
+        'tracemalloc': trace,
+        'stages': records}
+    return results
+
+
+def mine_rules(kinetic, engine, min_support):
+    """
+    the apriori stage, encode the missions then mine itemsets and rules
+
+    Args:
+        kinetic(pandas dataframe): kinetic missions with every mined column
+        engine(str): 'apriori' or 'fpgrowth'
+        min_support(float): minimum fraction of missions for an itemset
+
+    Returns:
+        rules(pandas dataframe): the association rules
+    """
+    transactions = apriori.encode_transactions(kinetic)
+    itemsets = apriori.frequent_itemsets(transactions, min_support, engine)
+    return apriori.rules_from_itemsets(itemsets, len(transactions))
+
+
+def write_results(results, outputdir=RESULTSDIR):
+    """
+    save the results of a run as JSON
+
+    Args:
+        results(dict): from run_benchmark
+        outputdir(str): directory to write to
+
+    Returns:
+        resultsfile(str): path of the file written
+    """
+    os.makedirs(outputdir, exist_ok=True)
+    name = os.path.splitext(results['dataset'])[0]
+    resultsfile = os.path.join(outputdir, '{}-{}.json'.format(
+        name, results['commit'] or 'unknown'))
+    with open(resultsfile, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('wrote benchmark results to {}'.format(resultsfile))
+    return resultsfile
+
+
+def compare(baselinefile, resultsfile):
+    """
+    print how each stage changed between two runs
+
+    Args:
+        baselinefile(str): JSON results of the earlier run
+        resultsfile(str): JSON results of the later run
+
+    Returns:
+        comparison(pandas dataframe): wall time, CPU time and traced peak
+                                      of each stage in both runs, with the
+                                      ratio of later to earlier
+    """
+    runs = []
+    for path in (baselinefile, resultsfile):
+        with open(path, 'r') as f:
+            stages = json.load(f)['stages']
+        runs.append(pd.DataFrame(stages).set_index('stage'))
+    baseline, results = runs
+    comparison = {}
+    for measurement in ('wall_s', 'cpu_s', 'traced_peak_mb'):
+        if measurement not in baseline or measurement not in results:
+            continue
+        comparison[measurement + ' before'] = baseline[measurement]
+        comparison[measurement + ' after'] = results[measurement]
+        comparison[measurement + ' ratio'] = (
+            results[measurement] / baseline[measurement]).round(2)
+    comparison = pd.DataFrame(comparison)
+    print(comparison.to_string())
+    return comparison
+
+
+def import_time(module, repeats=5):
+    """
+    time importing a module in a fresh interpreter with -X importtime
+
+    Args:
+        module(str): name of the module
+        repeats(int): number of fresh interpreters, the fastest is kept
+
+    Returns:
+        milliseconds(float): total import time of the fastest run
+        imported(list): top level packages the module imported
+    """
+    repodir = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for repeat in range(repeats):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import {}'.format(module)],
+            cwd=repodir, capture_output=True, text=True, check=True)
+        total, imported = read_importtime(result.stderr)
+        if best is None or total < best:
+            best = total
+    return best / 1000.0, imported
+
+
+def read_importtime(stderr):
+    """
+    total up the output of python -X importtime
+
+    Args:
+        stderr(str): what the interpreter wrote to stderr
+
+    Returns:
+        microseconds(int): total import time
+        imported(list): top level packages that were imported
+    """
+    total = 0
+    imported = set()
+    # lines look like 'import time:   123 |   456 | package.module'
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selftime, cumulative, name = line[len('import time:'):].split('|')
+        total += int(selftime)
+        imported.add(name.strip().split('.')[0])
+    return total, sorted(imported)
+
+
+def skipped_run_time(repeats=5, nrows=1000):
+    """
+    time a thor.py run where every stage is unchanged and skipped
+
+    a small synthetic dataset is loaded once, then the same run is timed
+    in fresh interpreters, it should only hash the dataset's signature and
+    read the stage state, never loading pandas
+
+    Args:
+        repeats(int): number of fresh interpreters, the fastest is kept
+        nrows(int): number of missions in the synthetic dataset
+
+    Returns:
+        milliseconds(float): wall time of the fastest run
+        imported(list): top level packages the run imported
+    """
+    repodir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'thor_startup.csv')
+        synthdata.write_synthetic(filename, nrows)
+        command = [
+            sys.executable, os.path.join(repodir, 'thor.py'), 'run', 'load',
+            '--input', filename, '--output', os.path.join(tmpdir, 'Output')]
+        subprocess.run(command, cwd=tmpdir, capture_output=True, check=True)
+        best = None
+        for repeat in range(repeats):
+            started = time.perf_counter()
+            result = subprocess.run(
+                [command[0], '-X', 'importtime'] + command[1:], cwd=tmpdir,
+                capture_output=True, text=True, check=True)
+            elapsed = time.perf_counter() - started
+            if best is None or elapsed < best:
+                best = elapsed
+            imported = read_importtime(result.stderr)[1]
+    return best * 1000.0, imported
+
+
+def check_startup(budgets=STARTUP_BUDGETS_MS, repeats=5):
+    """
+    measure the import time of every entry point against its budget, and
+    the time of a thor.py run that skips every stage
+
+    Args:
+        budgets(dict): keys are module names, values are milliseconds
+        repeats(int): number of fresh interpreters for each module
+
+    Returns:
+        results(dict): details of the run, a record for each module and one
+                       for the skipped run
+        failures(list): a message for every broken budget or early import
+    """
+    records = []
+    failures = []
+    for module, budget in budgets.items():
+        milliseconds, imported = import_time(module, repeats)
+        forbidden = HEAVY_MODULES
+        if module in DEPENDENCY_FREE:
+            forbidden = THIRD_PARTY_MODULES
+        early = [name for name in forbidden if name in imported]
+        print('{:<18} {:>7.1f}ms  budget {:>4}ms{}'.format(
+            module, milliseconds, budget,
+            '  imports ' + ', '.join(early) if early else ''))
+        if milliseconds > budget:
+            failures.append('{} took {:.1f}ms to import, over {}ms'.format(
+                module, milliseconds, budget))
+        if early:
+            failures.append('{} imports {} at startup'.format(
+                module, ', '.join(early)))
+        records.append({
+            'module': module,
+            'import_ms': round(milliseconds, 1),
+            'budget_ms': budget,
+            'early_imports': early})
+    milliseconds, imported = skipped_run_time(repeats)
+    early = [name for name in THIRD_PARTY_MODULES if name in imported]
+    print('{:<18} {:>7.1f}ms  budget {:>4}ms{}'.format(
+        'thor run, skipped', milliseconds, SKIPPED_RUN_BUDGET_MS,
+        '  imports ' + ', '.join(early) if early else ''))
+    if milliseconds > SKIPPED_RUN_BUDGET_MS:
+        failures.append(
+            'a thor.py run skipping every stage took {:.1f}ms, over '
+            '{}ms'.format(milliseconds, SKIPPED_RUN_BUDGET_MS))
+    if early:
+        failures.append(
+            'a thor.py run skipping every stage imports {}'.format(
+                ', '.join(early)))
+    results = {
+        'dataset': 'startup',
+        'commit': git_commit(),
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'repeats': repeats,
+        'modules': records,
+        'skipped_run': {
+            'wall_ms': round(milliseconds, 1),
+            'budget_ms': SKIPPED_RUN_BUDGET_MS,
+            'early_imports': early}}
+    return results, failures
+
+
+def main():
+    """
+    main program code
+
+    benchmark a dataset, generating a synthetic one first when given one
+    of the synthdata sizes, compare two earlier runs or check the startup
+    time of every script
+    """
+    parser = argparse.ArgumentParser(
+        description='time and memory profile every stage of the analysis')
+    parser.add_argument(
+        'dataset', nargs='?', default='10k',
+        help='path to a THOR CSV or one of {}'.format(
+            ', '.join(synthdata.SIZES)))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--kmeanssample', type=int, default=200000)
+    parser.add_argument('--kmlrows', type=int, default=100000)
+    parser.add_argument(
+        '--engine', choices=['apriori', 'fpgrowth'], default='apriori')
+    parser.add_argument('--min-support', type=float, default=0.1)
+    parser.add_argument(
+        '--no-tracemalloc', action='store_true',
+        help='skip allocation tracing for slightly more accurate times')
+    parser.add_argument('--outputdir', default=RESULTSDIR)
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BASELINE', 'RESULTS'),
+        help='compare two JSON results files instead of running')
+    parser.add_argument(
+        '--startup', action='store_true',
+        help='check the import time of every script against its budget')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.startup:
+        results, failures = check_startup()
+        write_results(results, args.outputdir)
+        for failure in failures:
+            print(failure)
+        if failures:
+            sys.exit(1)
+        return
+    filename = args.dataset
+    if filename.lower() in synthdata.SIZES:
+        size = filename.lower()
+        filename = os.path.join(
+            'synthetic', 'thor_synthetic_{}.csv'.format(size))
+        if not os.path.exists(filename):
+            synthdata.write_synthetic(filename, synthdata.SIZES[size])
+    results = run_benchmark(
+        filename, args.workers, args.kmeanssample, args.kmlrows,
+        args.engine, args.min_support, not args.no_tracemalloc)
+    write_results(results, args.outputdir)
+
+
+if __name__ == '__main__':
+    main()
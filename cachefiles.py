@@ -0,0 +1,86 @@
+"""
+paths and signatures of the caches derived from a THOR CSV
+
+only uses the standard library, so thor.py can check whether the dataset
+has changed without loading pandas
+"""
+
+
+import json
+import os
+
+
+CACHE_VERSION = 1
+
+
+def cache_paths(filename, suffix='.parquet'):
+    """
+    get the paths of the cache files for a source CSV
+
+    Args:
+        filename(str): path to the source CSV file
+        suffix(str): identifies which cache derived from the CSV we want
+
+    Returns:
+        cachefile(str): path to the cache file
+        signaturefile(str): path to the JSON file recording what the cache
+                            was built from
+    """
+    sourcedir, sourcename = os.path.split(os.path.abspath(filename))
+    cachedir = os.path.join(sourcedir, 'cache')
+    cachefile = os.path.join(cachedir, sourcename + suffix)
+    signaturefile = cachefile + '.json'
+    return cachefile, signaturefile
+
+
+def source_signature(filename):
+    """
+    describe the source CSV so we can tell when it has changed
+
+    Args:
+        filename(str): path to the source CSV file
+
+    Returns:
+        signature(dict): size and modification time of the file
+    """
+    stat = os.stat(filename)
+    signature = {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns}
+    return signature
+
+
+def cache_is_current(filename, suffix='.parquet'):
+    """
+    check if a cache exists and matches the source CSV
+
+    Args:
+        filename(str): path to the source CSV file
+        suffix(str): identifies which cache derived from the CSV we want
+
+    Returns:
+        current(bool): True if the cache can be used
+    """
+    cachefile, signaturefile = cache_paths(filename, suffix)
+    if not os.path.exists(cachefile) or not os.path.exists(signaturefile):
+        return False
+    with open(signaturefile, 'r') as f:
+        try:
+            cachedsignature = json.load(f)
+        except ValueError:
+            return False
+    return cachedsignature == source_signature(filename)
+
+
+def write_signature(signaturefile, signature):
+    """
+    record what a cache was built from
+
+    Args:
+        signaturefile(str): path to the JSON signature file
+        signature(dict): from source_signature, taken before the cache was
+                         built so a CSV changed during the build is noticed
+    """
+    with open(signaturefile, 'w') as f:
+        json.dump(signature, f)
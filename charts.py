@@ -0,0 +1,288 @@
+"""
+render charts of the Vietnam War THOR dataset in parallel
+
+a chart is described by a spec, a dict of what to draw and where to save
+it, the data in a spec is already aggregated so it is small to send to
+another process
+specs are rendered in a process pool with the non-interactive Agg backend,
+every figure is closed as soon as it is saved so memory stays flat however
+many charts are drawn
+the format of each chart comes from its filename, .png or .svg
+
+spec keys:
+    kind - 'pie', 'bar' or 'timeseries'
+    outputfile - filename to save the chart as
+    title - chart title
+    data - pandas series of counts for a pie or bar chart, or for a time
+           series a pandas series indexed by date, or a dataframe or dict
+           of them with one line per column or key
+    xlabel, ylabel - axis labels, optional
+    figsize - (width, height) in inches, optional
+"""
+
+
+import concurrent.futures
+import os
+
+import pandas as pd
+
+import cube
+import dataset
+import instrument
+import tallyfields
+
+
+FORMATS = ['png', 'svg']
+
+FIGSIZES = {'pie': (12, 12), 'bar': (12, 12), 'timeseries': (25, 10)}
+
+
+def _init_chart_worker():
+    """
+    make sure worker processes never try to open a window
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def pie_chart_spec(outputfile, count, title):
+    """
+    describe a pie chart, smallest slices first
+
+    Args:
+        outputfile(str): filename to save the chart as
+        count(pandas series): number of missions for each label
+        title(str): chart title
+
+    Returns:
+        spec(dict): the chart spec
+    """
+    count = count.sort_values(kind='stable')
+    return {'kind': 'pie', 'outputfile': outputfile, 'title': title,
+            'data': count}
+
+
+def bar_chart_spec(outputfile, count, title, top=30,
+                   xlabel='No of Missions'):
+    """
+    describe a horizontal bar chart of the values with the most missions
+
+    Args:
+        outputfile(str): filename to save the chart as
+        count(pandas series): number of missions for each label
+        title(str): chart title
+        top(int): number of bars, None for every value
+        xlabel(str): label for the x axis
+
+    Returns:
+        spec(dict): the chart spec
+    """
+    count = count.sort_values(ascending=False, kind='stable')
+    if top is not None:
+        count = count[:top]
+    return {'kind': 'bar', 'outputfile': outputfile, 'title': title,
+            'data': count[::-1], 'xlabel': xlabel}
+
+
+def time_series_spec(outputfile, series, title,
+                     ylabel='No of Missions per day'):
+    """
+    describe a time series line chart
+
+    Args:
+        outputfile(str): filename to save the chart as
+        series(pandas series or dataframe): counts indexed by date, a
+                                            dataframe or dict of series
+                                            gives one line per column
+                                            with a legend
+        title(str): chart title
+        ylabel(str): label for the y axis
+
+    Returns:
+        spec(dict): the chart spec
+    """
+    return {'kind': 'timeseries', 'outputfile': outputfile, 'title': title,
+            'data': series, 'xlabel': 'Dates', 'ylabel': ylabel}
+
+
+def draw_pie(ax, spec):
+    """
+    draw a pie chart spec onto some axes
+    """
+    data = spec['data']
+    ax.pie(list(data.to_numpy()), labels=list(data.index),
+           autopct='%1.1f%%', rotatelabels=True)
+
+
+def draw_bar(ax, spec):
+    """
+    draw a bar chart spec onto some axes
+    """
+    data = spec['data']
+    ax.barh([str(label) for label in data.index], data.to_numpy())
+
+
+def draw_time_series(ax, spec):
+    """
+    draw a time series spec onto some axes
+    """
+    data = spec['data']
+    if isinstance(data, pd.Series):
+        ax.plot(data.index, data.to_numpy(), marker='o', linestyle='solid')
+        return
+    for line in data:
+        ax.plot(data[line].index, data[line].to_numpy(), marker='o',
+                linestyle='solid', label=line)
+    ax.legend()
+
+
+DRAW = {'pie': draw_pie, 'bar': draw_bar, 'timeseries': draw_time_series}
+
+
+def render_chart(spec):
+    """
+    draw a chart spec and save it, closing the figure afterwards
+
+    Args:
+        spec(dict): the chart spec
+
+    Returns:
+        outputfile(str): filename the chart was saved as
+    """
+    # matplotlib is only loaded by the processes that draw
+    import matplotlib.pyplot as plt
+    outputfile = spec['outputfile']
+    extension = os.path.splitext(outputfile)[1].lstrip('.').lower()
+    if extension not in FORMATS:
+        raise ValueError('unsupported chart format {}'.format(outputfile))
+    figsize = spec.get('figsize', FIGSIZES[spec['kind']])
+    fig, ax = plt.subplots(figsize=figsize)
+    try:
+        DRAW[spec['kind']](ax, spec)
+        ax.set_title(spec['title'])
+        if 'xlabel' in spec:
+            ax.set_xlabel(spec['xlabel'])
+        if 'ylabel' in spec:
+            ax.set_ylabel(spec['ylabel'])
+        fig.savefig(outputfile)
+    finally:
+        plt.close(fig)
+    return outputfile
+
+
+def render_charts(specs, workers=None):
+    """
+    render many chart specs in parallel
+
+    Args:
+        specs(list): the chart specs
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        outputfiles(list): filenames of the charts, in the order of specs
+    """
+    with instrument.stage('render charts', rowsin=len(specs)):
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_chart_worker) as pool:
+            return list(pool.map(render_chart, specs))
+
+
+def chart_filename(outputdir, name, kind, imageformat='png'):
+    """
+    filename for a chart of one field
+
+    Args:
+        outputdir(str): directory for the charts
+        name(str): readable name of the field
+        kind(str): kind of chart, e.g. 'pie'
+        imageformat(str): 'png' or 'svg'
+
+    Returns:
+        outputfile(str): the filename
+    """
+    return os.path.join(
+        outputdir, '{} {}.{}'.format(name, kind, imageformat))
+
+
+def dimension_charts(df, fields, outputdir, imageformat='png', top=10,
+                     freq='MS', weights=None):
+    """
+    describe a pie chart, a tally bar chart and a time series for each field
+
+    Args:
+        df(pandas dataframe): missions, or the aggregate cube, with cleaned
+                              datetime64 MSNDATE
+        fields(dict): keys are readable names, values are columns
+        outputdir(str): directory for the charts
+        imageformat(str): 'png' or 'svg'
+        top(int): number of values in each time series
+        freq(str): 'D' for daily, 'W' for weekly or 'MS' for monthly counts
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the cube, None counts the rows
+
+    Returns:
+        specs(list): the chart specs
+    """
+    # these render their own charts through this module
+    import piecharts
+    import timeseries
+    periods = {'D': 'day', 'W': 'week', 'MS': 'month'}
+    specs = []
+    for name, column in fields.items():
+        count = piecharts.count_values(df, column, weights)
+        specs.append(pie_chart_spec(
+            chart_filename(outputdir, name, 'pie', imageformat), count,
+            name))
+        specs.append(bar_chart_spec(
+            chart_filename(outputdir, name, 'tally', imageformat), count,
+            name))
+        matrix = timeseries.time_series_matrix(
+            df, column, freq=freq, top=top, weights=weights)
+        specs.append(time_series_spec(
+            chart_filename(outputdir, name, 'time series', imageformat),
+            matrix,
+            'Missions per {}, Vietnam War (1965-1975) per {}'.format(
+                periods.get(freq, freq), name),
+            ylabel='No of Missions per {}'.format(periods.get(freq, freq))))
+    return specs
+
+
+def main(imageformat='png', usecube=False, filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    draw a pie chart, a tally bar chart and a monthly time series for
+    every field we tally, in parallel
+
+    Args:
+        imageformat(str): 'png' or 'svg'
+        usecube(bool): answer from the aggregate cube instead of counting
+                       the raw missions
+        filename(str): path to the dataset CSV file
+    """
+    fields = {
+        name: column for name, column in tallyfields.FIELDS.items()
+        if column != 'MSNDATE'}
+    with instrument.stage('load') as timer:
+        if usecube:
+            df = cube.clean_cube_dates(cube.load_cube(filename))
+            weights = 'COUNT'
+        else:
+            df = dataset.load_dataset(
+                filename, columns=['MSNDATE'] + list(fields.values()))
+            df['MSNDATE'], invalid, rejected = dataset.clean_dates(
+                df['MSNDATE'])
+            df = df[~invalid]
+            weights = None
+        timer.rowsout = len(df)
+    outputdir = 'Charts'
+    os.makedirs(outputdir, exist_ok=True)
+    with instrument.stage('aggregate', rowsin=len(df)):
+        specs = dimension_charts(
+            df, fields, outputdir, imageformat, weights=weights)
+    print('rendering {} charts to {}'.format(len(specs), outputdir))
+    render_charts(specs)
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
@@ -0,0 +1,258 @@
+"""
+frequency tables of any pairs of categorical fields of the Vietnam War THOR
+dataset
+
+each column is turned into integer codes once, then every table is a single
+bincount over the combined row and column codes instead of a separate
+pandas.crosstab group by
+tables with many cells, like UNIT by WEAPONTYPE, only keep their non-empty
+cells, and the chi-square test of independence and Cramer's V can be worked
+out from any table
+"""
+
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+MAX_DENSE_CELLS = 100000
+
+
+def factorize_column(column):
+    """
+    convert a column to integer codes in sorted order of its values
+
+    categorical columns reuse their codes, only their categories are sorted
+    missing values get the code after the last value, so a table can keep
+    them in an extra row or column and drop it at the end instead of
+    filtering every pair
+
+    Args:
+        column(pandas series): the column to convert
+
+    Returns:
+        codes(numpy array): position of each value in uniques, len(uniques)
+                            if missing
+        uniques(pandas index): the distinct values, sorted
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        uniques = column.cat.categories
+        order = uniques.argsort()
+        uniques = uniques[order]
+        codes = column.cat.codes.to_numpy()
+    else:
+        codes, uniques = pd.factorize(column, sort=True)
+        order = np.arange(len(uniques))
+    remap = np.empty(len(order) + 1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    remap[-1] = len(order)
+    return remap[codes], uniques
+
+
+def factorize_fields(df, columns):
+    """
+    convert several columns to integer codes, each one only once
+
+    Args:
+        df(pandas dataframe): the missions, or the aggregate cube
+        columns(list): the columns to convert
+
+    Returns:
+        factorized(dict): keys are column names, values are tuples of
+                          codes and sorted unique values
+    """
+    return {column: factorize_column(df[column]) for column in columns}
+
+
+def all_pairs(columns):
+    """
+    every pair of columns, each pair once
+
+    Args:
+        columns(list): the columns
+
+    Returns:
+        pairs(list): tuples of index column and columns column
+    """
+    return list(itertools.combinations(columns, 2))
+
+
+def count_cells(rowcodes, nrows, colcodes, ncols, weights=None):
+    """
+    total the rows falling in each cell of a table
+
+    the extra row and column holding missing values are dropped
+    one bincount over every possible cell, or a sort of the combined codes
+    when there are more possible cells than missions
+
+    Args:
+        rowcodes(numpy array): row of the table for each mission
+        nrows(int): number of rows in the table, not counting missing
+        colcodes(numpy array): column of the table for each mission
+        ncols(int): number of columns in the table, not counting missing
+        weights(numpy array): amount each mission adds, None counts them
+
+    Returns:
+        rows(numpy array): row of each non-empty cell
+        cols(numpy array): column of each non-empty cell
+        counts(numpy array): total of each non-empty cell
+    """
+    width = ncols + 1
+    combined = rowcodes * width + colcodes
+    if (nrows + 1) * width <= len(combined):
+        counts = np.bincount(combined, weights=weights)
+        cells = np.flatnonzero(counts)
+        counts = counts[cells]
+    else:
+        cells, inverse = np.unique(combined, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights)
+    rows, cols = np.divmod(cells, width)
+    keep = (rows < nrows) & (cols < ncols) & (counts != 0)
+    return rows[keep], cols[keep], counts[keep]
+
+
+def build_table(rows, cols, counts, rowuniques, coluniques, index, columns,
+                sparse):
+    """
+    turn the non-empty cells into a frequency table like pandas.crosstab
+
+    values that never appear in a non-empty cell are left out
+
+    Args:
+        rows(numpy array): row of each non-empty cell
+        cols(numpy array): column of each non-empty cell
+        counts(numpy array): total of each non-empty cell
+        rowuniques(pandas index): values for the rows of the table
+        coluniques(pandas index): values for the columns of the table
+        index(str): name of the rows
+        columns(str): name of the columns
+        sparse(bool): return only the non-empty cells
+
+    Returns:
+        table(pandas dataframe or series): the frequency table, or when
+                                           sparse a series of the non-empty
+                                           cells indexed by row and column
+                                           value like cube.query_cube
+    """
+    rowsused, rows = np.unique(rows, return_inverse=True)
+    colsused, cols = np.unique(cols, return_inverse=True)
+    rowlabels = pd.Index(rowuniques[rowsused], name=index)
+    collabels = pd.Index(coluniques[colsused], name=columns)
+    if sparse:
+        cells = pd.MultiIndex(
+            levels=[rowlabels, collabels], codes=[rows, cols],
+            names=[index, columns], verify_integrity=False)
+        return pd.Series(counts, index=cells)
+    values = np.zeros((len(rowsused), len(colsused)), dtype=counts.dtype)
+    values[rows, cols] = counts
+    return pd.DataFrame(values, index=rowlabels, columns=collabels)
+
+
+def crosstab_pairs(df, pairs, weights=None, maxdense=MAX_DENSE_CELLS,
+                   factorized=None):
+    """
+    make frequency tables of several pairs of columns
+
+    each column is factorized once however many pairs it is in, tables
+    with more than maxdense possible cells only keep their non-empty cells
+
+    Args:
+        df(pandas dataframe): the missions, or the aggregate cube
+        pairs(list): tuples of index column and columns column
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the cube, None counts the rows
+        maxdense(int): largest number of cells to return as a dense table,
+                       None to always return dense tables
+        factorized(dict): output of factorize_fields to reuse, columns
+                          missing from it are factorized here
+
+    Returns:
+        tables(dict): keys are the pairs, values are pandas dataframes of
+                      counts the same as pandas.crosstab, or
+                      cube.crosstab_cube with weights, sparse tables are
+                      series of the non-empty cells
+    """
+    factorized = dict(factorized or {})
+    for column in itertools.chain.from_iterable(pairs):
+        if column not in factorized:
+            factorized[column] = factorize_column(df[column])
+    weightvalues = None
+    dtype = np.int64
+    if weights is not None:
+        weightvalues = df[weights].to_numpy()
+        if not np.issubdtype(weightvalues.dtype, np.integer):
+            dtype = np.float64
+        weightvalues = weightvalues.astype(float)
+    tables = {}
+    for index, columns in pairs:
+        rowcodes, rowuniques = factorized[index]
+        colcodes, coluniques = factorized[columns]
+        nrows, ncols = len(rowuniques), len(coluniques)
+        rows, cols, counts = count_cells(
+            rowcodes, nrows, colcodes, ncols, weightvalues)
+        sparse = maxdense is not None and nrows * ncols > maxdense
+        tables[(index, columns)] = build_table(
+            rows, cols, counts.astype(dtype), rowuniques, coluniques, index,
+            columns, sparse)
+    return tables
+
+
+def association(table):
+    """
+    chi-square test of independence and Cramer's V for a frequency table
+
+    only the non-empty cells are summed, so sparse tables are never made
+    dense
+
+    Args:
+        table(pandas dataframe or series): the frequency table, dense or
+                                           sparse
+
+    Returns:
+        stats(dict): chi2, dof, pvalue and cramersv of the table
+    """
+    from scipy import stats
+    if isinstance(table, pd.Series):
+        rows, cols = table.index.codes
+        nrows, ncols = (len(level) for level in table.index.levels)
+        counts = table.to_numpy()
+    else:
+        values = table.to_numpy()
+        rows, cols = np.nonzero(values)
+        nrows, ncols = table.shape
+        counts = values[rows, cols]
+    counts = counts.astype(float)
+    rowtotals = np.bincount(rows, weights=counts, minlength=nrows)
+    coltotals = np.bincount(cols, weights=counts, minlength=ncols)
+    total = counts.sum()
+    expected = rowtotals[rows] * coltotals[cols] / total
+    chi2 = (counts ** 2 / expected).sum() - total
+    dof = (nrows - 1) * (ncols - 1)
+    smallest = min(nrows, ncols) - 1
+    cramersv = np.sqrt(chi2 / (total * smallest)) if smallest else np.nan
+    return {
+        'chi2': chi2,
+        'dof': dof,
+        'pvalue': stats.chi2.sf(chi2, dof) if dof else np.nan,
+        'cramersv': cramersv}
+
+
+def association_table(tables):
+    """
+    chi-square test and Cramer's V for several frequency tables
+
+    Args:
+        tables(dict): keys are pairs of columns, values are frequency tables
+
+    Returns:
+        associations(pandas dataframe): one row per pair of columns with
+                                        chi2, dof, pvalue and cramersv,
+                                        strongest association first
+    """
+    associations = pd.DataFrame(
+        [association(table) for table in tables.values()],
+        index=pd.MultiIndex.from_tuples(
+            list(tables), names=['index', 'columns']))
+    return associations.sort_values('cramersv', ascending=False)
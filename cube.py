@@ -0,0 +1,168 @@
+"""
+a precomputed aggregate cube of the Vietnam War THOR dataset
+
+the number of missions and the total weapons delivered and aircraft flown
+for every combination of mission date and the categorical fields we tally,
+built once from the dataset cache and stored next to it
+tallies, pie charts, crosstabs and time series can all be answered from the
+cube without reloading the raw rows
+"""
+
+
+import os
+
+import numpy as np
+import pandas as pd
+
+import dataset
+
+
+DIMENSIONS = [
+    'MSNDATE', 'MILSERVICE', 'VALID_AIRCRAFT_ROOT', 'TAKEOFFLOCATION',
+    'TGTTYPE', 'MFUNC_DESC', 'TGTCOUNTRY', 'COUNTRYFLYINGMISSION',
+    'MFUNC_DESC_CLASS', 'UNIT', 'WEAPONTYPE']
+
+MEASURES = ['COUNT', 'NUMWEAPONSDELIVERED', 'NUMOFACFT']
+
+CUBE_SUFFIX = '.cube.parquet'
+
+
+def build_cube(df):
+    """
+    aggregate missions into the cube
+
+    missing values are kept as their own group so the totals over any
+    dimension still add up to the number of missions
+
+    Args:
+        df(pandas dataframe): missions with the DIMENSIONS columns and
+                              NUMWEAPONSDELIVERED and NUMOFACFT
+
+    Returns:
+        cube(pandas dataframe): one row per combination of DIMENSIONS with
+                                the MEASURES columns
+    """
+    grouped = df.groupby(DIMENSIONS, observed=True, dropna=False, sort=False)
+    cube = grouped.agg(
+        COUNT=('NUMOFACFT', 'size'),
+        NUMWEAPONSDELIVERED=('NUMWEAPONSDELIVERED', 'sum'),
+        NUMOFACFT=('NUMOFACFT', 'sum'))
+    cube = cube.reset_index()
+    cube['COUNT'] = pd.to_numeric(cube['COUNT'], downcast='integer')
+    return cube
+
+
+def load_cube(filename):
+    """
+    load the cube for a dataset, building it first if the CSV has changed
+
+    without pyarrow the cube is built in memory each time
+
+    Args:
+        filename(str): path to the source CSV file
+
+    Returns:
+        cube(pandas dataframe): one row per combination of DIMENSIONS with
+                                the MEASURES columns
+    """
+    columns = DIMENSIONS + ['NUMWEAPONSDELIVERED', 'NUMOFACFT']
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return build_cube(dataset.load_dataset(filename, columns=columns))
+    cubefile, signaturefile = dataset.cache_paths(filename, CUBE_SUFFIX)
+    if not dataset.cache_is_current(filename, CUBE_SUFFIX):
+        print('building aggregate cube of {}'.format(filename))
+        signature = dataset.source_signature(filename)
+        cube = build_cube(dataset.load_dataset(filename, columns=columns))
+        os.makedirs(os.path.dirname(cubefile), exist_ok=True)
+        tmpfile = cubefile + '.tmp'
+        cube.to_parquet(tmpfile)
+        os.replace(tmpfile, cubefile)
+        dataset.write_signature(signaturefile, signature)
+        return cube
+    return pd.read_parquet(cubefile)
+
+
+def slice_cube(cube, where):
+    """
+    keep only the cells of the cube matching some values
+
+    Args:
+        cube(pandas dataframe): the cube
+        where(dict): keys are dimensions, values are a value or a list of
+                     values to keep
+
+    Returns:
+        cube(pandas dataframe): the matching cells
+    """
+    mask = np.ones(len(cube), dtype=bool)
+    for dimension, values in where.items():
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        mask &= cube[dimension].isin(values).to_numpy()
+    return cube[mask]
+
+
+def query_cube(cube, by, where=None, measures='COUNT'):
+    """
+    slice, dice and roll up the cube
+
+    the same as grouping the raw missions by the dimensions in by, missing
+    values are left out like pandas groupby does
+
+    Args:
+        cube(pandas dataframe): the cube
+        by(list): dimensions to keep, every other dimension is summed over
+        where(dict): keys are dimensions, values are a value or a list of
+                     values to keep
+        measures(str or list): the measures to total
+
+    Returns:
+        result(pandas series or dataframe): totals indexed by the
+                                            dimensions in by
+    """
+    if where:
+        cube = slice_cube(cube, where)
+    if not by:
+        return cube[measures].sum()
+    return cube.groupby(by, observed=True)[measures].sum()
+
+
+def crosstab_cube(cube, index, columns, measure='COUNT', where=None):
+    """
+    frequency table of two dimensions from the cube
+
+    matches pandas.crosstab on the raw missions
+
+    Args:
+        cube(pandas dataframe): the cube
+        index(str): dimension for the rows
+        columns(str): dimension for the columns
+        measure(str): the measure to total
+        where(dict): keys are dimensions, values are a value or a list of
+                     values to keep
+
+    Returns:
+        table(pandas dataframe): the frequency table
+    """
+    totals = query_cube(cube, [index, columns], where, measure)
+    totals.index = totals.index.remove_unused_levels()
+    table = totals.unstack(fill_value=0)
+    table.columns.name = columns
+    return table
+
+
+def clean_cube_dates(cube):
+    """
+    convert the cube's mission dates to datetime64 and drop invalid dates
+
+    Args:
+        cube(pandas dataframe): the cube
+
+    Returns:
+        cube(pandas dataframe): the cube with cleaned MSNDATE
+    """
+    cube = cube.copy()
+    cube['MSNDATE'], invalid, rejected = dataset.clean_dates(cube['MSNDATE'])
+    return cube[~invalid]
@@ -0,0 +1,402 @@
+"""
+load the Vietnam War THOR dataset
+
+the raw CSV is parsed once into a typed, columnar Parquet cache
+low cardinality text columns are stored as categoricals and integer columns
+are narrowed, so later loads only read the columns a script asks for
+the cache is rebuilt automatically whenever the source CSV changes
+
+also holds the shared cleaning of mission dates and the decoding of the
+original target co-ordinates
+"""
+
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from cachefiles import (  # noqa: F401
+    CACHE_VERSION, cache_is_current, cache_paths, source_signature,
+    write_signature)
+
+
+CATEGORICAL_COLUMNS = [
+    'COUNTRYFLYINGMISSION', 'MILSERVICE', 'SOURCERECORD',
+    'VALID_AIRCRAFT_ROOT', 'TAKEOFFLOCATION', 'TGTTYPE', 'WEAPONTYPE',
+    'WEAPONTYPECLASS', 'AIRCRAFT_ORIGINAL', 'AIRCRAFT_ROOT', 'AIRFORCEGROUP',
+    'AIRFORCESQDN', 'MFUNC', 'MFUNC_DESC', 'OPERATIONSUPPORTED',
+    'PERIODOFDAY', 'UNIT', 'TGTCLOUDCOVER', 'TGTCONTROL', 'TGTCOUNTRY',
+    'TGTORIGCOORDSFORMAT', 'TGTWEATHER', 'GEOZONE', 'MFUNC_DESC_CLASS']
+
+
+def narrow_dtypes(df):
+    """
+    convert a freshly parsed dataframe to compact dtypes
+
+    text columns in CATEGORICAL_COLUMNS become categoricals, integer columns
+    are downcast to the smallest integer type that holds them
+    float columns are left alone so co-ordinates are not rounded
+
+    Args:
+        df(pandas dataframe): dataframe to convert
+
+    Returns:
+        df(pandas dataframe): the converted dataframe
+    """
+    for column in df.columns:
+        if column in CATEGORICAL_COLUMNS:
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        elif pd.api.types.is_integer_dtype(df[column].dtype):
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+
+def read_thor_csv(filename, columns=None, **kwargs):
+    """
+    parse the raw CSV with compact dtypes
+
+    Args:
+        filename(str): path to the source CSV file
+        columns(list): only read these columns, None reads them all
+        kwargs: passed on to pandas.read_csv
+
+    Returns:
+        df(pandas dataframe): the parsed dataset, or an iterator of
+                              dataframes if chunksize is given
+    """
+    dtypes = {column: 'category' for column in CATEGORICAL_COLUMNS
+              if columns is None or column in columns}
+    return pd.read_csv(
+        filename, usecols=columns, dtype=dtypes, low_memory=False, **kwargs)
+
+
+def build_cache(filename):
+    """
+    parse the source CSV and write the columnar cache
+
+    Args:
+        filename(str): path to the source CSV file
+    """
+    cachefile, signaturefile = cache_paths(filename)
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    print('building columnar cache of {}'.format(filename))
+    signature = source_signature(filename)
+    df = narrow_dtypes(read_thor_csv(filename))
+    tmpfile = cachefile + '.tmp'
+    df.to_parquet(tmpfile, row_group_size=250000)
+    os.replace(tmpfile, cachefile)
+    write_signature(signaturefile, signature)
+
+
+def load_dataset(filename, columns=None):
+    """
+    load the THOR dataset from the columnar cache
+
+    the cache is built on first use and rebuilt when the CSV changes
+    if pyarrow is not installed the CSV is read directly instead
+
+    Args:
+        filename(str): path to the source CSV file
+        columns(list): only load these columns, None loads them all
+
+    Returns:
+        df(pandas dataframe): the dataset
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return narrow_dtypes(read_thor_csv(filename, columns))
+    if not cache_is_current(filename):
+        build_cache(filename)
+    cachefile = cache_paths(filename)[0]
+    return pd.read_parquet(cachefile, columns=columns)
+
+
+def clean_dates(dates, as_strings=False):
+    """
+    clean mission dates from yyyymmdd or yyyy-mm-dd in one columnar pass
+
+    each distinct value is only parsed once, there are a few thousand
+    distinct dates against millions of rows
+    rows are rejected as 'missing' (no date), 'format' (not yyyymmdd or
+    yyyy-mm-dd) or 'calendar' (not a real date e.g. 19720231)
+    this is stricter than the clean_date it replaced in timeseries.py and
+    operationsmap.py, which passed missing dates and values not starting
+    with 8 digits through unchanged, and took the day from characters 6 to
+    9, so 196501015 became 1965-01-015, neither caller could use those
+    values, to_datetime failed on them and the Linebacker 2 date filter
+    never matched them, so they are now rejected and counted instead
+
+    Args:
+        dates(pandas series): the raw MSNDATE column
+        as_strings(bool): return yyyy-mm-dd strings instead of datetime64
+
+    Returns:
+        cleandates(pandas series): the cleaned dates, NaT (or NaN when
+                                   as_strings is True) where invalid
+        invalid(pandas series): boolean mask, True for rejected rows
+        rejected(dict): number of rejected rows for each reason
+    """
+    codes, uniques = pd.factorize(dates)
+    uniques = pd.Index(uniques)
+    if pd.api.types.is_float_dtype(uniques.dtype) and (uniques % 1 == 0).all():
+        # a column of yyyymmdd numbers with gaps is parsed as floats
+        uniques = uniques.astype('int64')
+    text = pd.Series(uniques.astype(str))
+    wellformed = text.str.fullmatch(r'\d{8}|\d{4}-\d{2}-\d{2}')
+    digits = text.where(wellformed).str.replace('-', '', regex=False)
+    parsed = pd.to_datetime(
+        pd.DataFrame({
+            'year': pd.to_numeric(digits.str[0:4]),
+            'month': pd.to_numeric(digits.str[4:6]),
+            'day': pd.to_numeric(digits.str[6:8])}),
+        errors='coerce')
+    reasons = np.where(
+        ~wellformed.to_numpy(), 1, np.where(parsed.isna().to_numpy(), 2, 0))
+    # missing values are factorized to code -1, which picks the extra entry
+    # appended to the end of each lookup array
+    reasons = np.append(reasons, 3)
+    rowreasons = reasons[codes]
+    reasoncounts = np.bincount(rowreasons, minlength=4)
+    rejected = {
+        'missing': int(reasoncounts[3]),
+        'format': int(reasoncounts[1]),
+        'calendar': int(reasoncounts[2])}
+    if as_strings:
+        uniqueclean = pd.DatetimeIndex(parsed).strftime('%Y-%m-%d')
+        uniqueclean = np.append(uniqueclean.to_numpy(dtype=object), np.nan)
+    else:
+        uniqueclean = np.append(
+            parsed.to_numpy(), np.datetime64('NaT', 'ns'))
+    cleandates = pd.Series(
+        uniqueclean[codes], index=dates.index, name=dates.name)
+    invalid = pd.Series(rowreasons != 0, index=dates.index, name=dates.name)
+    return cleandates, invalid, rejected
+
+
+def coords_pattern(coordformat):
+    """
+    build a regex for TGTORIGCOORDS values from their TGTORIGCOORDSFORMAT
+
+    the format spells out the digits of the value, D for degrees, M for
+    minutes and S for seconds, followed by N for the N/S hemisphere of the
+    latitude and E for the E/W hemisphere of the longitude
+    a '.' marks where the decimal point of a field goes, the point is
+    usually left out of the value, e.g. '210999N1059331E' in the format
+    'DD.DDDDN DDD.DDDDE' is 21.0999N 105.9331E
+    spaces in the format are optional in the value
+
+    Args:
+        coordformat(str): a TGTORIGCOORDSFORMAT value
+
+    Returns:
+        pattern(str): regex with a named group for each field, e.g. latD,
+                      latDfrac and lath for the degrees, decimal places and
+                      hemisphere of the latitude
+
+    Raises:
+        ValueError: if the format is not understood
+    """
+    axisformat = r'(D+)(?:\.(D+))?(?:(M+)(?:\.(M+))?)?(?:(S+)(?:\.(S+))?)?'
+    parts = re.fullmatch(
+        r'\s*{0}N\s*{0}E\s*'.format(axisformat), str(coordformat))
+    if parts is None:
+        raise ValueError('unknown co-ordinate format {}'.format(coordformat))
+    pattern = r'^\s*'
+    for axis, runs, hemispheres in (
+            ('lat', parts.groups()[:6], 'NS'),
+            ('lon', parts.groups()[6:], 'EW')):
+        for unit, whole, fraction in zip('DMS', runs[::2], runs[1::2]):
+            if whole is not None:
+                pattern += r'(?P<{}{}>\d{{{}}})'.format(
+                    axis, unit, len(whole))
+            if fraction is not None:
+                pattern += r'\.?(?P<{}{}frac>\d{{{}}})'.format(
+                    axis, unit, len(fraction))
+        pattern += r'(?P<{}h>[{}])\s*'.format(axis, hemispheres)
+    return pattern + '$'
+
+
+def _axis_degrees(fields, axis):
+    """
+    add up the extracted fields of a latitude or longitude
+
+    Args:
+        fields(pandas dataframe): the named groups of coords_pattern
+        axis(str): 'lat' or 'lon'
+
+    Returns:
+        degrees(numpy array): signed decimal degrees, NaN where the value
+                              did not match or is out of range
+    """
+    degrees = np.zeros(len(fields))
+    valid = np.ones(len(fields), dtype=bool)
+    for unit, scale in (('D', 1.0), ('M', 60.0), ('S', 3600.0)):
+        if axis + unit not in fields:
+            continue
+        value = pd.to_numeric(fields[axis + unit]).to_numpy(dtype=float)
+        if axis + unit + 'frac' in fields:
+            fraction = fields[axis + unit + 'frac']
+            value = value + (
+                pd.to_numeric(fraction).to_numpy(dtype=float) /
+                10.0 ** fraction.str.len().to_numpy(dtype=float))
+        if unit != 'D':
+            valid &= value < 60
+        degrees += value / scale
+    limit = 90 if axis == 'lat' else 180
+    valid &= degrees <= limit
+    sign = np.where(fields[axis + 'h'].isin(['S', 'W']).to_numpy(), -1, 1)
+    return np.where(valid, sign * degrees, np.nan)
+
+
+def decode_coords(coords, formats):
+    """
+    decode TGTORIGCOORDS into decimal degrees in one columnar pass
+
+    each format is matched with a regex built from the format itself and
+    each distinct value of a format is only decoded once
+
+    Args:
+        coords(pandas series): TGTORIGCOORDS values
+        formats(pandas series): TGTORIGCOORDSFORMAT of each value
+
+    Returns:
+        lats(numpy array): latitudes, NaN where the value could not be
+                           decoded
+        lons(numpy array): longitudes, NaN where the value could not be
+                           decoded
+        decoded(dict): keys are formats, values are dicts of the number of
+                       values 'recovered' and 'failed', values with no
+                       co-ordinates or format are counted under 'none'
+    """
+    lats = np.full(len(coords), np.nan)
+    lons = np.full(len(coords), np.nan)
+    decoded = {}
+    present = (coords.notna() & formats.notna()).to_numpy()
+    if (~present).any():
+        decoded['none'] = {'recovered': 0, 'failed': int((~present).sum())}
+    formatcodes, formatvalues = pd.factorize(formats)
+    for formatcode, coordformat in enumerate(formatvalues):
+        rows = np.flatnonzero((formatcodes == formatcode) & present)
+        try:
+            pattern = coords_pattern(coordformat)
+        except ValueError:
+            decoded[coordformat] = {'recovered': 0, 'failed': len(rows)}
+            continue
+        codes, uniques = pd.factorize(coords.iloc[rows])
+        fields = pd.Series(uniques).astype(str).str.extract(pattern)
+        lats[rows] = _axis_degrees(fields, 'lat')[codes]
+        lons[rows] = _axis_degrees(fields, 'lon')[codes]
+        recovered = int((~np.isnan(lats[rows]) & ~np.isnan(lons[rows])).sum())
+        decoded[coordformat] = {
+            'recovered': recovered, 'failed': len(rows) - recovered}
+    failed = np.isnan(lats) | np.isnan(lons)
+    lats[failed] = np.nan
+    lons[failed] = np.nan
+    return lats, lons, decoded
+
+
+def fill_missing_coords(df):
+    """
+    fill missing WGS84 target co-ordinates from TGTORIGCOORDS
+
+    the decimal degree columns stay float, missions that cannot be
+    recovered are left missing
+
+    Args:
+        df(pandas dataframe): missions with TGTLATDD_DDD_WGS84,
+                              TGTLONDDD_DDD_WGS84, TGTORIGCOORDS and
+                              TGTORIGCOORDSFORMAT columns
+
+    Returns:
+        df(pandas dataframe): the missions with co-ordinates filled in
+        decoded(dict): number of missing co-ordinates 'recovered' and
+                       'failed' for each format, see decode_coords
+    """
+    missing = (
+        df['TGTLATDD_DDD_WGS84'].isna() |
+        df['TGTLONDDD_DDD_WGS84'].isna()).to_numpy()
+    if not missing.any():
+        return df, {}
+    lats, lons, decoded = decode_coords(
+        df['TGTORIGCOORDS'][missing], df['TGTORIGCOORDSFORMAT'][missing])
+    filled = {}
+    for column, values in (
+            ('TGTLATDD_DDD_WGS84', lats), ('TGTLONDDD_DDD_WGS84', lons)):
+        current = np.array(
+            pd.to_numeric(df[column], errors='coerce'), dtype=float)
+        current[missing] = np.where(
+            np.isnan(current[missing]), values, current[missing])
+        filled[column] = current
+    return df.assign(**filled), decoded
+
+
+def open_cache(cachefile, columns=None):
+    """
+    open the columnar cache to read it in pieces
+
+    text columns in CATEGORICAL_COLUMNS are read as categoricals
+
+    Args:
+        cachefile(str): path to the cache, from cache_paths
+        columns(list): the columns that will be read, None for all of them
+
+    Returns:
+        parquetfile(pyarrow ParquetFile): the opened cache
+    """
+    import pyarrow.parquet as pq
+    if columns is None:
+        categoricals = CATEGORICAL_COLUMNS
+    else:
+        categoricals = [
+            column for column in columns if column in CATEGORICAL_COLUMNS]
+    return pq.ParquetFile(cachefile, read_dictionary=categoricals)
+
+
+def read_row_group(cachefile, rowgroup, columns=None):
+    """
+    read one row group of the columnar cache, so separate processes can
+    each read their own part of it
+
+    Args:
+        cachefile(str): path to the cache, from cache_paths
+        rowgroup(int): number of the row group, each has up to 250000 rows
+        columns(list): only load these columns, None loads them all
+
+    Returns:
+        chunk(pandas dataframe): the rows of the row group
+    """
+    parquetfile = open_cache(cachefile, columns)
+    return parquetfile.read_row_group(rowgroup, columns=columns).to_pandas()
+
+
+def iter_dataset(filename, columns=None, chunksize=250000):
+    """
+    read the THOR dataset in chunks of a bounded size
+
+    chunks come from the columnar cache when pyarrow is installed,
+    otherwise the CSV is read in chunks
+
+    Args:
+        filename(str): path to the source CSV file
+        columns(list): only load these columns, None loads them all
+        chunksize(int): maximum number of rows in each chunk
+
+    Yields:
+        chunk(pandas dataframe): the next chunk of rows
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        for chunk in read_thor_csv(filename, columns, chunksize=chunksize):
+            yield narrow_dtypes(chunk)
+        return
+    if not cache_is_current(filename):
+        build_cache(filename)
+    parquetfile = open_cache(cache_paths(filename)[0], columns)
+    for batch in parquetfile.iter_batches(
+            batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
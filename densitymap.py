@@ -0,0 +1,446 @@
+"""
+create a KML density map of the missions in the Vietnam THOR dataset
+
+instead of a placemark for every mission the target co-ordinates are
+counted into a grid of cells, the grid is coloured into a PNG image and
+draped over the ground with a KML GroundOverlay
+each map has grids at several cell sizes, Google Earth shows the coarse
+grid when zoomed out and finer grids as you zoom in
+counts can be weighted, e.g. by the number of weapons delivered, and split
+into a folder for each value of a column, e.g. the mission type
+
+the animated map counts the missions in each cell for each day or week and
+draws one coloured square per cell and period with a KML TimeSpan, so the
+Google Earth time slider can replay the war without a placemark for every
+mission
+"""
+
+
+import os
+
+import numpy as np
+
+import dataset
+import instrument
+import kml
+import spatialindex
+
+
+COORDS = ['TGTLATDD_DDD_WGS84', 'TGTLONDDD_DDD_WGS84']
+
+# cell sizes in decimal degrees, coarsest first
+CELLSIZES = [0.1, 0.025, 0.005]
+
+COLORMAP = 'inferno'
+
+# the number of days in each period of the animated map, days are counted
+# from 1970-01-01 which was a Thursday, so weeks are offset to start on
+# Sundays like the weekly time series in timeseries.py
+PERIODS = {'D': (1, 0), 'W': (7, 4)}
+
+# number of colours the squares of the animated map are split into
+COLORLEVELS = 8
+
+
+def grid_shape(bbox, cellsize):
+    """
+    number of rows and columns of cells covering bbox
+
+    Args:
+        bbox(dict): north, south, east and west edges of the grid
+        cellsize(float): width and height of a cell in decimal degrees
+
+    Returns:
+        nrows(int): number of rows
+        ncols(int): number of columns
+    """
+    nrows = int(np.ceil((bbox['north'] - bbox['south']) / cellsize))
+    ncols = int(np.ceil((bbox['east'] - bbox['west']) / cellsize))
+    return nrows, ncols
+
+
+def cell_ids(lons, lats, bbox, cellsize):
+    """
+    find the cell of a grid each point falls in
+
+    Args:
+        lons(numpy array): longitudes in decimal degrees
+        lats(numpy array): latitudes in decimal degrees
+        bbox(dict): north, south, east and west edges of the grid
+        cellsize(float): width and height of a cell in decimal degrees
+
+    Returns:
+        cellids(numpy array): row * ncols + column of the cell of each
+                              point, rows count from the northern edge and
+                              columns from the western, -1 outside bbox
+    """
+    nrows, ncols = grid_shape(bbox, cellsize)
+    inside = (
+        (lons >= bbox['west']) & (lons <= bbox['east']) &
+        (lats >= bbox['south']) & (lats <= bbox['north']))
+    col = np.minimum(
+        ((lons[inside] - bbox['west']) / cellsize).astype(np.int64),
+        ncols - 1)
+    row = np.minimum(
+        ((bbox['north'] - lats[inside]) / cellsize).astype(np.int64),
+        nrows - 1)
+    cellids = np.full(len(lons), -1, dtype=np.int64)
+    cellids[inside] = row * ncols + col
+    return cellids
+
+
+def density_grid(lons, lats, bbox, cellsize, weights=None):
+    """
+    count the points in each cell of a grid
+
+    points outside bbox are left out
+
+    Args:
+        lons(numpy array): longitudes in decimal degrees
+        lats(numpy array): latitudes in decimal degrees
+        bbox(dict): north, south, east and west edges of the grid
+        cellsize(float): width and height of a cell in decimal degrees
+        weights(numpy array): amount each point adds to its cell, None to
+                              count the points
+
+    Returns:
+        grid(numpy array): total of each cell, the first row is the
+                           northern edge and the first column the western
+    """
+    nrows, ncols = grid_shape(bbox, cellsize)
+    cellids = cell_ids(lons, lats, bbox, cellsize)
+    inside = cellids >= 0
+    if weights is not None:
+        weights = weights[inside]
+    grid = np.bincount(
+        cellids[inside], weights=weights, minlength=nrows * ncols)
+    return grid.reshape(nrows, ncols)
+
+
+def grid_to_png(grid, outputfile, colormap=COLORMAP):
+    """
+    colour a grid into a PNG image
+
+    cells are coloured on a log scale so a few heavily bombed cells do not
+    wash out the rest, empty cells are transparent
+
+    Args:
+        grid(numpy array): total of each cell, from density_grid
+        outputfile(str): filename to save the image as
+        colormap(str): name of a matplotlib colormap
+    """
+    # matplotlib is only needed to colour and save the image
+    import matplotlib
+    import matplotlib.image
+    scaled = np.log1p(np.maximum(grid, 0))
+    if scaled.max() > 0:
+        scaled = scaled / scaled.max()
+    rgba = matplotlib.colormaps[colormap](scaled, bytes=True)
+    rgba[..., 3] = np.where(grid > 0, 96 + (159 * scaled), 0).astype(np.uint8)
+    matplotlib.image.imsave(outputfile, rgba)
+
+
+def add_density_overlays(kmlmap, outputdir, name, lons, lats, bbox,
+                         cellsizes=CELLSIZES, weights=None):
+    """
+    write a PNG for each cell size and add them to a map as ground overlays
+
+    each overlay is only shown while it has at most about two cells for
+    each pixel on screen, so the finer grids take over as you zoom in
+
+    Args:
+        kmlmap(kml.KMLOutputParser): the map to add the overlays to
+        outputdir(str): directory of the map, the PNGs are written to it
+        name(str): name of the overlays, also used for the PNG filenames
+        lons(numpy array): longitudes in decimal degrees
+        lats(numpy array): latitudes in decimal degrees
+        bbox(dict): north, south, east and west edges of the map
+        cellsizes(list): cell sizes in decimal degrees, coarsest first
+        weights(numpy array): amount each mission adds to its cell, None to
+                              count the missions
+
+    Returns:
+        pngfiles(list): filenames of the PNGs, relative to outputdir
+    """
+    safename = ''.join(
+        char if char.isalnum() else '_' for char in str(name))
+    pngfiles = []
+    minlodpixels = 0
+    for level, cellsize in enumerate(cellsizes):
+        grid = density_grid(lons, lats, bbox, cellsize, weights)
+        pngfile = '{}-{}.png'.format(safename, cellsize)
+        grid_to_png(grid, os.path.join(outputdir, pngfile))
+        pngfiles.append(pngfile)
+        maxlodpixels = -1
+        if level < len(cellsizes) - 1:
+            maxlodpixels = 2 * max(grid.shape)
+        kmlmap.add_ground_overlay(
+            '{} ({} degree cells)'.format(name, cellsize), pngfile,
+            minlodpixels=minlodpixels, maxlodpixels=maxlodpixels, **bbox)
+        minlodpixels = maxlodpixels
+    return pngfiles
+
+
+def create_density_map(outputdir, df, bbox=spatialindex.INDOCHINA,
+                       cellsizes=CELLSIZES, weights=None, splitby=None):
+    """
+    write a density map of a dataframe of missions
+
+    open doc.kml in the output directory in Google Earth
+
+    Args:
+        outputdir(str): directory to write doc.kml and the PNGs to
+        df(pandas dataframe): the missions to map, with co-ordinates
+        bbox(dict): north, south, east and west edges of the map
+        cellsizes(list): cell sizes in decimal degrees, coarsest first
+        weights(str): column to weight each mission by, e.g.
+                      'NUMWEAPONSDELIVERED', None to count the missions
+        splitby(str): column to make a separate map of each value of in
+                      its own folder, e.g. 'MFUNC_DESC', None for one map
+
+    Returns:
+        pngfiles(list): filenames of the PNGs, relative to outputdir
+    """
+    os.makedirs(outputdir, exist_ok=True)
+    lons = df['TGTLONDDD_DDD_WGS84'].to_numpy(dtype=float)
+    lats = df['TGTLATDD_DDD_WGS84'].to_numpy(dtype=float)
+    weightvalues = None
+    if weights is not None:
+        weightvalues = df[weights].fillna(0).to_numpy(dtype=float)
+    pngfiles = []
+    kmlfile = os.path.join(outputdir, 'doc.kml')
+    with kml.KMLOutputParser(kmlfile, stream=True) as kmlmap:
+        kmlmap.create_kml_header()
+        kmlmap.open_folder('Vietnam War Air Missions - THOR dataset density')
+        pngfiles += add_density_overlays(
+            kmlmap, outputdir, 'All missions', lons, lats, bbox, cellsizes,
+            weightvalues)
+        if splitby is not None:
+            groups = df.groupby(splitby, sort=True, observed=True).indices
+            for value, positions in groups.items():
+                print('creating density map for - {}'.format(value))
+                kmlmap.open_folder(str(value))
+                pngfiles += add_density_overlays(
+                    kmlmap, outputdir, value, lons[positions],
+                    lats[positions], bbox, cellsizes,
+                    None if weightvalues is None
+                    else weightvalues[positions])
+                kmlmap.close_folder()
+        kmlmap.close_folder()
+        kmlmap.close_kml_file()
+    return pngfiles
+
+
+def cell_period_totals(lons, lats, dates, bbox, cellsize, freq='W',
+                       weights=None):
+    """
+    total the missions in each grid cell for each day or week
+
+    every mission is keyed by its period and cell and the keys are counted
+    in one grouped pass, only cells and periods with missions are returned
+
+    Args:
+        lons(numpy array): longitudes in decimal degrees
+        lats(numpy array): latitudes in decimal degrees
+        dates(numpy array): datetime64 mission dates, missions outside bbox
+                            or with no date are left out
+        bbox(dict): north, south, east and west edges of the grid
+        cellsize(float): width and height of a cell in decimal degrees
+        freq(str): 'D' for daily or 'W' for weekly periods
+        weights(numpy array): amount each mission adds to its total, None
+                              to count the missions
+
+    Returns:
+        cellids(numpy array): cell of each total, see cell_ids
+        periodstarts(numpy array): datetime64[D] first day of the period of
+                                   each total
+        totals(numpy array): total of each cell and period, in date order
+    """
+    if freq not in PERIODS:
+        raise ValueError('unknown period {}, choose from {}'.format(
+            freq, ', '.join(PERIODS)))
+    periodlength, offset = PERIODS[freq]
+    nrows, ncols = grid_shape(bbox, cellsize)
+    days = dates.astype('datetime64[D]')
+    cells = cell_ids(lons, lats, bbox, cellsize)
+    keep = (cells >= 0) & ~np.isnat(days)
+    cells = cells[keep]
+    periods = (days[keep].astype(np.int64) + offset) // periodlength
+    keys = periods * (nrows * ncols) + cells
+    uniquekeys, inverse = np.unique(keys, return_inverse=True)
+    if weights is not None:
+        weights = weights[keep]
+    totals = np.bincount(inverse, weights=weights, minlength=len(uniquekeys))
+    periodstarts = (
+        (uniquekeys // (nrows * ncols)) * periodlength - offset).astype(
+            'datetime64[D]')
+    return uniquekeys % (nrows * ncols), periodstarts, totals
+
+
+def color_levels(totals, colormap=COLORMAP, levels=COLORLEVELS):
+    """
+    split totals into colour levels on a log scale
+
+    Args:
+        totals(numpy array): total of each cell and period
+        colormap(str): name of a matplotlib colormap
+        levels(int): number of colours
+
+    Returns:
+        levelids(numpy array): colour level of each total
+        colors(list): aabbggrr KML colour of each level
+    """
+    import matplotlib
+    scaled = np.log1p(np.maximum(totals, 0))
+    if len(scaled) and scaled.max() > 0:
+        scaled = scaled / scaled.max()
+    levelids = np.minimum((scaled * levels).astype(np.int64), levels - 1)
+    rgba = matplotlib.colormaps[colormap](
+        np.linspace(0.2, 1, levels), bytes=True)
+    colors = [
+        'c0{:02x}{:02x}{:02x}'.format(blue, green, red)
+        for red, green, blue, alpha in rgba]
+    return levelids, colors
+
+
+def create_animated_map(outputfile, df, bbox=spatialindex.INDOCHINA,
+                        cellsize=0.1, freq='W', weights=None,
+                        maxfeatures=250000, batchsize=50000):
+    """
+    write a map of the missions in each grid cell for each day or week
+
+    each cell and period with missions becomes one square coloured by its
+    total and only shown on the time slider during that period, so the
+    size of the map depends on the grid and the length of the war and not
+    on the number of missions
+    if there are still more than maxfeatures squares the smallest totals
+    are left out
+    the KML is streamed to disk, give the output file a .kmz extension to
+    write a compressed KMZ file instead
+
+    Args:
+        outputfile(str): path to write the kml or kmz file to
+        df(pandas dataframe): the missions to map, with co-ordinates and
+                              cleaned datetime MSNDATE
+        bbox(dict): north, south, east and west edges of the map
+        cellsize(float): width and height of a cell in decimal degrees
+        freq(str): 'D' for daily or 'W' for weekly periods
+        weights(str): column to weight each mission by, e.g.
+                      'NUMWEAPONSDELIVERED', None to count the missions
+        maxfeatures(int): most squares to draw
+        batchsize(int): number of squares to build at a time
+
+    Returns:
+        featurecount(int): number of squares drawn
+    """
+    weightvalues = None
+    if weights is not None:
+        weightvalues = df[weights].fillna(0).to_numpy(dtype=float)
+    cellids, periodstarts, totals = cell_period_totals(
+        df['TGTLONDDD_DDD_WGS84'].to_numpy(dtype=float),
+        df['TGTLATDD_DDD_WGS84'].to_numpy(dtype=float),
+        df['MSNDATE'].to_numpy(dtype='datetime64[ns]'), bbox, cellsize,
+        freq, weightvalues)
+    if len(totals) > maxfeatures:
+        print('leaving out the {} smallest of {} cells'.format(
+            len(totals) - maxfeatures, len(totals)))
+        keep = np.sort(np.argsort(-totals, kind='stable')[:maxfeatures])
+        cellids, periodstarts, totals = (
+            cellids[keep], periodstarts[keep], totals[keep])
+    levelids, colors = color_levels(totals)
+    # the corners of each cell are only formatted once
+    ncols = grid_shape(bbox, cellsize)[1]
+    usedcells, cellpositions = np.unique(cellids, return_inverse=True)
+    corners = []
+    for cellid in usedcells:
+        north = bbox['north'] - (cellid // ncols) * cellsize
+        west = bbox['west'] + (cellid % ncols) * cellsize
+        south = north - cellsize
+        east = west + cellsize
+        corners.append(' '.join(
+            '{:.4f},{:.4f},0'.format(lon, lat) for lon, lat in (
+                (west, north), (east, north), (east, south), (west, south),
+                (west, north))))
+    corners = np.array(corners, dtype=object)
+    periodlength = PERIODS[freq][0]
+    begins = np.datetime_as_string(periodstarts, unit='D')
+    ends = np.datetime_as_string(
+        periodstarts + np.timedelta64(periodlength, 'D'), unit='D')
+    if weights is None:
+        names = ['{:.0f} missions'.format(total) for total in totals]
+    else:
+        names = ['{:.0f} {}'.format(total, weights) for total in totals]
+    styleids = np.array(
+        ['level{}'.format(level) for level in range(len(colors))])
+    kmz = outputfile.lower().endswith('.kmz')
+    with kml.KMLOutputParser(outputfile, stream=True, kmz=kmz) as kmlmap:
+        kmlmap.create_kml_header()
+        for styleid, color in zip(styleids, colors):
+            kmlmap.add_style(styleid, color)
+        kmlmap.open_folder('Vietnam War Air Missions - THOR dataset timeline')
+        for start in range(0, len(totals), batchsize):
+            batch = slice(start, start + batchsize)
+            kmlmap.add_kml_polygons(
+                names[batch], styleids[levelids[batch]],
+                corners[cellpositions[batch]], begins[batch], ends[batch])
+        kmlmap.close_folder()
+        kmlmap.close_kml_file()
+    return len(totals)
+
+
+def main(weights=None, splitby=None, animate=None,
+         filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    load the co-ordinates of every mission
+    recover missing LAT LON co-ords from the original co-ords
+    remove missions with no LAT LON co-ords
+    create the density map of the whole war
+    create the animated map if asked for
+
+    Args:
+        weights(str): column to weight each mission by, e.g.
+                      'NUMWEAPONSDELIVERED', None to count the missions
+        splitby(str): column to split the map by, e.g. 'MFUNC_DESC'
+        animate(str): 'D' or 'W' to also write Animated Map.kmz with the
+                      missions in each cell for each day or week
+        filename(str): path to the dataset CSV file
+    """
+    columns = COORDS + ['TGTORIGCOORDS', 'TGTORIGCOORDSFORMAT'] + [
+        column for column in (weights, splitby) if column is not None]
+    if animate is not None:
+        columns.append('MSNDATE')
+    with instrument.stage('load') as timer:
+        df = dataset.load_dataset(filename, columns=columns)
+        timer.rowsout = len(df)
+    with instrument.stage('recover missing co-ords', rowsin=len(df)):
+        df, decoded = dataset.fill_missing_coords(df)
+        print('recovered missing co-ords from TGTORIGCOORDS {}'.format(
+            decoded))
+    with instrument.stage('drop missing co-ords', rowsin=len(df)) as timer:
+        df = df.dropna(subset=COORDS)
+        timer.rowsout = len(df)
+    print('creating density map of {} missions'.format(len(df)))
+    with instrument.stage('write density map', rowsin=len(df)):
+        pngfiles = create_density_map(
+            'Density Map', df, weights=weights, splitby=splitby)
+    print('wrote {} images to Density Map/doc.kml'.format(len(pngfiles)))
+    if animate is None:
+        return
+    with instrument.stage('clean dates', rowsin=len(df)) as timer:
+        df['MSNDATE'], invalid, rejected = dataset.clean_dates(
+            df['MSNDATE'])
+        print('removing {} missions with invalid dates {}'.format(
+            invalid.sum(), rejected))
+        df = df[~invalid]
+        timer.rowsout = len(df)
+    with instrument.stage('write animated map', rowsin=len(df)) as timer:
+        featurecount = create_animated_map(
+            'Animated Map.kmz', df, freq=animate, weights=weights)
+        timer.rowsout = featurecount
+    print('wrote {} cells to Animated Map.kmz'.format(featurecount))
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
@@ -0,0 +1,442 @@
+"""
+export subsets of the Vietnam War THOR dataset
+
+small tables are written straight to one file a chunk of rows at a time,
+instead of being rendered to one string first
+large subsets are exported to a directory, split by the values of keys such
+as year, COUNTRYFLYINGMISSION or TGTCOUNTRY into one directory per
+partition, key=value as pyarrow and spark expect
+every chunk of rows is written to its own part file in each partition in a
+process pool, as plain, gzip or zstd compressed CSV or as Parquet, and
+every file is listed with its partition and row count in _manifest.json,
+which pyarrow and spark skip when reading the directory
+export_dataset streams the rows from the columnar cache so the whole
+dataset is never in memory, e.g.
+
+    python export.py "US missions" --partitionby year TGTCOUNTRY \\
+        --where "COUNTRYFLYINGMISSION=UNITED STATES OF AMERICA" --format csv.gz
+"""
+
+
+import argparse
+import concurrent.futures
+import importlib
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import cube
+import dataset
+import instrument
+
+
+FORMATS = {
+    'csv': {'extension': '.csv', 'compression': None, 'requires': None},
+    'csv.gz': {
+        'extension': '.csv.gz',
+        'compression': {'method': 'gzip', 'mtime': 0, 'compresslevel': 6},
+        'requires': None},
+    'csv.zst': {
+        'extension': '.csv.zst', 'compression': {'method': 'zstd'},
+        'requires': 'zstandard'},
+    'parquet': {
+        'extension': '.parquet', 'compression': 'zstd',
+        'requires': 'pyarrow'}}
+
+MANIFEST = '_manifest.json'
+
+# directory name of the partition of missing values, pyarrow cannot read a
+# partition key with missing values back into pandas yet
+MISSING_PARTITION = 'missing'
+
+CHUNKSIZE = 100000
+
+
+def check_format(fileformat):
+    """
+    make sure we know how to write a format and the package it needs is
+    installed
+
+    Args:
+        fileformat(str): one of FORMATS
+
+    Raises:
+        ValueError: if the format is not in FORMATS
+        ImportError: if the package the format needs is not installed
+    """
+    if fileformat not in FORMATS:
+        raise ValueError('unknown format {}, choose from {}'.format(
+            fileformat, ', '.join(FORMATS)))
+    requires = FORMATS[fileformat]['requires']
+    if requires is not None:
+        try:
+            importlib.import_module(requires)
+        except ImportError:
+            raise ImportError('writing {} files needs the {} package'.format(
+                fileformat, requires))
+
+
+def write_table(df, filename, fileformat='csv', index=True,
+                chunksize=CHUNKSIZE):
+    """
+    write a dataframe or series to one file a chunk of rows at a time
+
+    gzip files have no timestamp so the same rows give the same bytes
+
+    Args:
+        df(pandas dataframe or series): the rows to write, a series is
+                                        written with its name as the header
+        filename(str): path of the file to write
+        fileformat(str): one of FORMATS
+        index(bool): write the index as the first column
+        chunksize(int): number of rows to write at a time
+    """
+    check_format(fileformat)
+    compression = FORMATS[fileformat]['compression']
+    if fileformat == 'parquet':
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        df.to_parquet(
+            filename, compression=compression, index=index,
+            row_group_size=chunksize)
+        return
+    df.to_csv(
+        filename, header=True, index=index, compression=compression,
+        chunksize=chunksize)
+
+
+def mission_years(dates):
+    """
+    the year of each mission date
+
+    works for datetime64 dates and for the raw YYYYMMDD or cleaned
+    YYYY-MM-DD dates, missing dates are left missing
+
+    Args:
+        dates(pandas series): the mission dates
+
+    Returns:
+        years(pandas series): the year of each date
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates.dtype):
+        return dates.dt.year.rename('year')
+    years = dates.astype('str').str[:4]
+    return years.where(dates.notna()).rename('year')
+
+
+def partition_rows(df, partitionby):
+    """
+    split rows into partitions by the values of some keys
+
+    Args:
+        df(pandas dataframe): the rows
+        partitionby(list): columns to partition by, 'year' is the year of
+                           MSNDATE
+
+    Returns:
+        partitions(dict): keys are tuples of the value of each key, values
+                          are numpy arrays of row positions
+    """
+    if not partitionby:
+        return {(): np.arange(len(df))}
+    keys = [
+        mission_years(df['MSNDATE']) if key == 'year' else df[key]
+        for key in partitionby]
+    grouped = df.groupby(keys, observed=True, dropna=False, sort=True)
+    return {
+        label if isinstance(label, tuple) else (label,): positions
+        for label, positions in grouped.indices.items()}
+
+
+def partition_dir(partitionby, label):
+    """
+    relative directory of a partition, one level of key=value per key
+
+    characters that are not safe in a filename are replaced with _ and
+    missing values go in MISSING_PARTITION
+
+    Args:
+        partitionby(list): the keys
+        label(tuple): the value of each key
+
+    Returns:
+        directory(str): the directory, '' when not partitioned
+    """
+    parts = []
+    for key, value in zip(partitionby, label):
+        if pd.isna(value):
+            value = MISSING_PARTITION
+        else:
+            value = re.sub(r'[^\w .()+-]', '_', str(value)).strip() or '_'
+        parts.append('{}={}'.format(key, value))
+    return os.path.join(*parts) if parts else ''
+
+
+def write_chunk(chunk, chunkno, outputdir, partitionby, fileformat, index):
+    """
+    write each partition of a chunk of rows to its own part file, called
+    in a worker process
+
+    Parquet part files leave out the partition columns, CSV files keep them
+
+    Args:
+        chunk(pandas dataframe): the rows
+        chunkno(int): number of the chunk, used for the part filenames
+        outputdir(str): the export directory
+        partitionby(list): columns to partition by
+        fileformat(str): one of FORMATS
+        index(bool): write the index as the first column
+
+    Returns:
+        files(list): a dict for each file written with its path relative to
+                     outputdir, the value of each key, rows and bytes
+    """
+    files = []
+    extension = FORMATS[fileformat]['extension']
+    partitions = partition_rows(chunk, partitionby)
+    if fileformat == 'parquet':
+        # parquet readers take the partition columns from the directories
+        chunk = chunk.drop(columns=partitionby, errors='ignore')
+    for label, positions in partitions.items():
+        directory = partition_dir(partitionby, label)
+        os.makedirs(os.path.join(outputdir, directory), exist_ok=True)
+        path = os.path.join(
+            directory, 'part-{:05d}{}'.format(chunkno, extension))
+        fullpath = os.path.join(outputdir, path)
+        write_table(
+            chunk.iloc[positions], fullpath, fileformat, index,
+            chunksize=len(positions) or 1)
+        files.append({
+            'path': path.replace(os.sep, '/'),
+            'partition': {
+                key: None if pd.isna(value) else str(value)
+                for key, value in zip(partitionby, label)},
+            'rows': len(positions),
+            'bytes': os.path.getsize(fullpath)})
+    return files
+
+
+def prepare_outputdir(outputdir):
+    """
+    make an empty hidden directory next to the export directory to write
+    the export into, so a failed export never leaves part files behind
+
+    Args:
+        outputdir(str): the export directory
+
+    Returns:
+        partialdir(str): the directory to write the export into
+
+    Raises:
+        ValueError: if the directory exists and is not an earlier export
+    """
+    if os.path.exists(outputdir) and not os.path.exists(
+            os.path.join(outputdir, MANIFEST)):
+        raise ValueError(
+            '{} exists and is not an earlier export'.format(outputdir))
+    parent, name = os.path.split(os.path.normpath(os.path.abspath(outputdir)))
+    partialdir = os.path.join(parent, '.{}.partial'.format(name))
+    # left behind if an earlier export was killed
+    shutil.rmtree(partialdir, ignore_errors=True)
+    os.makedirs(partialdir)
+    return partialdir
+
+
+def finish_outputdir(partialdir, outputdir):
+    """
+    replace an earlier export with a finished one, so its part files do not
+    mix with the new ones
+
+    Args:
+        partialdir(str): the directory the export was written into
+        outputdir(str): the export directory
+    """
+    if os.path.exists(outputdir):
+        shutil.rmtree(outputdir)
+    os.replace(partialdir, outputdir)
+
+
+def write_chunks(chunks, outputdir, partitionby=None, fileformat='csv',
+                 index=True, workers=None):
+    """
+    write chunks of rows to an export directory in parallel and write the
+    manifest
+
+    no more than one chunk per worker is waiting to be written at once
+    the export only replaces the directory once every file and the
+    manifest are written, an export that fails leaves it as it was
+
+    Args:
+        chunks(iterable): pandas dataframes of rows
+        outputdir(str): the export directory
+        partitionby(list): columns to partition by, 'year' is the year of
+                           MSNDATE
+        fileformat(str): one of FORMATS
+        index(bool): write the index as the first column
+        workers(int): number of processes, defaults to the number of cores,
+                      1 writes in this process
+
+    Returns:
+        manifest(dict): the format, partition keys, total rows and the
+                        files written
+    """
+    check_format(fileformat)
+    partitionby = list(partitionby or [])
+    if workers is None:
+        workers = os.cpu_count() or 1
+    partialdir = prepare_outputdir(outputdir)
+    files = []
+    args = (partialdir, partitionby, fileformat, index)
+    try:
+        if workers == 1:
+            for chunkno, chunk in enumerate(chunks):
+                files += write_chunk(chunk, chunkno, *args)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+                pending = set()
+                for chunkno, chunk in enumerate(chunks):
+                    if len(pending) >= workers:
+                        done, pending = concurrent.futures.wait(
+                            pending,
+                            return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            files += future.result()
+                    pending.add(
+                        pool.submit(write_chunk, chunk, chunkno, *args))
+                for future in concurrent.futures.as_completed(pending):
+                    files += future.result()
+        files.sort(key=lambda record: record['path'])
+        manifest = {
+            'format': fileformat,
+            'partitionby': partitionby,
+            'rows': sum(record['rows'] for record in files),
+            'files': files}
+        with open(os.path.join(partialdir, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    except BaseException:
+        shutil.rmtree(partialdir, ignore_errors=True)
+        raise
+    finish_outputdir(partialdir, outputdir)
+    return manifest
+
+
+def export_subset(df, outputdir, partitionby=None, fileformat='csv',
+                  index=True, chunksize=CHUNKSIZE, workers=None):
+    """
+    export rows already in memory to a partitioned directory
+
+    Args:
+        df(pandas dataframe): the rows
+        outputdir(str): the export directory
+        partitionby(list): columns to partition by, 'year' is the year of
+                           MSNDATE
+        fileformat(str): one of FORMATS
+        index(bool): write the index as the first column
+        chunksize(int): number of rows in each part file at most
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        manifest(dict): see write_chunks
+    """
+    chunks = (
+        df.iloc[start:start + chunksize]
+        for start in range(0, len(df), chunksize))
+    return write_chunks(
+        chunks, outputdir, partitionby, fileformat, index, workers)
+
+
+def export_dataset(filename, outputdir, where=None, partitionby=None,
+                   fileformat='csv', columns=None, chunksize=CHUNKSIZE,
+                   workers=None):
+    """
+    export the rows of the dataset matching some values to a partitioned
+    directory, streamed from the columnar cache a chunk at a time
+
+    Args:
+        filename(str): path to the dataset CSV file
+        outputdir(str): the export directory
+        where(dict): keys are columns, values are a value or a list of
+                     values to keep, None keeps every row
+        partitionby(list): columns to partition by, 'year' is the year of
+                           MSNDATE
+        fileformat(str): one of FORMATS
+        columns(list): columns to export, the where and partitionby
+                       columns are added, None exports them all
+        chunksize(int): number of rows to read at a time
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        manifest(dict): see write_chunks
+    """
+    if columns is not None:
+        keys = [
+            'MSNDATE' if key == 'year' else key
+            for key in list(where or {}) + list(partitionby or [])]
+        columns = list(dict.fromkeys(list(columns) + keys))
+    chunks = dataset.iter_dataset(filename, columns, chunksize)
+    if where:
+        chunks = (cube.slice_cube(chunk, where) for chunk in chunks)
+    return write_chunks(
+        (chunk for chunk in chunks if len(chunk)), outputdir, partitionby,
+        fileformat, False, workers)
+
+
+def parse_where(conditions):
+    """
+    read row filters given as COLUMN=VALUE
+
+    a column given more than once keeps rows matching any of its values
+
+    Args:
+        conditions(list): the filters from the command line
+
+    Returns:
+        where(dict): keys are columns, values are lists of values to keep
+    """
+    where = {}
+    for condition in conditions or []:
+        column, equals, value = condition.partition('=')
+        if not equals:
+            raise ValueError(
+                'filters look like COLUMN=VALUE, not {}'.format(condition))
+        where.setdefault(column, []).append(value)
+    return where
+
+
+def main(argv=None):
+    """
+    main program code
+
+    Args:
+        argv(list): command line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(
+        description='export a subset of the THOR dataset')
+    parser.add_argument('outputdir', help='directory to export to')
+    parser.add_argument('--input', default='thor_data_vietnam.csv')
+    parser.add_argument(
+        '--where', action='append', metavar='COLUMN=VALUE',
+        help='only export rows with this value, e.g. TGTCOUNTRY=LAOS')
+    parser.add_argument(
+        '--partitionby', nargs='*', default=[],
+        help="columns to partition by, 'year' for the year of MSNDATE")
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--columns', nargs='*', default=None)
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    with instrument.stage('export'):
+        manifest = export_dataset(
+            args.input, args.outputdir, parse_where(args.where),
+            args.partitionby, args.format, args.columns, args.chunksize,
+            args.workers)
+    print('exported {} rows to {} files in {}'.format(
+        manifest['rows'], len(manifest['files']), args.outputdir))
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
@@ -0,0 +1,220 @@
+"""
+extract named operations from the Vietnam THOR dataset
+
+operations are defined in operations.json, each with any of:
+    dates - first and last mission date, inclusive
+    countries - values of COUNTRYFLYINGMISSION
+    services - values of MILSERVICE
+    missiontypes - values of MFUNC_DESC
+    bbox - north, south, east and west edges of the target area
+    kml - false to only write the CSV
+    format - 'csv', 'csv.gz', 'csv.zst' or 'parquet', defaults to 'csv'
+    partitionby - columns to split the missions by, 'year' for the year of
+                  the mission date, into a directory instead of one file
+
+every operation is matched in one pass over the dataset and the CSV and KML
+files of each operation are written in parallel
+"""
+
+
+import concurrent.futures
+import json
+
+import numpy as np
+import pandas as pd
+
+import dataset
+import export
+import instrument
+import operationsmap
+import spatialindex
+
+
+CRITERIA = {
+    'countries': 'COUNTRYFLYINGMISSION',
+    'services': 'MILSERVICE',
+    'missiontypes': 'MFUNC_DESC'}
+
+SETTINGS = ['dates', 'bbox', 'kml', 'format', 'partitionby'] + list(CRITERIA)
+
+
+def load_operations(configfile):
+    """
+    read the operation definitions
+
+    Args:
+        configfile(str): path to the JSON file of operations
+
+    Returns:
+        operations(dict): keys are operation names, values are dicts of
+                          the criteria for that operation
+
+    Raises:
+        ValueError: if an operation has a setting or format we don't know
+                    about
+    """
+    with open(configfile, 'r') as f:
+        operations = json.load(f)
+    for name, spec in operations.items():
+        for setting in spec:
+            if setting not in SETTINGS:
+                raise ValueError(
+                    'unknown setting {} for operation {}'.format(
+                        setting, name))
+        export.check_format(spec.get('format', 'csv'))
+    return operations
+
+
+def assign_operations(df, dates, operations):
+    """
+    work out which operations every mission belongs to
+
+    each categorical column is turned into codes once and each operation
+    checks its values with a lookup table over those codes, the target
+    area is found with the spatial index
+
+    Args:
+        df(pandas dataframe): the missions
+        dates(pandas series): datetime64 date of each mission
+        operations(dict): from load_operations
+
+    Returns:
+        membership(numpy array): boolean, one row per mission and one
+                                 column per operation
+    """
+    membership = np.ones((len(df), len(operations)), dtype=bool)
+    datevalues = dates.to_numpy(dtype='datetime64[ns]')
+    columncodes = {}
+    index = None
+    for opno, spec in enumerate(operations.values()):
+        mask = membership[:, opno]
+        if 'dates' in spec:
+            first, last = (np.datetime64(date, 'ns') for date in spec['dates'])
+            mask &= (datevalues >= first) & (datevalues <= last)
+        for setting, column in CRITERIA.items():
+            if setting not in spec:
+                continue
+            if column not in columncodes:
+                categorical = df[column].astype('category')
+                columncodes[column] = (
+                    categorical.cat.codes.to_numpy(),
+                    categorical.cat.categories)
+            codes, categories = columncodes[column]
+            # missing values have code -1 and pick the False on the end
+            lookup = np.append(np.isin(categories, spec[setting]), False)
+            mask &= lookup[codes]
+        if 'bbox' in spec:
+            if index is None:
+                index = spatialindex.SpatialIndex.from_dataframe(df)
+            inbox = np.zeros(len(df), dtype=bool)
+            inbox[index.query_bbox(**spec['bbox'])] = True
+            mask &= inbox
+    return membership
+
+
+def write_operation(name, missions, writekml=True, fileformat='csv',
+                    partitionby=None):
+    """
+    write the CSV and KML map of an operation
+
+    Args:
+        name(str): name of the operation, used for the filenames
+        missions(pandas dataframe): the missions in the operation
+        writekml(bool): also write the KML map
+        fileformat(str): one of export.FORMATS
+        partitionby(list): columns to split the missions by into the
+                           directory name, None writes one file
+
+    Returns:
+        name(str): name of the operation
+        count(int): number of missions written
+    """
+    if partitionby:
+        # operations are already written in parallel
+        export.export_subset(
+            missions, name, partitionby, fileformat, workers=1)
+    else:
+        export.write_table(
+            missions, name + export.FORMATS[fileformat]['extension'],
+            fileformat)
+    if writekml:
+        missiontypesorganised = operationsmap.split_by_mission_type(missions)
+        operationsmap.create_map(name + '.kml', missiontypesorganised)
+    return name, len(missions)
+
+
+def extract_operations(df, dates, operations, workers=None):
+    """
+    write every operation in parallel
+
+    Args:
+        df(pandas dataframe): the missions
+        dates(pandas series): datetime64 date of each mission
+        operations(dict): from load_operations
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        counts(dict): keys are operation names, values are the number of
+                      missions in each
+    """
+    membership = assign_operations(df, dates, operations)
+    counts = {}
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = []
+        for opno, (name, spec) in enumerate(operations.items()):
+            missions = df.iloc[np.flatnonzero(membership[:, opno])]
+            futures.append(pool.submit(
+                write_operation, name, missions, spec.get('kml', True),
+                spec.get('format', 'csv'), spec.get('partitionby')))
+        for future in concurrent.futures.as_completed(futures):
+            name, count = future.result()
+            print('wrote {} missions for {}'.format(count, name))
+            counts[name] = count
+    return counts
+
+
+def main(filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    load dataset
+    clean the mission dates
+    recover missing LAT LON co-ords from the original co-ords
+    remove missions with no LAT LON co-ords
+    extract every operation in operations.json
+
+    Args:
+        filename(str): path to the dataset CSV file
+    """
+    operations = load_operations('operations.json')
+    with instrument.stage('load') as timer:
+        df = dataset.load_dataset(filename)
+        timer.rowsout = len(df)
+    with instrument.stage('clean dates', rowsin=len(df)) as timer:
+        dates, invalid, rejected = dataset.clean_dates(df['MSNDATE'])
+        print('removing {} missions with invalid dates {}'.format(
+            invalid.sum(), rejected))
+        df = df[~invalid]
+        dates = dates[~invalid]
+        # only the few thousand distinct dates are formatted as yyyy-mm-dd
+        codes, uniquedates = pd.factorize(dates)
+        df['MSNDATE'] = pd.DatetimeIndex(uniquedates).strftime(
+            '%Y-%m-%d').to_numpy(dtype=object)[codes]
+        timer.rowsout = len(df)
+    with instrument.stage('recover missing co-ords', rowsin=len(df)):
+        df, decoded = dataset.fill_missing_coords(df)
+        print('recovered missing co-ords from TGTORIGCOORDS {}'.format(
+            decoded))
+    with instrument.stage('drop missing co-ords', rowsin=len(df)) as timer:
+        hascoords = (
+            df['TGTLATDD_DDD_WGS84'].notna() &
+            df['TGTLONDDD_DDD_WGS84'].notna())
+        df = df[hascoords]
+        dates = dates[hascoords]
+        timer.rowsout = len(df)
+    with instrument.stage('extract operations', rowsin=len(df)):
+        extract_operations(df, dates, operations)
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
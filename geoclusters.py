@@ -1,57 +1,195 @@
 """
 attempt K-means clustering on our GEO LAT LON mission data
 
+or DBSCAN clustering, which finds clusters of any shape that follow the
+target areas, on the unique target co-ordinates weighted by their number
+of missions
+
 Vietnam THOR dataset
 
 Thomas W Whittam
 """
 
 
-import pandas as pd
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
+import concurrent.futures
+
+import numpy as np
 
+import dataset
+import instrument
 import kml
+import spatialindex
+
+
+COORDS = ['TGTLATDD_DDD_WGS84', 'TGTLONDDD_DDD_WGS84']
+
+_ELBOW_COORDS = None
+
+
+def make_kmeans(nclusters, minibatch=False, seed=None):
+    """
+    create a K-means model
+
+    Args:
+        nclusters(int): number of clusters
+        minibatch(bool): use mini-batch K-means, much faster on millions of
+                         points for a small loss of accuracy
+        seed(int): random state for repeatable results
+
+    Returns:
+        model(sklearn estimator): the unfitted model
+    """
+    # sklearn takes longer to import than the rest of the script put
+    # together, so it is only loaded once we cluster
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    if minibatch:
+        return MiniBatchKMeans(
+            n_clusters=nclusters, init='k-means++', batch_size=4096,
+            n_init=3, random_state=seed)
+    return KMeans(n_clusters=nclusters, init='k-means++', random_state=seed)
+
+
+def sample_coords(df, samplesize=None, seed=None):
+    """
+    get the LAT LON pairs of the missions, optionally a random sample
+
+    Args:
+        df(pandas dataframe): missions with co-ordinates
+        samplesize(int): maximum number of points, None for all of them
+        seed(int): random state for repeatable results
+
+    Returns:
+        coords(numpy array): one row of latitude, longitude per point
+    """
+    coords = df[COORDS].to_numpy(dtype=float)
+    if samplesize is not None and len(coords) > samplesize:
+        rng = np.random.default_rng(seed)
+        coords = coords[rng.choice(len(coords), samplesize, replace=False)]
+    return coords
+
+
+def _init_elbow_worker(coords):
+    """
+    keep the co-ordinates in each worker process so they are only
+    sent once rather than once for every K
+    """
+    global _ELBOW_COORDS
+    _ELBOW_COORDS = coords
+
+
+def evaluate_k(nclusters, minibatch=False, silhouettesize=10000, seed=None):
+    """
+    fit K-means once for one number of clusters and score it
 
+    Args:
+        nclusters(int): number of clusters
+        minibatch(bool): use mini-batch K-means
+        silhouettesize(int): number of points to compute the silhouette
+                             score on, 0 to skip it
+        seed(int): random state for repeatable results
 
-def plot_elbow_curve(df):
+    Returns:
+        nclusters(int): number of clusters
+        score(float): the K-means score (negative inertia)
+        silhouette(float): the silhouette score, NaN if not computed
+    """
+    from sklearn.metrics import silhouette_score
+    coords = _ELBOW_COORDS
+    model = make_kmeans(nclusters, minibatch, seed)
+    model.fit(coords)
+    score = -model.inertia_
+    silhouette = float('nan')
+    if silhouettesize and nclusters > 1:
+        silhouette = silhouette_score(
+            coords, model.labels_,
+            sample_size=min(silhouettesize, len(coords)), random_state=seed)
+    return nclusters, score, silhouette
+
+
+def plot_elbow_curve(df, samplesize=200000, minibatch=True,
+                     silhouettesize=10000, workers=None, seed=0):
     """
     plot an elbow curve to find the optimal number of clusters
+
+    each K is fitted once on the LAT LON pairs, the values of K are
+    evaluated in parallel in a process pool
+
+    Args:
+        df(pandas dataframe): missions with co-ordinates
+        samplesize(int): cluster a random sample of this many points,
+                         None for all of them
+        minibatch(bool): use mini-batch K-means
+        silhouettesize(int): number of points to compute the silhouette
+                             score on, 0 to skip it
+        workers(int): number of processes, defaults to the number of cores
+        seed(int): random state for repeatable results
     """
+    import matplotlib.pyplot as plt
     K_clusters = range(1, 10)
-    kmeans = [KMeans(n_clusters=i) for i in K_clusters]
-    Y_axis = df[["TGTLATDD_DDD_WGS84"]]
-    X_axis = df[["TGTLONDDD_DDD_WGS84"]]
-    score = [kmeans[i].fit(Y_axis).score(Y_axis) for i in range(len(kmeans))]
-    plt.plot(K_clusters, score)
-    plt.xlabel('Number of Clusters')
-    plt.ylabel('Score')
-    plt.title('Elbow Curve')
-    plt.savefig('elbow-curve.png')
-    plt.clf()
+    coords = sample_coords(df, samplesize, seed)
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_elbow_worker,
+            initargs=(coords,)) as pool:
+        futures = [
+            pool.submit(evaluate_k, k, minibatch, silhouettesize, seed)
+            for k in K_clusters]
+        results = sorted(future.result() for future in futures)
+    score = [result[1] for result in results]
+    silhouette = [result[2] for result in results]
+    fig, ax = plt.subplots()
+    ax.plot(K_clusters, score)
+    ax.set_xlabel('Number of Clusters')
+    ax.set_ylabel('Score')
+    ax.set_title('Elbow Curve')
+    fig.savefig('elbow-curve.png')
+    plt.close(fig)
+    if silhouettesize:
+        fig, ax = plt.subplots()
+        ax.plot(K_clusters, silhouette)
+        ax.set_xlabel('Number of Clusters')
+        ax.set_ylabel('Silhouette Score')
+        ax.set_title('Silhouette Curve')
+        fig.savefig('silhouette-curve.png')
+        plt.close(fig)
 
 
-def kmeans(df):
+def kmeans(df, nclusters=4, samplesize=None, minibatch=False, seed=None):
     """
     cluster the data points
 
     plot clusters on a chart
     plot clusters centers to KML
+
+    the model is fitted once, on a random sample if samplesize is given,
+    and every mission is then labelled with a single predict
+
+    Args:
+        df(pandas dataframe): missions with co-ordinates
+        nclusters(int): number of clusters
+        samplesize(int): fit on a random sample of this many points,
+                         None to fit on all of them
+        minibatch(bool): use mini-batch K-means
+        seed(int): random state for repeatable results
     """
-    X = df.loc[
-        :, ['THOR_DATA_VIET_ID', "TGTLATDD_DDD_WGS84", "TGTLONDDD_DDD_WGS84"]]
-    kmeans = KMeans(n_clusters=4, init='k-means++')
-    kmeans.fit(X[X.columns[1:3]])
-    X['cluster_label'] = kmeans.fit_predict(X[X.columns[1:3]])
-    centers = kmeans.cluster_centers_
-    labels = kmeans.predict(X[X.columns[1:3]])
-    plt.figure(figsize=(25, 25))
-    plt.scatter(
+    import matplotlib.pyplot as plt
+    X = df.loc[:, ['THOR_DATA_VIET_ID'] + COORDS]
+    model = make_kmeans(nclusters, minibatch, seed)
+    coords = X[COORDS].to_numpy(dtype=float)
+    if samplesize is not None and len(coords) > samplesize:
+        model.fit(sample_coords(X, samplesize, seed))
+        labels = model.predict(coords)
+    else:
+        model.fit(coords)
+        labels = model.labels_
+    X['cluster_label'] = labels
+    centers = model.cluster_centers_
+    fig, ax = plt.subplots(figsize=(25, 25))
+    ax.scatter(
         x=X['TGTLONDDD_DDD_WGS84'], y=X['TGTLATDD_DDD_WGS84'], c=labels)
-    plt.scatter(centers[:, 1], centers[:, 0], c='black', s=200, alpha=0.5)
-    plt.title('K-means Clustered')
-    plt.savefig('Kmeans.png')
-    plt.clf()
+    ax.scatter(centers[:, 1], centers[:, 0], c='black', s=200, alpha=0.5)
+    ax.set_title('K-means Clustered')
+    fig.savefig('Kmeans.png')
+    plt.close(fig)
     print(centers)
     print(type(centers))
     print('plotting cluster centers to KML map')
@@ -70,31 +208,198 @@ def kmeans(df):
     kmlmap.write_kml_doc_file()
 
 
-def main():
+def unique_coords(df):
+    """
+    collapse missions to their unique target co-ordinates
+
+    many missions share exactly the same target, so this is far fewer
+    points to cluster
+
+    Args:
+        df(pandas dataframe): missions with co-ordinates
+
+    Returns:
+        coords(numpy array): unique LAT LON pairs, one row each
+        counts(numpy array): number of missions at each pair
+    """
+    coords, counts = np.unique(
+        df[COORDS].to_numpy(dtype=float), axis=0, return_counts=True)
+    return coords, counts
+
+
+def cluster_summary(coords, counts, labels):
+    """
+    describe each cluster
+
+    Args:
+        coords(numpy array): unique LAT LON pairs
+        counts(numpy array): number of missions at each pair
+        labels(numpy array): cluster of each pair, -1 for noise
+
+    Returns:
+        clusters(dict): keys are cluster labels, values are dicts of the
+                        mission weighted centroid 'lat' and 'lon', the
+                        'north', 'south', 'east' and 'west' extent, the
+                        number of 'missions' and of unique 'targets'
+    """
+    inclusters = labels >= 0
+    labels = labels[inclusters]
+    coords = coords[inclusters]
+    counts = counts[inclusters]
+    nclusters = labels.max() + 1 if len(labels) else 0
+    missions = np.bincount(labels, weights=counts, minlength=nclusters)
+    targets = np.bincount(labels, minlength=nclusters)
+    lats = np.bincount(labels, weights=coords[:, 0] * counts,
+                       minlength=nclusters) / missions
+    lons = np.bincount(labels, weights=coords[:, 1] * counts,
+                       minlength=nclusters) / missions
+    north = np.full(nclusters, -np.inf)
+    south = np.full(nclusters, np.inf)
+    east = np.full(nclusters, -np.inf)
+    west = np.full(nclusters, np.inf)
+    np.maximum.at(north, labels, coords[:, 0])
+    np.minimum.at(south, labels, coords[:, 0])
+    np.maximum.at(east, labels, coords[:, 1])
+    np.minimum.at(west, labels, coords[:, 1])
+    clusters = {}
+    for label in range(nclusters):
+        clusters[label] = {
+            'lat': lats[label], 'lon': lons[label],
+            'north': north[label], 'south': south[label],
+            'east': east[label], 'west': west[label],
+            'missions': int(missions[label]), 'targets': int(targets[label])}
+    return clusters
+
+
+def write_cluster_kml(outputfile, clusters):
+    """
+    map each cluster as a placemark at its centroid and a box of its extent
+
+    Args:
+        outputfile(str): path to write the KML file to
+        clusters(dict): from cluster_summary
+    """
+    kmlmap = kml.KMLOutputParser(outputfile)
+    kmlmap.create_kml_header()
+    kmlmap.add_style('extent', '40ffffff')
+    kmlmap.open_folder('Cluster centroids')
+    for label, cluster in clusters.items():
+        description = kmlmap.format_kml_placemark_description({
+            'missions': cluster['missions'],
+            'unique targets': cluster['targets'],
+            'extent': {
+                edge: round(cluster[edge], 6)
+                for edge in ('north', 'south', 'east', 'west')}})
+        kmlmap.add_kml_placemark(
+            'cluster {} - {} missions'.format(label + 1, cluster['missions']),
+            description, str(cluster['lon']), str(cluster['lat']),
+            altitude='0')
+    kmlmap.close_folder()
+    kmlmap.open_folder('Cluster extents')
+    corners = []
+    for cluster in clusters.values():
+        corners.append(' '.join(
+            '{},{},0'.format(cluster[lon], cluster[lat]) for lon, lat in (
+                ('west', 'north'), ('east', 'north'), ('east', 'south'),
+                ('west', 'south'), ('west', 'north'))))
+    kmlmap.add_kml_polygons(
+        ['cluster {}'.format(label + 1) for label in clusters],
+        ['extent'] * len(clusters), corners)
+    kmlmap.close_folder()
+    kmlmap.close_kml_file()
+    kmlmap.write_kml_doc_file()
+
+
+def dbscan(df, epskm=3.0, minmissions=100):
+    """
+    cluster the missions with DBSCAN on their unique target co-ordinates
+
+    the missions are collapsed to unique LAT LON pairs weighted by their
+    number of missions, neighbours are found within epskm on the earth's
+    surface with a haversine ball tree, a pair is the core of a cluster
+    when at least minmissions missions are within epskm of it
+
+    plot clusters on a chart
+    plot cluster centroids and extents to KML
+
+    Args:
+        df(pandas dataframe): missions with co-ordinates
+        epskm(float): neighbourhood radius in kilometres
+        minmissions(int): missions needed within epskm of a core point
+
+    Returns:
+        clusters(dict): from cluster_summary
+    """
+    from sklearn.cluster import DBSCAN
+    import matplotlib.pyplot as plt
+    coords, counts = unique_coords(df)
+    print('clustering {} missions at {} unique targets'.format(
+        int(counts.sum()), len(coords)))
+    model = DBSCAN(
+        eps=epskm / spatialindex.EARTH_RADIUS_KM, min_samples=minmissions,
+        metric='haversine', algorithm='ball_tree')
+    labels = model.fit_predict(np.radians(coords), sample_weight=counts)
+    clusters = cluster_summary(coords, counts, labels)
+    noise = int(counts[labels < 0].sum())
+    print('found {} clusters, {} missions are not in a cluster'.format(
+        len(clusters), noise))
+    fig, ax = plt.subplots(figsize=(25, 25))
+    ax.scatter(coords[labels < 0, 1], coords[labels < 0, 0], c='lightgrey',
+               s=1)
+    ax.scatter(coords[labels >= 0, 1], coords[labels >= 0, 0],
+               c=labels[labels >= 0], cmap='tab20', s=2)
+    ax.set_title('DBSCAN Clustered')
+    fig.savefig('DBSCAN.png')
+    plt.close(fig)
+    print('plotting cluster centroids and extents to KML map')
+    write_cluster_kml('dbscan-clusters.kml', clusters)
+    return clusters
+
+
+def main(engine='kmeans', filename='thor_data_vietnam.csv'):
     """
     main program code
 
     load dataset
+    recover missing LAT LON co-ords from the original co-ords
     remove missions with no LAT LON co-ords
     filter to missions in the Indochina region
-    #plot elbow curve
-    cluster the data!
-    """
-    filename = 'thor_data_vietnam.csv'
-    df = pd.read_csv(filename)
-    df["TGTLONDDD_DDD_WGS84"].fillna('NO CO-ORDS', inplace=True)
-    df["TGTLATDD_DDD_WGS84"].fillna('NO CO-ORDS', inplace=True)
-    df = df[
-        (df["TGTLONDDD_DDD_WGS84"] != 'NO CO-ORDS') &
-        (df["TGTLATDD_DDD_WGS84"] != 'NO CO-ORDS')]
-    df = df[
-        (df['TGTLONDDD_DDD_WGS84'] >= 99) &
-        (df['TGTLONDDD_DDD_WGS84'] <= 110) &
-        (df['TGTLATDD_DDD_WGS84'] >= 8) &
-        (df['TGTLATDD_DDD_WGS84'] <= 23)]
-    #plot_elbow_curve(df)
-    kmeans(df)
+    plot elbow curve on a sample of the missions and cluster the data
+    with K-means, or cluster the unique targets with DBSCAN
+
+    Args:
+        engine(str): 'kmeans' or 'dbscan'
+        filename(str): path to the dataset CSV file
+    """
+    if engine not in ('kmeans', 'dbscan'):
+        raise ValueError('unknown engine {}'.format(engine))
+    with instrument.stage('load') as timer:
+        df = dataset.load_dataset(
+            filename,
+            columns=[
+                'THOR_DATA_VIET_ID', 'TGTLATDD_DDD_WGS84',
+                'TGTLONDDD_DDD_WGS84', 'TGTORIGCOORDS',
+                'TGTORIGCOORDSFORMAT'])
+        timer.rowsout = len(df)
+    with instrument.stage('recover missing co-ords', rowsin=len(df)):
+        df, decoded = dataset.fill_missing_coords(df)
+        print('recovered missing co-ords from TGTORIGCOORDS {}'.format(
+            decoded))
+    with instrument.stage('filter to indochina', rowsin=len(df)) as timer:
+        df = df[spatialindex.in_bbox(
+            df['TGTLATDD_DDD_WGS84'].to_numpy(dtype=float),
+            df['TGTLONDDD_DDD_WGS84'].to_numpy(dtype=float),
+            **spatialindex.INDOCHINA)]
+        timer.rowsout = len(df)
+    if engine == 'dbscan':
+        with instrument.stage('dbscan', rowsin=len(df)):
+            dbscan(df)
+        return
+    with instrument.stage('elbow curve', rowsin=len(df)):
+        plot_elbow_curve(df)
+    with instrument.stage('kmeans', rowsin=len(df)):
+        kmeans(df)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)
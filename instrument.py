@@ -0,0 +1,298 @@
+"""
+per-stage timing and memory instrumentation for the analysis scripts
+
+wrap each stage of a script's main() in a stage to record its wall time,
+CPU time, peak resident memory, tracemalloc peak and the number of rows
+going in and coming out, e.g.
+
+    with instrument.stage('drop invalid dates', rowsin=len(df)) as timer:
+        df = df[~invalid]
+        timer.rowsout = len(df)
+
+instrumentation is off by default and a stage then does nothing, turn it on
+with the THOR_INSTRUMENT environment variable or the --instrument flag on
+any script, a JSON and a CSV report of the run are written to
+'Run Reports', or to the directory given, e.g.
+
+    THOR_INSTRUMENT=1 python tallyfields.py
+    python tallyfields.py --instrument=reports
+"""
+
+
+import csv
+import datetime
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+REPORTDIR = 'Run Reports'
+
+ENVIRONMENT_VARIABLE = 'THOR_INSTRUMENT'
+
+FLAG = '--instrument'
+
+COLUMNS = [
+    'stage', 'depth', 'wall_s', 'cpu_s', 'peak_rss_mb', 'traced_peak_mb',
+    'rows_in', 'rows_out']
+
+_RUN = {'enabled': False, 'reportdir': None, 'stages': [], 'open': []}
+
+
+def peak_rss_mb():
+    """
+    highest resident memory so far of this process and of its children
+
+    Returns:
+        own(float): peak resident memory of this process in MB, None if
+                    the platform cannot tell us
+        children(float): largest peak of any finished child process in MB
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    scale = 1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return own, children
+
+
+def cpu_seconds():
+    """
+    CPU time used so far by this process and its finished children
+
+    Returns:
+        seconds(float): user plus system time
+    """
+    if resource is None:
+        return time.process_time()
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+class _NullStage():
+    """
+    the stage handed out when instrumentation is off, it does nothing
+    """
+    rowsin = None
+    rowsout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage():
+    """
+    times one stage of a script
+
+    stages can be nested, the tracemalloc peak of a stage includes the
+    peaks of the stages inside it
+
+    Attributes:
+        name(str): name of the stage
+        rowsin(int): number of rows going into the stage
+        rowsout(int): number of rows coming out, set it inside the stage
+        depth(int): how many stages this one is nested in
+    """
+    def __init__(self, name, rowsin=None):
+        self.name = name
+        self.rowsin = rowsin
+        self.rowsout = None
+        self.depth = 0
+        self.start = None
+        self.cpustart = None
+        self.tracedstart = 0
+        self.tracedpeak = 0
+
+    def __enter__(self):
+        self.depth = len(_RUN['open'])
+        if tracemalloc.is_tracing():
+            _note_traced_peak()
+            self.tracedstart = tracemalloc.get_traced_memory()[0]
+            self.tracedpeak = self.tracedstart
+        _RUN['open'].append(self)
+        self.cpustart = cpu_seconds()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.start
+        cpu = cpu_seconds() - self.cpustart
+        if tracemalloc.is_tracing():
+            _note_traced_peak()
+        _RUN['open'].remove(self)
+        own = peak_rss_mb()[0]
+        record = {
+            'stage': self.name,
+            'depth': self.depth,
+            'wall_s': round(wall, 4),
+            'cpu_s': round(cpu, 4),
+            'peak_rss_mb': None if own is None else round(own, 2),
+            'traced_peak_mb': None,
+            'rows_in': self.rowsin,
+            'rows_out': self.rowsout}
+        if tracemalloc.is_tracing():
+            record['traced_peak_mb'] = round(
+                (self.tracedpeak - self.tracedstart) / 2 ** 20, 2)
+        _RUN['stages'].append(record)
+        return False
+
+
+def _note_traced_peak():
+    """
+    pass the tracemalloc peak since the last reset to every open stage
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for openstage in _RUN['open']:
+        openstage.tracedpeak = max(openstage.tracedpeak, peak)
+    tracemalloc.reset_peak()
+
+
+def stage(name, rowsin=None):
+    """
+    start timing a stage, use it as a context manager
+
+    Args:
+        name(str): name of the stage
+        rowsin(int): number of rows going into the stage
+
+    Returns:
+        stage(Stage): set rowsout on it before the stage ends
+    """
+    if not _RUN['enabled']:
+        return _NULL_STAGE
+    return Stage(name, rowsin)
+
+
+def enabled():
+    """
+    check if stages are being recorded
+
+    Returns:
+        enabled(bool): True if instrumentation is on
+    """
+    return _RUN['enabled']
+
+
+def enable(reportdir=REPORTDIR, trace=True):
+    """
+    start recording stages
+
+    Args:
+        reportdir(str): directory to write the run report to
+        trace(bool): also measure allocations with tracemalloc
+    """
+    _RUN['enabled'] = True
+    _RUN['reportdir'] = reportdir
+    _RUN['stages'] = []
+    if trace and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """
+    stop recording stages and forget the ones recorded
+    """
+    _RUN['enabled'] = False
+    _RUN['stages'] = []
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def configure(argv=None):
+    """
+    turn instrumentation on if the flag or environment variable asks for it
+
+    the --instrument flag is removed from argv so scripts never see it
+
+    Args:
+        argv(list): command line arguments, defaults to sys.argv
+
+    Returns:
+        enabled(bool): True if instrumentation is on
+    """
+    if argv is None:
+        argv = sys.argv
+    reportdir = None
+    for argument in list(argv[1:]):
+        if argument == FLAG or argument.startswith(FLAG + '='):
+            argv.remove(argument)
+            reportdir = argument.partition('=')[2] or REPORTDIR
+    setting = os.environ.get(ENVIRONMENT_VARIABLE, '')
+    if reportdir is None and setting not in ('', '0'):
+        reportdir = REPORTDIR if setting == '1' else setting
+    if reportdir is not None:
+        enable(reportdir)
+    return enabled()
+
+
+def write_report(script):
+    """
+    write the stages recorded so far as JSON and CSV
+
+    Args:
+        script(str): name of the script, used for the filenames
+
+    Returns:
+        reportfile(str): path of the JSON report
+    """
+    os.makedirs(_RUN['reportdir'], exist_ok=True)
+    startedat = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    basename = os.path.join(
+        _RUN['reportdir'], '{}-{}'.format(script, startedat))
+    report = {
+        'script': script,
+        'command': sys.argv,
+        'written': startedat,
+        'stages': _RUN['stages']}
+    with open(basename + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(basename + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(_RUN['stages'])
+    print('wrote run report to {}.json'.format(basename))
+    return basename + '.json'
+
+
+def run_main(main, script=None):
+    """
+    run a script's main() and report its stages if instrumentation is on
+
+    the whole of main() is recorded as one stage with the script's stages
+    nested inside it
+
+    Args:
+        main(function): the main function to run
+        script(str): name of the script, defaults to the module of main
+
+    Returns:
+        result: whatever main returned
+    """
+    if script is None:
+        script = main.__module__
+        if script == '__main__':
+            script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+    if not configure():
+        return main()
+    try:
+        with stage(script):
+            return main()
+    finally:
+        write_report(script)
@@ -3,21 +3,59 @@ a parser to generate Keyhole Markup Language (KML) for Google Earth
 """
 
 
+import io
+import os
+import zipfile
+
+
 class KMLOutputParser():
     """
     Class to parse KML into an output file.
 
+    by default the tags are kept in memory until write_kml_doc_file is
+    called, in streaming mode each tag is written to a buffered file as soon
+    as it is added so the document never has to fit in memory
+
+    can be used as a context manager, on leaving the with block any open
+    folders and the document are closed and the file is written
+    the file is written to kmlfilepath.partial and only moved to kmlfilepath
+    once it is complete, if the with block raises the partial file is
+    removed
+
     Attributes:
         kmldoc(list): list of strings to make up the doc.kml
         kmlfilepath(str): path to output KML file
+        stream(bool): write tags straight to the output file
+        kmz(bool): write a compressed KMZ (zip) file containing doc.kml
+        kmlout(file): the open output file when streaming
+        partialpath(str): path the file is written to until it is complete
+        openfolders(int): number of folders that have not been closed
+        documentclosed(bool): True once close_kml_file has been called
         kmlheader(str): first part of a KML file
         placemarktemplate(str): template for a KML placemark (pin on map)
         lineplacemarktemplate(str): template for KML linestring (line on map)
-        styletemplate(str): template for custom icons on placemarks
+        styletemplate(str): template for the fill colour of polygons
+        polygonplacemarktemplate(str): template for a filled polygon
+        timespantemplate(str): template for the span of time a feature is
+                               shown for on the time slider
+        regiontemplate(str): template for a KML region, an area that only
+                             becomes active when it is big enough on screen
+        networklinktemplate(str): template for a link to another KML file
+        groundoverlaytemplate(str): template for an image draped over the
+                                    ground between lat/lon edges
     """
-    def __init__(self, kmlfilepath):
+    def __init__(self, kmlfilepath, stream=False, kmz=False):
         self.kmldoc = []
         self.kmlfilepath = kmlfilepath
+        self.partialpath = kmlfilepath + '.partial'
+        self.stream = stream
+        self.kmz = kmz
+        self.kmzfile = None
+        self.kmlout = None
+        self.openfolders = 0
+        self.documentclosed = False
+        if self.stream:
+            self.kmlout = self.open_output()
         self.kmlheader = """<?xml version="1.0" encoding="UTF-8"?>
 <kml xmlns="http://www.opengis.net/kml/2.2">
 <Document>
@@ -43,6 +81,131 @@ class KMLOutputParser():
 <coordinates>%s</coordinates>
 </Point>
 </Placemark>"""
+        self.styletemplate = """
+<Style id="%s">
+<LineStyle>
+<width>0</width>
+</LineStyle>
+<PolyStyle>
+<color>%s</color>
+<outline>0</outline>
+</PolyStyle>
+</Style>"""
+        self.polygonplacemarktemplate = """
+<Placemark>
+<name>%s</name>%s
+<styleUrl>#%s</styleUrl>
+<Polygon>
+<outerBoundaryIs>
+<LinearRing>
+<coordinates>%s</coordinates>
+</LinearRing>
+</outerBoundaryIs>
+</Polygon>
+</Placemark>"""
+        self.timespantemplate = """
+<TimeSpan>
+<begin>%s</begin>
+<end>%s</end>
+</TimeSpan>"""
+        self.regiontemplate = """
+<Region>
+<LatLonAltBox>
+<north>%s</north>
+<south>%s</south>
+<east>%s</east>
+<west>%s</west>
+</LatLonAltBox>
+<Lod>
+<minLodPixels>%s</minLodPixels>
+<maxLodPixels>%s</maxLodPixels>
+</Lod>
+</Region>"""
+        self.networklinktemplate = """
+<NetworkLink>
+<name>%s</name>%s
+<Link>
+<href>%s</href>
+<viewRefreshMode>onRegion</viewRefreshMode>
+</Link>
+</NetworkLink>"""
+        self.groundoverlaytemplate = """
+<GroundOverlay>
+<name>%s</name>%s
+<color>%s</color>
+<drawOrder>%s</drawOrder>
+<Icon>
+<href>%s</href>
+</Icon>
+<LatLonBox>
+<north>%s</north>
+<south>%s</south>
+<east>%s</east>
+<west>%s</west>
+</LatLonBox>
+</GroundOverlay>"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.close_output(complete=False)
+            return
+        while self.openfolders:
+            self.close_folder()
+        if not self.documentclosed:
+            self.close_kml_file()
+        self.write_kml_doc_file()
+
+    def open_output(self):
+        """
+        open the output file, inside a KMZ zip file if required
+
+        Returns:
+            kmlout(file): text file handle to write the KML to
+        """
+        if self.kmz:
+            self.kmzfile = zipfile.ZipFile(
+                self.partialpath, 'w', compression=zipfile.ZIP_DEFLATED)
+            kmlout = io.TextIOWrapper(
+                self.kmzfile.open('doc.kml', 'w'), encoding='utf-8')
+        else:
+            kmlout = open(self.partialpath, 'w', buffering=1024 * 1024)
+        return kmlout
+
+    def close_output(self, complete=True):
+        """
+        close the output file if it is open and move it into place, or
+        remove it if it is not complete
+
+        Args:
+            complete(bool): the file has been written in full
+        """
+        if self.kmlout is not None:
+            self.kmlout.close()
+            self.kmlout = None
+        if self.kmzfile is not None:
+            self.kmzfile.close()
+            self.kmzfile = None
+        if not os.path.exists(self.partialpath):
+            return
+        if complete:
+            os.replace(self.partialpath, self.kmlfilepath)
+        else:
+            os.remove(self.partialpath)
+
+    def add_tags(self, kmltags):
+        """
+        add a string of tags to the document
+
+        Args:
+            kmltags(str): the KML to add
+        """
+        if self.stream:
+            self.kmlout.write(kmltags)
+        else:
+            self.kmldoc.append(kmltags)
 
     @staticmethod
     def format_kml_placemark_description(placemarkdict):
@@ -80,12 +243,38 @@ class KMLOutputParser():
         description = ''.join(descriptionlist)
         return description
 
+    @staticmethod
+    def format_kml_placemark_descriptions(columns):
+        """
+        format the descriptions of many placemarks at once
+
+        gives the same strings as format_kml_placemark_description but
+        works a column at a time, the field labels are only formatted once
+
+        Args:
+            columns(dict): keys are field names, values are lists of the
+                           string value of that field for each placemark
+
+        Returns:
+            descriptions(list): one HTML description string per placemark
+        """
+        starttag = "<![CDATA["
+        newlinetag = "<br  />\n"
+        endtag = "]]>"
+        fieldtemplates = []
+        for item in columns:
+            label = str(item).upper().replace('%', '%%')
+            fieldtemplates.append(label + ' - %s' + newlinetag)
+        template = starttag + ''.join(fieldtemplates) + endtag
+        descriptions = [template % row for row in zip(*columns.values())]
+        return descriptions
+
     def create_kml_header(self):
         """
         Write the first part of the KML output file.
         This only needs to be called once at the start of the kml file.
         """
-        self.kmldoc.append(self.kmlheader)
+        self.add_tags(self.kmlheader)
 
     def add_kml_placemark(self, placemarkname, description, lon, lat,
                           altitude='0', timestamp=''):
@@ -107,7 +296,177 @@ class KMLOutputParser():
         placemark = self.placemarktemplate % (
             placemarkname, description, timestamp, lon, lat,
             altitude, coords)
-        self.kmldoc.append(placemark)
+        self.add_tags(placemark)
+
+    def add_kml_placemarks(self, placemarknames, descriptions, lons, lats,
+                           altitude='0', timestamps=None):
+        """
+        Write many placemarks to the KML file in one go
+
+        each distinct placemark name is only cleaned once
+
+        Args:
+            placemarknames(list): text that appears next to each pin
+            descriptions(list): text that will appear in each placemark
+            lons(list): longitudes in decimal degrees as strings
+            lats(list): latitudes in decimal degrees as strings
+            altitude(str): altitude in metres for all the placemarks
+            timestamps(list): time stamps in XML format, None for no times
+        """
+        cleannames = {
+            name: remove_invalid_chars(name) for name in set(placemarknames)}
+        if timestamps is None:
+            timestamps = [''] * len(descriptions)
+        template = self.placemarktemplate
+        placemarks = [
+            template % (
+                cleannames[name], description, timestamp, lon, lat,
+                altitude, lon + ',' + lat + ',' + altitude)
+            for name, description, lon, lat, timestamp in zip(
+                placemarknames, descriptions, lons, lats, timestamps)]
+        self.add_tags(''.join(placemarks))
+
+    def add_style(self, styleid, polycolor):
+        """
+        add a shared style that polygons can refer to by its id
+
+        styles need to be added before the placemarks that use them
+
+        Args:
+            styleid(str): id of the style
+            polycolor(str): aabbggrr hex fill colour
+        """
+        self.add_tags(self.styletemplate % (
+            remove_invalid_chars(styleid), polycolor))
+
+    def add_kml_polygons(self, polygonnames, styleids, coordinates,
+                         begins=None, ends=None):
+        """
+        Write many filled polygons to the KML file in one go
+
+        each distinct polygon name is only cleaned once
+
+        Args:
+            polygonnames(list): text that appears for each polygon
+            styleids(list): id of the style of each polygon
+            coordinates(list): 'lon,lat,altitude' corners of each polygon
+                               separated by spaces, the last corner the
+                               same as the first
+            begins(list): start of the time span of each polygon in XML
+                          format, None to always show them
+            ends(list): end of the time span of each polygon in XML format
+        """
+        cleannames = {
+            name: remove_invalid_chars(name) for name in set(polygonnames)}
+        if begins is None:
+            timespans = [''] * len(polygonnames)
+        else:
+            timespans = [
+                self.timespantemplate % (begin, end)
+                for begin, end in zip(begins, ends)]
+        template = self.polygonplacemarktemplate
+        polygons = [
+            template % (cleannames[name], timespan, styleid, corners)
+            for name, timespan, styleid, corners in zip(
+                polygonnames, timespans, styleids, coordinates)]
+        self.add_tags(''.join(polygons))
+
+    def format_region(self, north, south, east, west, minlodpixels=128,
+                      maxlodpixels=-1):
+        """
+        format a KML region
+
+        Args:
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+            minlodpixels(int): size on screen in pixels before the region
+                               becomes active
+            maxlodpixels(int): size on screen in pixels after which the
+                               region is no longer active, -1 for no limit
+
+        Returns:
+            region(str): the region tags
+        """
+        return self.regiontemplate % (
+            north, south, east, west, minlodpixels, maxlodpixels)
+
+    def add_region(self, north, south, east, west, minlodpixels=128,
+                   maxlodpixels=-1):
+        """
+        limit the current document or folder to a region
+        so it is only drawn when that area is big enough on screen
+
+        Args:
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+            minlodpixels(int): size on screen in pixels before the region
+                               becomes active
+            maxlodpixels(int): size on screen in pixels after which the
+                               region is no longer active, -1 for no limit
+        """
+        self.add_tags(self.format_region(
+            north, south, east, west, minlodpixels, maxlodpixels))
+
+    def add_network_link(self, linkname, href, north, south, east, west,
+                         minlodpixels=128, maxlodpixels=-1):
+        """
+        link to another KML file that is only loaded when its region
+        is big enough on screen
+
+        Args:
+            linkname(str): name of the link
+            href(str): path or URL of the KML file to load
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+            minlodpixels(int): size on screen in pixels before the linked
+                               file is loaded
+            maxlodpixels(int): size on screen in pixels after which the
+                               linked file is no longer shown, -1 for no limit
+        """
+        region = self.format_region(
+            north, south, east, west, minlodpixels, maxlodpixels)
+        networklink = self.networklinktemplate % (
+            remove_invalid_chars(linkname), region, remove_invalid_chars(href))
+        self.add_tags(networklink)
+
+    def add_ground_overlay(self, overlayname, href, north, south, east, west,
+                           color='ffffffff', draworder=0, minlodpixels=None,
+                           maxlodpixels=-1):
+        """
+        drape an image over the ground between lat/lon edges
+
+        the image is stretched so its top edge is north and its left edge
+        is west, each pixel covers an equal step of latitude and longitude
+
+        Args:
+            overlayname(str): name of the overlay
+            href(str): path or URL of the image
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+            color(str): aabbggrr hex colour the image is multiplied by,
+                        lower the alpha to make it see-through
+            draworder(int): overlays with higher values are drawn on top
+            minlodpixels(int): size on screen in pixels before the overlay
+                               is shown, None to always show it
+            maxlodpixels(int): size on screen in pixels after which the
+                               overlay is hidden, -1 for no limit
+        """
+        region = ''
+        if minlodpixels is not None:
+            region = self.format_region(
+                north, south, east, west, minlodpixels, maxlodpixels)
+        groundoverlay = self.groundoverlaytemplate % (
+            remove_invalid_chars(overlayname), region, color, draworder,
+            remove_invalid_chars(href), north, south, east, west)
+        self.add_tags(groundoverlay)
 
     def open_folder(self, foldername):
         """
@@ -118,14 +477,16 @@ class KMLOutputParser():
         """
         cleanfoldername = remove_invalid_chars(foldername)
         openfolderstr = "<Folder>\n<name>{}</name>".format(cleanfoldername)
-        self.kmldoc.append(openfolderstr)
+        self.add_tags(openfolderstr)
+        self.openfolders += 1
 
     def close_folder(self):
         """
         close the currently open folder
         """
         closefolderstr = "</Folder>"
-        self.kmldoc.append(closefolderstr)
+        self.add_tags(closefolderstr)
+        self.openfolders -= 1
 
     def close_kml_file(self):
         """
@@ -134,15 +495,27 @@ class KMLOutputParser():
         to ensure the tags are closed properly.
         """
         endtags = "\n</Document></kml>"
-        self.kmldoc.append(endtags)
+        self.add_tags(endtags)
+        self.documentclosed = True
 
     def write_kml_doc_file(self):
         """
         write the tags to the kml doc.kml file
+
+        when streaming the tags have already been written so this just closes
+        the file
         """
-        with open(self.kmlfilepath, 'w') as kmlout:
+        if self.stream:
+            self.close_output()
+            return
+        self.kmlout = self.open_output()
+        try:
             for kmltags in self.kmldoc:
-                kmlout.write(kmltags)
+                self.kmlout.write(kmltags)
+        except BaseException:
+            self.close_output(complete=False)
+            raise
+        self.close_output()
 
 
 def remove_invalid_chars(xmlstring):
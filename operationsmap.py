@@ -5,40 +5,68 @@ Thomas W Whittam
 """
 
 
-import datetime
-import re
+import numpy as np
+import pandas as pd
 
+import dataset
+import export
+import instrument
 import kml
+import spatialindex
 
-import pandas as pd
 
+COLS2DROP = [
+    'NUMWEAPONSJETTISONED', 'NUMWEAPONSRETURNED', 'RELEASEALTITUDE',
+    'RELEASEFLTSPEED', 'TGTWEATHER', 'TGTID', 'TGTCLOUDCOVER',
+    'TGTCONTROL', 'OPERATIONSUPPORTED', 'AIRFORCEGROUP', 'AIRFORCESQDN',
+    'WEAPONTYPECLASS', 'WEAPONTYPEWEIGHT']
 
-def clean_date(datestr):
+
+def column_as_strings(column):
     """
-    clean the date string from yyyymmdd to yyyy-mm-dd
+    convert every value in a column to a string
+
+    each distinct value is only converted once, missing values become 'nan'
+    the same as str() gives for them
 
     Args:
-        datestr(str): string containing the date
+        column(pandas series): the column to convert
 
     Returns:
-        cleandate(str): if the date has been modified or is 'INVALID'
-        datestr(str): if the date requires no modification as it is already
-                      in the correct format
+        strings(numpy array): str() of each value in the column
+    """
+    codes, uniques = pd.factorize(column)
+    strings = np.array(
+        [str(value) for value in uniques] + ['nan'], dtype=object)
+    return strings[codes]
+
+
+def add_mission_placemarks(kmlmap, operations):
     """
-    datestr = str(datestr)
-    if re.match(r'^(\d{8})', datestr):
-        cleandate = '{}-{}-{}'.format(datestr[0:4], datestr[4:6], datestr[6:9])
-        try:
-            datetime.date(
-                int(datestr[0:4]), int(datestr[4:6]), int(datestr[6:9]))
-        except ValueError:
-            cleandate = 'INVALID'
-        return cleandate
-    else:
-        return datestr
-
-
-def create_map(outputfile, mtypes):
+    add a placemark for each mission in a dataframe
+
+    the placemark names, descriptions and co-ordinates are built a column at
+    a time instead of row by row
+
+    Args:
+        kmlmap(kml.KMLOutputParser): the map to add the placemarks to
+        operations(pandas dataframe): the missions to add
+    """
+    columns = {
+        column: column_as_strings(operations[column])
+        for column in operations.columns}
+    aircraft = columns['VALID_AIRCRAFT_ROOT']
+    pointnames = np.where(
+        operations['CALLSIGN'].notna().to_numpy(),
+        aircraft + '  ' + columns['CALLSIGN'], aircraft)
+    descriptions = kmlmap.format_kml_placemark_descriptions(columns)
+    kmlmap.add_kml_placemarks(
+        pointnames, descriptions,
+        columns['TGTLONDDD_DDD_WGS84'], columns['TGTLATDD_DDD_WGS84'],
+        altitude='0', timestamps=columns['MSNDATE'])
+
+
+def create_map(outputfile, mtypes, batchsize=50000):
     """
     create a kml map
 
@@ -49,40 +77,28 @@ def create_map(outputfile, mtypes):
       you click on the placemark
      -each mission type is in its own folder
 
+    the KML is streamed to disk as it is generated, give the output file a
+    .kmz extension to write a compressed KMZ file instead
+
     Args:
         mtypes(dict): dict of pandas dataframes, keys are mission types values
                       are pandas dataframe of missions of that type
-        outputfile(str): path to write kml file to
+        outputfile(str): path to write kml or kmz file to
+        batchsize(int): number of placemarks to build at a time
     """
-    cols2drop = [
-        'NUMWEAPONSJETTISONED', 'NUMWEAPONSRETURNED', 'RELEASEALTITUDE',
-        'RELEASEFLTSPEED', 'TGTWEATHER', 'TGTID', 'TGTCLOUDCOVER',
-        'TGTCONTROL', 'OPERATIONSUPPORTED', 'AIRFORCEGROUP', 'AIRFORCESQDN',
-        'WEAPONTYPECLASS', 'WEAPONTYPEWEIGHT']
-    kmlmap = kml.KMLOutputParser(outputfile)
-    kmlmap.create_kml_header()
-    kmlmap.open_folder('Vietnam War Air Missions - THOR dataset')
-    for mtype in mtypes:
-        kmlmap.open_folder(mtype)
-        operations = mtypes[mtype]
-        operations.drop(cols2drop, axis=1, inplace=True)
-        for index, row in operations.iterrows():
-            operation = row.to_dict()
-            desc = kmlmap.format_kml_placemark_description(operation)
-            if isinstance(operation['CALLSIGN'], str):
-                pointname = '{}  {}'.format(
-                    operation['VALID_AIRCRAFT_ROOT'], operation['CALLSIGN'])
-            else:
-                pointname = operation['VALID_AIRCRAFT_ROOT']
-            kmlmap.add_kml_placemark(
-                pointname, desc,
-                str(operation['TGTLONDDD_DDD_WGS84']),
-                str(operation['TGTLATDD_DDD_WGS84']),
-                altitude='0', timestamp=operation['MSNDATE'])
+    kmz = outputfile.lower().endswith('.kmz')
+    with kml.KMLOutputParser(outputfile, stream=True, kmz=kmz) as kmlmap:
+        kmlmap.create_kml_header()
+        kmlmap.open_folder('Vietnam War Air Missions - THOR dataset')
+        for mtype in mtypes:
+            kmlmap.open_folder(mtype)
+            operations = mtypes[mtype].drop(COLS2DROP, axis=1)
+            for start in range(0, len(operations), batchsize):
+                add_mission_placemarks(
+                    kmlmap, operations.iloc[start:start + batchsize])
+            kmlmap.close_folder()
         kmlmap.close_folder()
-    kmlmap.close_folder()
-    kmlmap.close_kml_file()
-    kmlmap.write_kml_doc_file()
+        kmlmap.close_kml_file()
 
 
 def split_by_mission_type(df):
@@ -104,7 +120,7 @@ def split_by_mission_type(df):
     return bymissiontypes
 
 
-def linebacker2_map(lbdf):
+def linebacker2_map(lbdf, index=None):
     """
     map Operation Linebacker 2
 
@@ -118,43 +134,65 @@ def linebacker2_map(lbdf):
 
     Args:
         lbdf(pandas dataframe): dataframe to make map from
+        index(spatialindex.SpatialIndex): index with dates over lbdf, to
+                                          share one index between several
+                                          queries, None scans every row
     """
     print('Creating map of Operation Linebacker 2 targets')
-    missiondates = ['1972-12-' + str(x) for x in range(18, 30)]
-    lbdf = lbdf[lbdf['MSNDATE'].isin(missiondates)]
-    lbdf = lbdf[lbdf['COUNTRYFLYINGMISSION'] == 'UNITED STATES OF AMERICA']
-    lbdf = lbdf[
-        (lbdf['TGTLONDDD_DDD_WGS84'] >= 104) &
-        (lbdf['TGTLONDDD_DDD_WGS84'] <= 108) &
-        (lbdf['TGTLATDD_DDD_WGS84'] >= 20) &
-        (lbdf['TGTLATDD_DDD_WGS84'] <= 22)]
-    missiontypesorganised = split_by_mission_type(lbdf)
-    create_map('Operation Linebacker 2.kml', missiontypesorganised)
-    lbcsv = lbdf.to_csv(header=True)
-    with open('Operation Linebacker 2.csv', 'w') as f:
-        f.write(lbcsv)
-
-
-def main():
+    with instrument.stage('linebacker 2 query', rowsin=len(lbdf)) as timer:
+        bbox = {'north': 22, 'south': 20, 'east': 108, 'west': 104}
+        daterange = ('1972-12-18', '1972-12-29')
+        if index is None:
+            # one query, a single pass is quicker than building an index
+            inside = spatialindex.in_bbox(
+                lbdf['TGTLATDD_DDD_WGS84'].to_numpy(dtype=float),
+                lbdf['TGTLONDDD_DDD_WGS84'].to_numpy(dtype=float), **bbox)
+            inside &= lbdf['MSNDATE'].between(*daterange).to_numpy()
+            lbdf = lbdf[inside]
+        else:
+            lbdf = lbdf.iloc[index.query_bbox(**bbox, daterange=daterange)]
+        lbdf = lbdf[
+            lbdf['COUNTRYFLYINGMISSION'] == 'UNITED STATES OF AMERICA']
+        timer.rowsout = len(lbdf)
+    with instrument.stage('linebacker 2 kml', rowsin=len(lbdf)):
+        missiontypesorganised = split_by_mission_type(lbdf)
+        create_map('Operation Linebacker 2.kml', missiontypesorganised)
+    with instrument.stage('linebacker 2 csv', rowsin=len(lbdf)):
+        export.write_table(lbdf, 'Operation Linebacker 2.csv')
+
+
+def main(filename='thor_data_vietnam.csv'):
     """
     main program code
 
     load dataset
     clean the mission dates
+    recover missing LAT LON co-ords from the original co-ords
     remove missions with no LAT LON co-ords
     create the map
+
+    Args:
+        filename(str): path to the dataset CSV file
     """
-    filename = 'thor_data_vietnam.csv'
-    df = pd.read_csv(filename)
-    df['MSNDATE'] = df['MSNDATE'].apply(clean_date)
-    df = df[df.MSNDATE != 'INVALID']
-    df["TGTLONDDD_DDD_WGS84"].fillna('NO CO-ORDS', inplace=True)
-    df["TGTLATDD_DDD_WGS84"].fillna('NO CO-ORDS', inplace=True)
-    df = df[
-        (df["TGTLONDDD_DDD_WGS84"] != 'NO CO-ORDS') &
-        (df["TGTLATDD_DDD_WGS84"] != 'NO CO-ORDS')]
+    with instrument.stage('load') as timer:
+        df = dataset.load_dataset(filename)
+        timer.rowsout = len(df)
+    with instrument.stage('clean dates', rowsin=len(df)) as timer:
+        df['MSNDATE'], invalid, rejected = dataset.clean_dates(
+            df['MSNDATE'], as_strings=True)
+        print('removing {} missions with invalid dates {}'.format(
+            invalid.sum(), rejected))
+        df = df[~invalid]
+        timer.rowsout = len(df)
+    with instrument.stage('recover missing co-ords', rowsin=len(df)):
+        df, decoded = dataset.fill_missing_coords(df)
+        print('recovered missing co-ords from TGTORIGCOORDS {}'.format(
+            decoded))
+    with instrument.stage('drop missing co-ords', rowsin=len(df)) as timer:
+        df = df.dropna(subset=['TGTLONDDD_DDD_WGS84', 'TGTLATDD_DDD_WGS84'])
+        timer.rowsout = len(df)
     linebacker2_map(df)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)
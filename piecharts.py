@@ -6,35 +6,61 @@ Thomas Whittam
 """
 
 
-import pandas as pd
-import matplotlib.pyplot as plt
+import os
 
+import charts
+import cube
+import dataset
+import instrument
 
-def pie_chart_maker(outputfilename, dataframe, catagory, title):
+
+def count_values(dataframe, catagory, weights=None):
+    """
+    tally up the values of a column
+
+    Args:
+        dataframe(pandas dataframe): the raw data in a pandas dataframe
+        catagory(str): the column we want to tally up
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the aggregate cube, None counts the rows
+
+    Returns:
+        count(pandas series): number of missions for each value
+    """
+    grouped = dataframe.groupby(catagory, observed=True)
+    if weights is None:
+        return grouped.size()
+    return grouped[weights].sum()
+
+
+def pie_chart_maker(outputfilename, dataframe, catagory, title,
+                    weights=None):
     """
     generate pie charts for a column in the dataframe by tallying up the values
 
     Args:
-        outputfilename(str): filename to save the pie chart as
+        outputfilename(str): filename to save the pie chart as, .png or .svg
         dataframe(pandas dataframe): the raw data in a pandas dataframe
         catagory(str): the column we want to tally up and make a pie chart from
         title(str): title to appear on the chart
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the aggregate cube, None counts the rows
     """
-    count = dataframe.groupby([catagory]).size()
-    countdict = count.to_dict()
-    countdict = dict(sorted(countdict.items(), key=lambda x: x[1]))
-    labels = list(countdict.keys())
-    values = list(countdict.values())
-    fig, ax = plt.subplots(figsize=(12, 12))
-    ax.pie(values, labels=labels, autopct='%1.1f%%', rotatelabels=True)
-    plt.title(title)
-    plt.savefig(outputfilename)
-    plt.clf()
-
-
-def main():
+    count = count_values(dataframe, catagory, weights)
+    charts.render_chart(charts.pie_chart_spec(outputfilename, count, title))
+
+
+def main(usecube=False, imageformat='png', filename='thor_data_vietnam.csv'):
     """
     main program code
+
+    the values are tallied here and the charts drawn in parallel
+
+    Args:
+        usecube(bool): answer from the aggregate cube instead of counting
+                       the raw missions
+        imageformat(str): 'png' or 'svg'
+        filename(str): path to the dataset CSV file
     """
     catagories = {
         'Military Service': 'MILSERVICE',
@@ -43,13 +69,25 @@ def main():
         'Target Type': 'TGTTYPE',
         'Mission Type': 'MFUNC_DESC',
         'Target Country': 'TGTCOUNTRY'}
-    filename = 'thor_data_vietnam.csv'
-    df = pd.read_csv(filename)
-    for catagory in catagories:
-        print('creating pie chart for - {}'.format(catagory))
-        outfile = '{}_{}_pie.png'.format(filename, catagory)
-        pie_chart_maker(outfile, df, catagories[catagory], catagory)
+    with instrument.stage('load') as timer:
+        if usecube:
+            df = cube.load_cube(filename)
+            weights = 'COUNT'
+        else:
+            df = dataset.load_dataset(
+                filename, columns=list(catagories.values()))
+            weights = None
+        timer.rowsout = len(df)
+    specs = []
+    with instrument.stage('tally', rowsin=len(df)):
+        for catagory in catagories:
+            print('creating pie chart for - {}'.format(catagory))
+            outfile = '{}_{}_pie.{}'.format(
+                os.path.basename(filename), catagory, imageformat)
+            count = count_values(df, catagories[catagory], weights)
+            specs.append(charts.pie_chart_spec(outfile, count, catagory))
+    charts.render_charts(specs)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)
@@ -0,0 +1,297 @@
+"""
+a mission level rollup of the Vietnam War THOR dataset
+
+the dataset has one row per source record, so a mission reported once per
+target or weapon, or by more than one source, is counted several times by
+the tallies and time series
+records are grouped into missions by a hash of a composite key, records
+that agree on a longer key are flagged as likely duplicates and left out of
+the mission totals
+the mission table is built once and stored next to the dataset like the
+aggregate cube, tallyfields and timeseries can run on it with missions=True
+"""
+
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import cube
+import dataset
+import export
+import instrument
+
+
+KEYS = {
+    'mission': ['MSNDATE', 'MISSIONID', 'UNIT', 'CALLSIGN'],
+    'duplicate': [
+        'MSNDATE', 'MISSIONID', 'UNIT', 'CALLSIGN', 'VALID_AIRCRAFT_ROOT',
+        'TGTLATDD_DDD_WGS84', 'TGTLONDDD_DDD_WGS84', 'WEAPONTYPE',
+        'NUMWEAPONSDELIVERED', 'TIMEONTARGET']}
+
+MEASURES = ['NUMOFACFT', 'NUMWEAPONSDELIVERED', 'FLTHOURS']
+
+MISSIONS_SUFFIX = '.missions-{}.parquet'
+
+
+def date_codes(dates):
+    """
+    give each distinct mission date a code, the same for both spellings
+    of a date
+
+    MSNDATE mixes yyyymmdd and yyyy-mm-dd, so the same mission can be
+    written both ways, dates that cannot be cleaned keep a code of their
+    own
+
+    Args:
+        dates(array like): the distinct raw mission dates
+
+    Returns:
+        codes(numpy array): code of each date
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates.dtype):
+        return np.arange(len(dates))
+    dates = pd.Series(np.asarray(dates, dtype=object))
+    cleandates, invalid = dataset.clean_dates(dates, as_strings=True)[:2]
+    return pd.factorize(cleandates.where(~invalid, dates))[0]
+
+
+def hash_keys(df, columns):
+    """
+    hash the values of several columns in each row to one 64 bit number
+
+    each column is factorized and its integer codes hashed, which is much
+    quicker than hashing every string, then the hashes are combined
+    the codes depend on the order of the rows, so hashes can only be
+    compared with others from the same call
+    missing values all hash the same, and so do both spellings of a
+    MSNDATE
+
+    Args:
+        df(pandas dataframe): the records
+        columns(list): the columns making up the key
+
+    Returns:
+        hashes(numpy array): uint64 hash of the key of each row
+    """
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for column in columns:
+        codes, uniques = pd.factorize(df[column])
+        if column == 'MSNDATE':
+            # only the few thousand distinct dates are cleaned
+            codes = np.where(codes >= 0, date_codes(uniques)[codes], -1)
+        hashes ^= pd.util.hash_array(codes)
+        hashes *= np.uint64(1000003)
+    return hashes
+
+
+def group_by_hash(hashes):
+    """
+    number the groups of equal hashes in order of first appearance
+
+    with 64 bit hashes two different keys in the whole dataset have about
+    a one in a million chance of being grouped together
+
+    Args:
+        hashes(numpy array): hash of the key of each row
+
+    Returns:
+        codes(numpy array): group of each row
+        ngroups(int): number of groups
+    """
+    codes, uniques = pd.factorize(hashes)
+    return codes, len(uniques)
+
+
+def first_in_group(codes):
+    """
+    find the first row of each group
+
+    groups are numbered in order of appearance, so a group starts where its
+    code goes past the highest code so far
+
+    Args:
+        codes(numpy array): group of each row from group_by_hash
+
+    Returns:
+        first(numpy array): True for the first row of each group
+    """
+    first = np.ones(len(codes), dtype=bool)
+    if len(codes):
+        first[1:] = codes[1:] > np.maximum.accumulate(codes)[:-1]
+    return first
+
+
+def flag_duplicates(df, key=None):
+    """
+    flag records that repeat an earlier record's key
+
+    Args:
+        df(pandas dataframe): the records
+        key(list): columns that have to match, defaults to KEYS['duplicate']
+
+    Returns:
+        duplicate(numpy array): True for every record after the first with
+                                the same key
+    """
+    if key is None:
+        key = KEYS['duplicate']
+    codes = group_by_hash(hash_keys(df, key))[0]
+    return ~first_in_group(codes)
+
+
+def rollup_missions(df, missionkey=None, duplicatekey=None):
+    """
+    group records into missions and total them
+
+    the other columns of each mission are the values of its first record,
+    duplicate records are counted but not added to the measures
+
+    Args:
+        df(pandas dataframe): records with the key columns, MEASURES and
+                              cube.DIMENSIONS
+        missionkey(list): columns identifying a mission, defaults to
+                          KEYS['mission']
+        duplicatekey(list): columns identifying a duplicate record,
+                            defaults to KEYS['duplicate']
+
+    Returns:
+        missions(pandas dataframe): one row per mission with the key
+                                    columns, cube.DIMENSIONS, the MEASURES,
+                                    RECORDS and DUPLICATES
+    """
+    if missionkey is None:
+        missionkey = KEYS['mission']
+    duplicate = flag_duplicates(df, duplicatekey)
+    codes, nmissions = group_by_hash(hash_keys(df, missionkey))
+    columns = list(dict.fromkeys(missionkey + cube.DIMENSIONS))
+    missions = df.loc[first_in_group(codes), columns].reset_index(drop=True)
+    missions['RECORDS'] = np.bincount(codes, minlength=nmissions)
+    missions['DUPLICATES'] = np.bincount(
+        codes, weights=duplicate, minlength=nmissions).astype(np.int64)
+    keep = ~duplicate
+    for measure in MEASURES:
+        values = df[measure].to_numpy(dtype=float, na_value=0)[keep]
+        totals = np.bincount(codes[keep], weights=values, minlength=nmissions)
+        if pd.api.types.is_integer_dtype(df[measure].dtype):
+            totals = totals.astype(np.int64)
+        missions[measure] = totals
+    return missions
+
+
+def rollup_columns(missionkey, duplicatekey):
+    """
+    the columns of the dataset a rollup needs
+
+    Args:
+        missionkey(list): columns identifying a mission
+        duplicatekey(list): columns identifying a duplicate record
+
+    Returns:
+        columns(list): the columns to load
+    """
+    return list(dict.fromkeys(
+        missionkey + duplicatekey + cube.DIMENSIONS + MEASURES))
+
+
+def missions_suffix(missionkey, duplicatekey):
+    """
+    cache suffix for a mission table, each pair of keys gets its own cache
+
+    Args:
+        missionkey(list): columns identifying a mission
+        duplicatekey(list): columns identifying a duplicate record
+
+    Returns:
+        suffix(str): suffix for dataset.cache_paths
+    """
+    keys = json.dumps([missionkey, duplicatekey]).encode()
+    return MISSIONS_SUFFIX.format(hashlib.sha256(keys).hexdigest()[:12])
+
+
+def load_missions(filename, missionkey=None, duplicatekey=None):
+    """
+    load the mission table for a dataset, building it first if the CSV has
+    changed
+
+    without pyarrow the table is built in memory each time
+
+    Args:
+        filename(str): path to the source CSV file
+        missionkey(list): columns identifying a mission, defaults to
+                          KEYS['mission']
+        duplicatekey(list): columns identifying a duplicate record,
+                            defaults to KEYS['duplicate']
+
+    Returns:
+        missions(pandas dataframe): one row per mission, see rollup_missions
+    """
+    missionkey = list(missionkey or KEYS['mission'])
+    duplicatekey = list(duplicatekey or KEYS['duplicate'])
+    columns = rollup_columns(missionkey, duplicatekey)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return rollup_missions(
+            dataset.load_dataset(filename, columns=columns),
+            missionkey, duplicatekey)
+    suffix = missions_suffix(missionkey, duplicatekey)
+    missionsfile, signaturefile = dataset.cache_paths(filename, suffix)
+    if not dataset.cache_is_current(filename, suffix):
+        print('building mission table of {}'.format(filename))
+        signature = dataset.source_signature(filename)
+        missions = rollup_missions(
+            dataset.load_dataset(filename, columns=columns),
+            missionkey, duplicatekey)
+        os.makedirs(os.path.dirname(missionsfile), exist_ok=True)
+        tmpfile = missionsfile + '.tmp'
+        missions.to_parquet(tmpfile)
+        os.replace(tmpfile, missionsfile)
+        dataset.write_signature(signaturefile, signature)
+        return missions
+    return pd.read_parquet(missionsfile)
+
+
+def main(missionkey=None, duplicatekey=None,
+         filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    build the mission table and report how many records, missions and
+    likely duplicates there are, overall and for each country flying
+    missions
+
+    Args:
+        missionkey(list): columns identifying a mission, defaults to
+                          KEYS['mission']
+        duplicatekey(list): columns identifying a duplicate record,
+                            defaults to KEYS['duplicate']
+        filename(str): path to the dataset CSV file
+    """
+    with instrument.stage('rollup') as timer:
+        missions = load_missions(filename, missionkey, duplicatekey)
+        timer.rowsout = len(missions)
+    records = int(missions['RECORDS'].sum())
+    duplicates = int(missions['DUPLICATES'].sum())
+    print('{} records are {} missions, {} likely duplicate records'.format(
+        records, len(missions), duplicates))
+    report = {
+        'records': records,
+        'missions': len(missions),
+        'duplicates': duplicates,
+        'missionkey': list(missionkey or KEYS['mission']),
+        'duplicatekey': list(duplicatekey or KEYS['duplicate'])}
+    with open('rollup-report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    print('writing missions and duplicates per country flying missions')
+    bycountry = missions.groupby('COUNTRYFLYINGMISSION', observed=True).agg(
+        Missions=('RECORDS', 'size'), Records=('RECORDS', 'sum'),
+        Duplicates=('DUPLICATES', 'sum'))
+    export.write_table(bycountry, 'missions-by-country.csv')
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
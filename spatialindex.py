@@ -0,0 +1,294 @@
+"""
+a spatial index over the target co-ordinates of the Vietnam THOR dataset
+
+missions are bucketed into a regular grid of lat/lon cells and sorted by
+cell, a query only looks at the missions in the cells it overlaps instead of
+scanning every row
+supports bounding box, radius and polygon queries, optionally limited to a
+range of dates, and returns row positions for use with DataFrame.iloc
+a single bounding box query is quicker with in_bbox, which needs no index
+"""
+
+
+import numpy as np
+import pandas as pd
+
+
+INDOCHINA = {'north': 23, 'south': 8, 'east': 110, 'west': 99}
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class SpatialIndex():
+    """
+    grid index over latitude and longitude points
+
+    points with missing co-ordinates are never returned by a query
+
+    Attributes:
+        lats(numpy array): latitude of each row in decimal degrees
+        lons(numpy array): longitude of each row in decimal degrees
+        dates(numpy array): datetime64 date of each row, or None
+        cellsize(float): width and height of a grid cell in degrees
+        south(float): southern edge of the grid
+        west(float): western edge of the grid
+        nrows(int): number of rows of cells in the grid
+        ncols(int): number of columns of cells in the grid
+        order(numpy array): row positions sorted by grid cell
+        sortedcells(numpy array): the grid cell of each entry in order
+    """
+    def __init__(self, lats, lons, dates=None, cellsize=0.1):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.dates = None
+        if dates is not None:
+            self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.cellsize = cellsize
+        valid = np.flatnonzero(~(np.isnan(self.lats) | np.isnan(self.lons)))
+        if len(valid):
+            self.south = self.lats[valid].min()
+            self.west = self.lons[valid].min()
+            north = self.lats[valid].max()
+            east = self.lons[valid].max()
+        else:
+            self.south = self.west = north = east = 0.0
+        self.nrows = int((north - self.south) // cellsize) + 1
+        self.ncols = int((east - self.west) // cellsize) + 1
+        cells = self.cell_ids(self.lats[valid], self.lons[valid])
+        sortorder = np.argsort(cells, kind='stable')
+        self.order = valid[sortorder]
+        self.sortedcells = cells[sortorder]
+
+    @classmethod
+    def from_dataframe(cls, df, cellsize=0.1, usedates=False):
+        """
+        build an index over the target co-ordinates of a dataframe
+
+        Args:
+            df(pandas dataframe): missions with TGTLATDD_DDD_WGS84 and
+                                  TGTLONDDD_DDD_WGS84 columns
+            cellsize(float): width and height of a grid cell in degrees
+            usedates(bool): also index MSNDATE (cleaned dates) so queries
+                            can be limited to a date range
+
+        Returns:
+            index(SpatialIndex): the index
+        """
+        dates = None
+        if usedates:
+            dates = pd.to_datetime(df['MSNDATE']).to_numpy()
+        lats = pd.to_numeric(df['TGTLATDD_DDD_WGS84'], errors='coerce')
+        lons = pd.to_numeric(df['TGTLONDDD_DDD_WGS84'], errors='coerce')
+        return cls(
+            lats.to_numpy(dtype=float), lons.to_numpy(dtype=float),
+            dates, cellsize)
+
+    def cell_rows(self, lats):
+        """
+        grid row of some latitudes, clipped to the grid
+        """
+        rows = np.floor((lats - self.south) / self.cellsize)
+        return np.clip(rows, 0, self.nrows - 1).astype(np.int64)
+
+    def cell_cols(self, lons):
+        """
+        grid column of some longitudes, clipped to the grid
+        """
+        cols = np.floor((lons - self.west) / self.cellsize)
+        return np.clip(cols, 0, self.ncols - 1).astype(np.int64)
+
+    def cell_ids(self, lats, lons):
+        """
+        grid cell id of some points
+
+        Args:
+            lats(numpy array): latitudes in decimal degrees
+            lons(numpy array): longitudes in decimal degrees
+
+        Returns:
+            cells(numpy array): row * ncols + column of each point
+        """
+        return self.cell_rows(lats) * self.ncols + self.cell_cols(lons)
+
+    def candidates(self, north, south, east, west):
+        """
+        row positions of every point in the grid cells overlapping a box
+
+        Args:
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+
+        Returns:
+            positions(numpy array): row positions, may include points just
+                                    outside the box
+        """
+        if (not len(self.order) or north < self.south or
+                south > self.south + self.nrows * self.cellsize or
+                east < self.west or
+                west > self.west + self.ncols * self.cellsize):
+            return np.array([], dtype=np.int64)
+        firstcol = self.cell_cols(np.float64(west))
+        lastcol = self.cell_cols(np.float64(east))
+        rows = np.arange(
+            self.cell_rows(np.float64(south)),
+            self.cell_rows(np.float64(north)) + 1)
+        # the cells of one grid row are contiguous in the sorted order
+        starts = np.searchsorted(
+            self.sortedcells, rows * self.ncols + firstcol, side='left')
+        ends = np.searchsorted(
+            self.sortedcells, rows * self.ncols + lastcol, side='right')
+        lengths = ends - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.order[offsets + np.arange(lengths.sum())]
+
+    def finish(self, positions, daterange):
+        """
+        apply a date range and sort the row positions of a query
+
+        Args:
+            positions(numpy array): matching row positions
+            daterange(tuple): first and last date to include, None for all
+
+        Returns:
+            positions(numpy array): sorted row positions
+        """
+        if daterange is not None:
+            if self.dates is None:
+                raise ValueError('the index was built without dates')
+            first, last = (np.datetime64(pd.Timestamp(date), 'ns')
+                           for date in daterange)
+            dates = self.dates[positions]
+            positions = positions[(dates >= first) & (dates <= last)]
+        return np.sort(positions)
+
+    def query_bbox(self, north, south, east, west, daterange=None):
+        """
+        find the points inside a bounding box, edges included
+
+        Args:
+            north(float): northern edge in decimal degrees
+            south(float): southern edge in decimal degrees
+            east(float): eastern edge in decimal degrees
+            west(float): western edge in decimal degrees
+            daterange(tuple): first and last date to include, None for all
+
+        Returns:
+            positions(numpy array): sorted row positions of the points
+        """
+        positions = self.candidates(north, south, east, west)
+        inside = in_bbox(
+            self.lats[positions], self.lons[positions], north, south, east,
+            west)
+        return self.finish(positions[inside], daterange)
+
+    def query_radius(self, lat, lon, radiuskm, daterange=None):
+        """
+        find the points within a distance of a point
+
+        Args:
+            lat(float): latitude of the centre in decimal degrees
+            lon(float): longitude of the centre in decimal degrees
+            radiuskm(float): great circle distance in kilometres
+            daterange(tuple): first and last date to include, None for all
+
+        Returns:
+            positions(numpy array): sorted row positions of the points
+        """
+        dlat = np.degrees(radiuskm / EARTH_RADIUS_KM)
+        coslat = max(np.cos(np.radians(lat)), 1e-6)
+        dlon = min(dlat / coslat, 180.0)
+        positions = self.candidates(
+            lat + dlat, lat - dlat, lon + dlon, lon - dlon)
+        distances = haversine_km(
+            lat, lon, self.lats[positions], self.lons[positions])
+        return self.finish(positions[distances <= radiuskm], daterange)
+
+    def query_polygon(self, polygon, daterange=None):
+        """
+        find the points inside a polygon
+
+        Args:
+            polygon(list): (lon, lat) vertices of the polygon
+            daterange(tuple): first and last date to include, None for all
+
+        Returns:
+            positions(numpy array): sorted row positions of the points
+        """
+        vertices = np.asarray(polygon, dtype=float)
+        positions = self.candidates(
+            vertices[:, 1].max(), vertices[:, 1].min(),
+            vertices[:, 0].max(), vertices[:, 0].min())
+        inside = points_in_polygon(
+            self.lons[positions], self.lats[positions], vertices)
+        return self.finish(positions[inside], daterange)
+
+
+def in_bbox(lats, lons, north, south, east, west):
+    """
+    find the points inside a bounding box, edges included, in one pass
+    over every point
+
+    for a single query this is quicker than building a SpatialIndex, which
+    sorts every point, the index pays off over repeated queries
+
+    Args:
+        lats(numpy array): latitude of each point in decimal degrees
+        lons(numpy array): longitude of each point in decimal degrees
+        north(float): northern edge in decimal degrees
+        south(float): southern edge in decimal degrees
+        east(float): eastern edge in decimal degrees
+        west(float): western edge in decimal degrees
+
+    Returns:
+        inside(numpy array): True for each point inside the box, False for
+                             missing co-ordinates
+    """
+    return (
+        (lats >= south) & (lats <= north) & (lons >= west) & (lons <= east))
+
+
+def haversine_km(lat, lon, lats, lons):
+    """
+    great circle distance from one point to many
+
+    Args:
+        lat(float): latitude of the first point in decimal degrees
+        lon(float): longitude of the first point in decimal degrees
+        lats(numpy array): latitudes of the other points
+        lons(numpy array): longitudes of the other points
+
+    Returns:
+        distances(numpy array): distances in kilometres
+    """
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    dlat = lat2 - lat1
+    dlon = np.radians(lons) - np.radians(lon)
+    a = (np.sin(dlat / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def points_in_polygon(xs, ys, vertices):
+    """
+    even-odd test of many points against a polygon
+
+    Args:
+        xs(numpy array): x (longitude) of each point
+        ys(numpy array): y (latitude) of each point
+        vertices(numpy array): (x, y) vertices of the polygon
+
+    Returns:
+        inside(numpy array): boolean, True for points inside the polygon
+    """
+    inside = np.zeros(len(xs), dtype=bool)
+    x1, y1 = vertices[-1]
+    for x2, y2 in vertices:
+        crosses = (y1 > ys) != (y2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xcross = (x2 - x1) * (ys - y1) / (y2 - y1) + x1
+        inside ^= crosses & (xs < xcross)
+        x1, y1 = x2, y2
+    return inside
@@ -0,0 +1,271 @@
+"""
+create a tiled KML super-overlay of every mission in the Vietnam THOR dataset
+
+missions are split into a lat/lon quadtree over Indochina, each tile is its
+own KML file holding a sample of its missions and network links to its four
+child tiles, Google Earth only loads a tile when its region is big enough on
+screen so detail appears as you zoom in
+"""
+
+
+import concurrent.futures
+import os
+
+import numpy as np
+
+import dataset
+import instrument
+import kml
+import operationsmap
+import spatialindex
+
+
+def assign_tiles(lons, lats, bbox, maxpoints=500, maxdepth=8, seed=0):
+    """
+    assign each point to a tile of a quadtree
+
+    each tile keeps up to maxpoints points picked at random and passes the
+    rest down to its four children, so every point appears in exactly one
+    tile and zooming out still shows an even sample of the whole area
+    tiles at maxdepth keep all their remaining points
+
+    Args:
+        lons(numpy array): longitudes in decimal degrees
+        lats(numpy array): latitudes in decimal degrees
+        bbox(dict): north, south, east and west edges of the whole quadtree
+        maxpoints(int): maximum number of points kept in a tile that has
+                        children
+        maxdepth(int): the deepest level of the quadtree
+        seed(int): seed for the random sample kept in each tile
+
+    Returns:
+        tileids(numpy array): tile id of each point, see tile_from_id
+        tiles(dict): keys are tile ids, values are True if the tile
+                     has child tiles
+    """
+    scale = 2 ** maxdepth
+    width = bbox['east'] - bbox['west']
+    height = bbox['north'] - bbox['south']
+    ix = np.clip(
+        np.floor((lons - bbox['west']) / width * scale), 0, scale - 1)
+    iy = np.clip(
+        np.floor((lats - bbox['south']) / height * scale), 0, scale - 1)
+    ix = ix.astype(np.int64)
+    iy = iy.astype(np.int64)
+    tileids = np.zeros(len(lons), dtype=np.int64)
+    tiles = {}
+    rng = np.random.default_rng(seed)
+    unassigned = rng.permutation(len(lons))
+    for level in range(maxdepth + 1):
+        if not len(unassigned):
+            break
+        shift = maxdepth - level
+        keys = (
+            (ix[unassigned] >> shift) * (1 << level) +
+            (iy[unassigned] >> shift))
+        # a stable sort keeps the random order within each tile
+        order = np.argsort(keys, kind='stable')
+        sortedkeys = keys[order]
+        starts = np.flatnonzero(np.diff(sortedkeys, prepend=-1))
+        counts = np.diff(np.append(starts, len(sortedkeys)))
+        within = np.arange(len(sortedkeys)) - np.repeat(starts, counts)
+        if level == maxdepth:
+            keep = np.ones(len(sortedkeys), dtype=bool)
+        else:
+            keep = within < maxpoints
+        levelids = tile_id(level, sortedkeys)
+        tileids[unassigned[order[keep]]] = levelids[keep]
+        for tileid, count in zip(levelids[starts], counts):
+            tiles[int(tileid)] = bool(count > maxpoints and level < maxdepth)
+        unassigned = unassigned[order[~keep]]
+    return tileids, tiles
+
+
+def tile_id(level, key):
+    """
+    combine a quadtree level and the key of a tile within that level
+
+    Args:
+        level(int): quadtree level, 0 is the whole area
+        key(int or numpy array): x * 2 ** level + y
+
+    Returns:
+        tileid(int or numpy array): id unique across all levels
+    """
+    return (np.int64(level) << 48) + key
+
+
+def tile_from_id(tileid):
+    """
+    split a tile id back into its level and position
+
+    Args:
+        tileid(int): id made by tile_id
+
+    Returns:
+        level(int): quadtree level, 0 is the whole area
+        x(int): column of the tile counting from the west
+        y(int): row of the tile counting from the south
+    """
+    level = tileid >> 48
+    key = tileid - (level << 48)
+    return level, key >> level, key & ((1 << level) - 1)
+
+
+def tile_bounds(bbox, level, x, y):
+    """
+    get the edges of a tile
+
+    Args:
+        bbox(dict): north, south, east and west edges of the whole quadtree
+        level(int): quadtree level, 0 is the whole area
+        x(int): column of the tile counting from the west
+        y(int): row of the tile counting from the south
+
+    Returns:
+        bounds(dict): north, south, east and west edges of the tile
+    """
+    width = (bbox['east'] - bbox['west']) / 2 ** level
+    height = (bbox['north'] - bbox['south']) / 2 ** level
+    bounds = {
+        'north': bbox['south'] + (y + 1) * height,
+        'south': bbox['south'] + y * height,
+        'east': bbox['west'] + (x + 1) * width,
+        'west': bbox['west'] + x * width}
+    return bounds
+
+
+def tile_filename(level, x, y):
+    """
+    name of the KML file for a tile
+
+    Args:
+        level(int): quadtree level, 0 is the whole area
+        x(int): column of the tile counting from the west
+        y(int): row of the tile counting from the south
+
+    Returns:
+        filename(str): the tile filename, the top tile is doc.kml
+    """
+    if level == 0:
+        return 'doc.kml'
+    return 'tile-{}-{}-{}.kml'.format(level, x, y)
+
+
+def write_tile(tilepath, bounds, links, missions, batchsize=50000):
+    """
+    write the KML file for one tile
+
+    Args:
+        tilepath(str): path to write the tile to
+        bounds(dict): edges of the tile, None for the top tile which is
+                      always shown
+        links(list): (name, filename, bounds) of each child tile
+        missions(pandas dataframe): the missions to place in this tile
+        batchsize(int): number of placemarks to build at a time
+    """
+    with kml.KMLOutputParser(tilepath, stream=True) as kmlmap:
+        kmlmap.create_kml_header()
+        if bounds is not None:
+            kmlmap.add_region(**bounds)
+        for start in range(0, len(missions), batchsize):
+            operationsmap.add_mission_placemarks(
+                kmlmap, missions.iloc[start:start + batchsize])
+        for linkname, href, linkbounds in links:
+            kmlmap.add_network_link(linkname, href, **linkbounds)
+
+
+def create_super_overlay(outputdir, df, bbox=spatialindex.INDOCHINA,
+                         maxpoints=500, maxdepth=8, workers=None):
+    """
+    write a quadtree of KML tiles for a dataframe of missions
+
+    missions outside bbox are left out, the tiles are written in parallel
+    open doc.kml in the output directory in Google Earth
+
+    Args:
+        outputdir(str): directory to write the tiles to
+        df(pandas dataframe): the missions to map, with cleaned dates
+                              and co-ordinates
+        bbox(dict): north, south, east and west edges of the map
+        maxpoints(int): maximum number of placemarks in a tile that has
+                        children
+        maxdepth(int): the deepest level of the quadtree
+        workers(int): number of processes, defaults to the number of cores
+
+    Returns:
+        tilecount(int): number of tiles written
+    """
+    lons = df['TGTLONDDD_DDD_WGS84'].to_numpy(dtype=float)
+    lats = df['TGTLATDD_DDD_WGS84'].to_numpy(dtype=float)
+    inside = (
+        (lons >= bbox['west']) & (lons <= bbox['east']) &
+        (lats >= bbox['south']) & (lats <= bbox['north']))
+    missions = df[inside].drop(operationsmap.COLS2DROP, axis=1)
+    tileids, tiles = assign_tiles(
+        lons[inside], lats[inside], bbox, maxpoints, maxdepth)
+    os.makedirs(outputdir, exist_ok=True)
+    bytile = missions.groupby(tileids, sort=False)
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = []
+        for tileid, haschildren in tiles.items():
+            level, x, y = tile_from_id(tileid)
+            links = []
+            if haschildren:
+                for childx in (2 * x, 2 * x + 1):
+                    for childy in (2 * y, 2 * y + 1):
+                        childkey = childx * 2 ** (level + 1) + childy
+                        if int(tile_id(level + 1, childkey)) not in tiles:
+                            continue
+                        links.append((
+                            '{}-{}-{}'.format(level + 1, childx, childy),
+                            tile_filename(level + 1, childx, childy),
+                            tile_bounds(bbox, level + 1, childx, childy)))
+            bounds = None if level == 0 else tile_bounds(bbox, level, x, y)
+            tilepath = os.path.join(outputdir, tile_filename(level, x, y))
+            futures.append(pool.submit(
+                write_tile, tilepath, bounds, links,
+                bytile.get_group(tileid)))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    return len(tiles)
+
+
+def main(filename='thor_data_vietnam.csv'):
+    """
+    main program code
+
+    load dataset
+    clean the mission dates
+    recover missing LAT LON co-ords from the original co-ords
+    remove missions with no LAT LON co-ords
+    create the tiled map of the whole war
+
+    Args:
+        filename(str): path to the dataset CSV file
+    """
+    with instrument.stage('load') as timer:
+        df = dataset.load_dataset(filename)
+        timer.rowsout = len(df)
+    with instrument.stage('clean dates', rowsin=len(df)) as timer:
+        df['MSNDATE'], invalid, rejected = dataset.clean_dates(
+            df['MSNDATE'], as_strings=True)
+        print('removing {} missions with invalid dates {}'.format(
+            invalid.sum(), rejected))
+        df = df[~invalid]
+        timer.rowsout = len(df)
+    with instrument.stage('recover missing co-ords', rowsin=len(df)):
+        df, decoded = dataset.fill_missing_coords(df)
+        print('recovered missing co-ords from TGTORIGCOORDS {}'.format(
+            decoded))
+    with instrument.stage('drop missing co-ords', rowsin=len(df)) as timer:
+        df = df.dropna(subset=['TGTLONDDD_DDD_WGS84', 'TGTLATDD_DDD_WGS84'])
+        timer.rowsout = len(df)
+    print('creating tiled map of {} missions'.format(len(df)))
+    with instrument.stage('write tiles', rowsin=len(df)):
+        tilecount = create_super_overlay('Whole War Map', df)
+    print('wrote {} tiles to Whole War Map/doc.kml'.format(tilecount))
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
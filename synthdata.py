@@ -0,0 +1,406 @@
+"""
+generate synthetic CSVs shaped like the Vietnam War THOR dataset
+
+the real thor_data_vietnam.csv is not part of the repository, this writes
+stand-ins with the same 47 columns so the scripts can be run and timed
+reproducibly at any size
+categorical values and their frequencies come from the committed Tallys,
+aircraft type and mission type are drawn together from the committed
+frequency table so they stay consistent, mission dates follow the real
+number of missions per day and target co-ordinates are clustered around
+each target country
+many missions have several records and a few records are duplicated, so
+rollup.py has missions to group
+columns we never tally are drawn from the rows in Mission Subsets
+"""
+
+
+import argparse
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+import rollup
+import spatialindex
+import tallyfields
+
+
+TALLYDIR = 'Tallys'
+
+FREQUENCYDIR = 'Frequency Tables'
+
+SUBSETS = [
+    os.path.join('Mission Subsets', 'Operation Linebacker 2.csv'),
+    os.path.join('Mission Subsets', 'Australian-missions.csv')]
+
+COLUMNS = [
+    'THOR_DATA_VIET_ID', 'COUNTRYFLYINGMISSION', 'MILSERVICE', 'MSNDATE',
+    'SOURCEID', 'SOURCERECORD', 'VALID_AIRCRAFT_ROOT', 'TAKEOFFLOCATION',
+    'TGTLATDD_DDD_WGS84', 'TGTLONDDD_DDD_WGS84', 'TGTTYPE',
+    'NUMWEAPONSDELIVERED', 'TIMEONTARGET', 'WEAPONTYPE', 'WEAPONTYPECLASS',
+    'WEAPONTYPEWEIGHT', 'AIRCRAFT_ORIGINAL', 'AIRCRAFT_ROOT',
+    'AIRFORCEGROUP', 'AIRFORCESQDN', 'CALLSIGN', 'FLTHOURS', 'MFUNC',
+    'MFUNC_DESC', 'MISSIONID', 'NUMOFACFT', 'OPERATIONSUPPORTED',
+    'PERIODOFDAY', 'UNIT', 'TGTCLOUDCOVER', 'TGTCONTROL', 'TGTCOUNTRY',
+    'TGTID', 'TGTORIGCOORDS', 'TGTORIGCOORDSFORMAT', 'TGTWEATHER',
+    'ADDITIONALINFO', 'GEOZONE', 'ID', 'MFUNC_DESC_CLASS',
+    'NUMWEAPONSJETTISONED', 'NUMWEAPONSRETURNED', 'RELEASEALTITUDE',
+    'RELEASEFLTSPEED', 'RESULTSBDA', 'TIMEOFFTARGET', 'WEAPONSLOADEDWEIGHT']
+
+# number of rows in the real dataset, every mission has a kinetic class
+TOTAL_MISSIONS = 4670416
+
+SIZES = {'10k': 10000, '1m': 1000000, '5m': 5000000}
+
+# rough centre and spread in degrees of the targets in each country
+TARGETS = {
+    'NORTH VIETNAM': (20.5, 105.8, 0.8),
+    'SOUTH VIETNAM': (12.5, 107.5, 1.5),
+    'LAOS': (17.0, 105.5, 1.2),
+    'CAMBODIA': (12.3, 105.0, 0.8),
+    'THAILAND': (15.5, 101.5, 1.5),
+    'WESTPAC WATERS': (17.5, 108.5, 0.8)}
+
+MISSINGCOORDS = 0.03
+
+IMPLIEDDECIMAL = 0.1
+
+# fraction of records that are another record of an earlier mission, e.g.
+# for a second target or weapon
+MULTIRECORD = 0.4
+
+# fraction of records that repeat an earlier record from another source
+DUPLICATERECORDS = 0.02
+
+# fraction of the further records of a mission with the date spelled
+# yyyymmdd instead of yyyy-mm-dd
+RESPELLED = 0.1
+
+# columns that differ between every record, even duplicates
+RECORDIDS = ['THOR_DATA_VIET_ID', 'ID', 'SOURCEID']
+
+
+def load_tally(field):
+    """
+    read the values of a field and how often each one occurs
+
+    Args:
+        field(str): name of the tally, a key of tallyfields.FIELDS
+
+    Returns:
+        values(numpy array): the values as strings
+        counts(numpy array): the number of missions with each value
+    """
+    tally = pd.read_csv(
+        os.path.join(TALLYDIR, '{}-tally.csv'.format(field)),
+        dtype={field: str}, keep_default_na=False)
+    return tally[field].to_numpy(dtype=object), tally['Count'].to_numpy()
+
+
+def with_missing(values, counts, total=TOTAL_MISSIONS):
+    """
+    add a missing value for the missions a tally does not count
+
+    Args:
+        values(numpy array): the tallied values
+        counts(numpy array): the number of missions with each value
+        total(int): number of missions in the dataset
+
+    Returns:
+        values(numpy array): the values with NaN appended
+        probabilities(numpy array): the chance of each value
+    """
+    counts = np.append(counts, max(total - counts.sum(), 0))
+    values = np.append(values, np.nan)
+    return values, counts / counts.sum()
+
+
+def load_profile():
+    """
+    gather everything needed to generate missions
+
+    Returns:
+        profile(dict): value pools and probabilities for the generator
+    """
+    profile = {'tallies': {}}
+    joint = set(['VALID_AIRCRAFT_ROOT', 'MFUNC_DESC', 'MFUNC_DESC_CLASS'])
+    for field, column in tallyfields.FIELDS.items():
+        if column in joint:
+            continue
+        values, counts = load_tally(field)
+        profile['tallies'][column] = with_missing(values, counts)
+
+    # aircraft and mission type pairs, plus the aircraft whose missions
+    # have no mission type
+    aircraft, aircraftcounts = load_tally('Aircraft Type')
+    pairs = pd.read_csv(
+        os.path.join(
+            FREQUENCYDIR, 'aircrafttype_to_missiontype_frequency_table.csv'),
+        index_col=0, keep_default_na=False)
+    pairs.index = pairs.index.astype(str)
+    pairs = pairs.reindex(aircraft, fill_value=0)
+    untyped = aircraftcounts - pairs.sum(axis=1).to_numpy()
+    counts = np.column_stack([pairs.to_numpy(), np.clip(untyped, 0, None)])
+    missiontypes = np.append(pairs.columns.to_numpy(dtype=object), np.nan)
+    rows, columns = np.nonzero(counts)
+    counts = counts[rows, columns]
+    profile['pairs'] = (
+        aircraft[rows], missiontypes[columns], counts / counts.sum())
+
+    # each mission type is always kinetic or always non kinetic
+    kinetic = pd.read_csv(
+        os.path.join(
+            FREQUENCYDIR, 'missiontype_to_kinetic_frequency_table.csv'),
+        index_col=0, keep_default_na=False)
+    profile['classes'] = kinetic.idxmax(axis=1).to_dict()
+    classes, classcounts = load_tally('Kinetic OR Non Kinetic')
+    untypedcounts = classcounts - kinetic.sum().reindex(classes).to_numpy()
+    untypedcounts = np.clip(untypedcounts, 0, None)
+    profile['untypedclasses'] = (classes, untypedcounts / untypedcounts.sum())
+
+    # the rows we have supply the columns that are never tallied
+    subsets = pd.concat(
+        [pd.read_csv(subset, index_col=0, low_memory=False)
+         for subset in SUBSETS],
+        ignore_index=True)
+    # invent codes for the mission types we have no rows for
+    codes = subsets[['MFUNC_DESC', 'MFUNC']].dropna().drop_duplicates(
+        'MFUNC_DESC')
+    profile['mfunc'] = {
+        missiontype: 100.0 + position
+        for position, missiontype in enumerate(pairs.columns)}
+    profile['mfunc'].update(zip(codes['MFUNC_DESC'], codes['MFUNC']))
+    profile['subsets'] = subsets
+    return profile
+
+
+def choose(rng, values, probabilities, size):
+    """
+    draw values at random with the given probabilities
+
+    Args:
+        rng(numpy generator): random number generator
+        values(numpy array): the values to draw from
+        probabilities(numpy array): the chance of each value
+        size(int): number of values to draw
+
+    Returns:
+        chosen(numpy array): the drawn values
+    """
+    return values[rng.choice(len(values), size=size, p=probabilities)]
+
+
+def degrees_minutes_seconds(degrees, width):
+    """
+    format decimal degrees as zero padded DDDMMSS strings
+
+    Args:
+        degrees(numpy array): positive decimal degrees
+        width(int): number of digits for the whole degrees
+
+    Returns:
+        text(pandas series): the formatted co-ordinates
+    """
+    seconds = np.rint(degrees * 3600).astype(np.int64)
+    packed = seconds // 3600 * 10000 + seconds // 60 % 60 * 100 + seconds % 60
+    return pd.Series(packed).astype(str).str.zfill(width + 4)
+
+
+def implied_decimal(degrees, width):
+    """
+    format decimal degrees as DDDdddd strings with an implied decimal point
+
+    Args:
+        degrees(numpy array): positive decimal degrees
+        width(int): number of digits for the whole degrees
+
+    Returns:
+        text(pandas series): the formatted co-ordinates
+    """
+    tenthousandths = np.rint(degrees * 10000).astype(np.int64)
+    return pd.Series(tenthousandths).astype(str).str.zfill(width + 4)
+
+
+def target_coordinates(rng, countries):
+    """
+    place targets around the country they are in
+
+    Args:
+        rng(numpy generator): random number generator
+        countries(numpy array): target country of each mission
+
+    Returns:
+        lats(numpy array): latitude in decimal degrees
+        lons(numpy array): longitude in decimal degrees
+    """
+    bbox = spatialindex.INDOCHINA
+    size = len(countries)
+    lats = rng.uniform(bbox['south'], bbox['north'], size)
+    lons = rng.uniform(bbox['west'], bbox['east'], size)
+    for country, (lat, lon, spread) in TARGETS.items():
+        incountry = np.flatnonzero(countries == country)
+        lats[incountry] = rng.normal(lat, spread, len(incountry))
+        lons[incountry] = rng.normal(lon, spread, len(incountry))
+    lats = np.clip(lats, bbox['south'], bbox['north'])
+    lons = np.clip(lons, bbox['west'], bbox['east'])
+    return lats, lons
+
+
+def repeat_records(df, nrows, rng):
+    """
+    make some records further records of an earlier mission, with the
+    same rollup.KEYS['mission'], and some duplicates of an earlier record
+
+    the earlier records are in the same block
+
+    Args:
+        df(dict): numpy array of each column, changed in place
+        nrows(int): number of records
+        rng(numpy generator): random number generator
+    """
+    duplicatecolumns = [
+        column for column in COLUMNS if column not in RECORDIDS]
+    for fraction, columns in ((MULTIRECORD, rollup.KEYS['mission']),
+                              (DUPLICATERECORDS, duplicatecolumns)):
+        rows = np.flatnonzero(rng.random(nrows) < fraction)
+        rows = rows[rows > 0]
+        earlier = (rng.random(len(rows)) * rows).astype(np.int64)
+        for column in columns:
+            values = np.array(df[column])
+            values[rows] = values[earlier]
+            df[column] = values
+        if fraction == MULTIRECORD:
+            respelled = rows[rng.random(len(rows)) < RESPELLED]
+            df['MSNDATE'][respelled] = pd.Series(
+                df['MSNDATE'][respelled]).str.replace(
+                    '-', '', regex=False).to_numpy()
+
+
+def generate_chunk(profile, start, nrows, rng):
+    """
+    generate a block of synthetic missions
+
+    Args:
+        profile(dict): from load_profile
+        start(int): number of missions generated before this block
+        nrows(int): number of missions to generate
+        rng(numpy generator): random number generator
+
+    Returns:
+        df(pandas dataframe): the missions with the COLUMNS of the dataset
+    """
+    df = {}
+    for column, (values, probabilities) in profile['tallies'].items():
+        df[column] = choose(rng, values, probabilities, nrows)
+
+    aircraft, missiontypes, probabilities = profile['pairs']
+    picks = rng.choice(len(probabilities), size=nrows, p=probabilities)
+    df['VALID_AIRCRAFT_ROOT'] = aircraft[picks]
+    df['MFUNC_DESC'] = missiontypes[picks]
+    missiontypes = pd.Series(df['MFUNC_DESC'])
+    classes = missiontypes.map(profile['classes']).to_numpy(dtype=object)
+    untyped = missiontypes.isna().to_numpy()
+    classes[untyped] = choose(
+        rng, *profile['untypedclasses'], size=untyped.sum())
+    df['MFUNC_DESC_CLASS'] = classes
+    df['MFUNC'] = missiontypes.map(profile['mfunc']).to_numpy(dtype=float)
+    aircraftroot = pd.Series(df['VALID_AIRCRAFT_ROOT']).str.replace(
+        '-', '', regex=False)
+    df['AIRCRAFT_ORIGINAL'] = aircraftroot.to_numpy(dtype=object)
+    df['AIRCRAFT_ROOT'] = aircraftroot.to_numpy(dtype=object)
+
+    lats, lons = target_coordinates(rng, df['TGTCOUNTRY'])
+    impliedformat = rng.random(nrows) < IMPLIEDDECIMAL
+    dms = (degrees_minutes_seconds(lats, 2) + 'N' +
+           degrees_minutes_seconds(lons, 3) + 'E')
+    decimal = (implied_decimal(lats, 2) + 'N' +
+               implied_decimal(lons, 3) + 'E')
+    df['TGTORIGCOORDS'] = dms.where(~impliedformat, decimal).to_numpy()
+    df['TGTORIGCOORDSFORMAT'] = np.where(
+        impliedformat, 'DD.DDDDN DDD.DDDDE',
+        'DDMMSSN DDDMMSSE').astype(object)
+    # some missions lost their converted co-ordinates but kept the
+    # originals, others have neither
+    missing = rng.random(nrows) < MISSINGCOORDS
+    lats[missing] = np.nan
+    lons[missing] = np.nan
+    df['TGTLATDD_DDD_WGS84'] = np.round(lats, 6)
+    df['TGTLONDDD_DDD_WGS84'] = np.round(lons, 6)
+    noorig = missing & (rng.random(nrows) < 0.5)
+    df['TGTORIGCOORDS'][noorig] = np.nan
+    df['TGTORIGCOORDSFORMAT'][noorig] = np.nan
+
+    rowids = np.arange(start + 1, start + nrows + 1)
+    df['THOR_DATA_VIET_ID'] = rowids
+    df['ID'] = rowids + 27000000
+    df['SOURCEID'] = rng.integers(1, 1000000, nrows)
+    letters = np.array(list(string.ascii_uppercase + string.digits))
+    missionids = letters[rng.integers(0, len(letters), (nrows, 4))]
+    df['MISSIONID'] = missionids.view('<U4').ravel().astype(object)
+
+    # every other column is drawn row by row from the mission subsets
+    subsets = profile['subsets']
+    rows = rng.integers(0, len(subsets), nrows)
+    for column in COLUMNS:
+        if column not in df:
+            df[column] = subsets[column].to_numpy()[rows]
+    repeat_records(df, nrows, rng)
+    callsigns = pd.Series(df['CALLSIGN']).fillna('').astype(str)
+    df['ADDITIONALINFO'] = (
+        'UNIT: ' + pd.Series(df['UNIT']).fillna('').astype(str) +
+        ' - CALLSIGN: ' + callsigns).to_numpy()
+    return pd.DataFrame(df, columns=COLUMNS)
+
+
+def write_synthetic(filename, nrows, chunksize=250000, seed=0):
+    """
+    write a synthetic THOR CSV of any size
+
+    rows are generated and written in chunks so memory use stays bounded
+
+    Args:
+        filename(str): path of the CSV to write
+        nrows(int): number of missions
+        chunksize(int): number of missions to generate at a time
+        seed(int): random seed, the same seed and size give the same file
+    """
+    profile = load_profile()
+    rng = np.random.default_rng(seed)
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    print('writing {} synthetic missions to {}'.format(nrows, filename))
+    with open(filename, 'w', newline='') as f:
+        for start in range(0, nrows, chunksize):
+            chunk = generate_chunk(
+                profile, start, min(chunksize, nrows - start), rng)
+            chunk.to_csv(f, header=start == 0, index=False)
+
+
+def main():
+    """
+    main program code
+
+    write a synthetic dataset for each size asked for on the command line
+    """
+    parser = argparse.ArgumentParser(
+        description='generate synthetic THOR-shaped CSV files')
+    parser.add_argument(
+        'sizes', nargs='*', default=['10k'],
+        help='number of rows or one of {}'.format(', '.join(SIZES)))
+    parser.add_argument('--outputdir', default='synthetic')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for size in args.sizes:
+        nrows = SIZES.get(size.lower())
+        if nrows is None:
+            nrows = int(size)
+        filename = os.path.join(
+            args.outputdir, 'thor_synthetic_{}.csv'.format(size.lower()))
+        write_synthetic(filename, nrows, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
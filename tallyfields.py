@@ -8,8 +8,18 @@ Thomas Whittam
 """
 
 
+import concurrent.futures
+import os
+
 import pandas as pd
 
+import crosstabs
+import cube
+import dataset
+import export
+import instrument
+import rollup
+
 
 FIELDS = {
     'Military Service': 'MILSERVICE',
@@ -24,44 +34,223 @@ FIELDS = {
     'Weapon Type': 'WEAPONTYPE',
     'Mission Date': 'MSNDATE'}
 
+FREQUENCY_TABLES = {
+    'mission type to Kinetic/Non Kinetic': {
+        'index': 'MFUNC_DESC', 'columns': 'MFUNC_DESC_CLASS',
+        'filename': 'missiontype_to_kinetic_frequency_table.csv'},
+    'aircraft type to mission type': {
+        'index': 'VALID_AIRCRAFT_ROOT', 'columns': 'MFUNC_DESC',
+        'filename': 'aircrafttype_to_missiontype_frequency_table.csv'}}
+
+
+def count_chunk(chunk):
+    """
+    count the values of every column in a chunk of the dataset
+
+    Args:
+        chunk(pandas dataframe): the rows to count
+
+    Returns:
+        counts(dict): keys are column names, values are pandas series of
+                      the number of times each value appears
+    """
+    counts = {}
+    for column in chunk.columns:
+        count = chunk[column].value_counts(sort=False)
+        count.index = count.index.astype(object)
+        counts[column] = count[count > 0]
+    return counts
+
 
-def frequency_tables(df):
+def count_row_group(cachefile, rowgroup, columns):
     """
-    generate frequency tables for:
-      mission type to whether mission is Kinetic or Non Kinetic
-      aircraft type to mission type
+    read one row group of the columnar cache and count its values, called
+    in a worker process
+
+    Args:
+        cachefile(str): path to the columnar cache
+        rowgroup(int): number of the row group
+        columns(list): the columns to count
+
+    Returns:
+        counts(dict): see count_chunk
+    """
+    return count_chunk(dataset.read_row_group(cachefile, rowgroup, columns))
+
+
+def tally_fields(filename, columns, chunksize=250000, workers=None):
+    """
+    count the values of several columns in one pass over the dataset
+
+    each worker process reads and counts its own row groups of the
+    columnar cache, so only the small counts are sent between processes,
+    then the counts are merged
+    without pyarrow the CSV is read and counted here in chunks
+
+    Args:
+        filename(str): path to the dataset CSV file
+        columns(list): the columns to count
+        chunksize(int): maximum number of rows in each chunk of the CSV
+        workers(int): number of processes, defaults to the number of cores,
+                      1 counts in this process
+
+    Returns:
+        tallys(dict): keys are column names, values are pandas series of
+                      counts sorted by value, like df.groupby(column).size()
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tallys = {column: pd.Series(dtype='int64') for column in columns}
+
+    def merge(counts):
+        for column, count in counts.items():
+            tallys[column] = tallys[column].add(count, fill_value=0)
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        for chunk in dataset.iter_dataset(filename, columns, chunksize):
+            merge(count_chunk(chunk))
+    else:
+        if not dataset.cache_is_current(filename):
+            dataset.build_cache(filename)
+        cachefile = dataset.cache_paths(filename)[0]
+        rowgroups = range(dataset.open_cache(cachefile).num_row_groups)
+        if workers == 1 or len(rowgroups) <= 1:
+            for rowgroup in rowgroups:
+                merge(count_row_group(cachefile, rowgroup, columns))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    min(workers, len(rowgroups))) as pool:
+                futures = [
+                    pool.submit(count_row_group, cachefile, rowgroup, columns)
+                    for rowgroup in rowgroups]
+                for future in concurrent.futures.as_completed(futures):
+                    merge(future.result())
+    for column in columns:
+        tally = tallys[column].astype('int64').sort_index()
+        tally.index.name = column
+        tallys[column] = tally
+    return tallys
+
+
+def frequency_tables(df, weights=None, allpairs=False):
+    """
+    generate the FREQUENCY_TABLES
+
+    every table is made in one pass over integer codes of the fields, with
+    allpairs the tables of every pair of FIELDS are also written along with
+    how strongly each pair is associated
 
     Args:
         df(pandas dataframe): dataframe to make frequency tables from
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the cube, None counts the rows
+        allpairs(bool): also write a table for every pair of FIELDS
     """
-    print('creating mission type to Kinetic/Non Kinetic frequency table')
-    missiontype2kinetic = pd.crosstab(df.MFUNC_DESC, df.MFUNC_DESC_CLASS)
-    missiontype2kineticcsv = missiontype2kinetic.to_csv(header=True)
-    with open('missiontype_to_kinetic_frequency_table.csv', 'w') as f:
-        f.write(missiontype2kineticcsv)
-    print('creating aircraft type to mission type frequency table')
-    aircraft2mission = pd.crosstab(df.VALID_AIRCRAFT_ROOT, df.MFUNC_DESC)
-    aircraft2missioncsv = aircraft2mission.to_csv(header=True)
-    with open('aircrafttype_to_missiontype_frequency_table.csv', 'w') as f2:
-        f2.write(aircraft2missioncsv)
-
-
-def main():
+    pairs = [
+        (spec['index'], spec['columns'])
+        for spec in FREQUENCY_TABLES.values()]
+    if allpairs:
+        pairs += [
+            pair for pair in crosstabs.all_pairs(list(FIELDS.values()))
+            if pair not in pairs]
+    tables = crosstabs.crosstab_pairs(df, pairs, weights)
+    for name, spec in FREQUENCY_TABLES.items():
+        print('creating {} frequency table'.format(name))
+        table = tables[(spec['index'], spec['columns'])]
+        if isinstance(table, pd.Series):
+            table = table.unstack(fill_value=0)
+        export.write_table(table, spec['filename'])
+    if allpairs:
+        write_all_pairs(tables)
+
+
+def write_all_pairs(tables):
+    """
+    write a frequency table of every pair of FIELDS and a summary of how
+    strongly each pair is associated
+
+    sparse tables are written as one line per non-empty cell
+
+    Args:
+        tables(dict): keys are pairs of columns, values are frequency tables
+                      from crosstabs.crosstab_pairs
+    """
+    names = {column: field for field, column in FIELDS.items()}
+    print('creating frequency tables of every pair of fields')
+    for (index, columns), table in tables.items():
+        if isinstance(table, pd.Series):
+            table = table.rename('Count')
+        export.write_table(table, '{} by {}-crosstab.csv'.format(
+            names[index], names[columns]))
+    print('measuring association between every pair of fields')
+    associations = crosstabs.association_table(tables)
+    associations.index = associations.index.map(
+        lambda pair: (names[pair[0]], names[pair[1]]))
+    export.write_table(associations, 'field-associations.csv')
+
+
+def main(usecube=False, allpairs=False, missions=False,
+         missionkey=None, duplicatekey=None,
+         filename='thor_data_vietnam.csv'):
     """
     main program code
+
+    Args:
+        usecube(bool): answer from the aggregate cube instead of counting
+                       the raw missions
+        allpairs(bool): also write a frequency table of every pair of
+                        FIELDS and how strongly each pair is associated
+        missions(bool): count the missions in the rollup.py mission table
+                        instead of the source records
+        missionkey(list): columns identifying a mission, defaults to
+                          rollup.KEYS['mission']
+        duplicatekey(list): columns identifying a duplicate record,
+                            defaults to rollup.KEYS['duplicate']
+        filename(str): path to the dataset CSV file
     """
-    filename = 'thor_data_vietnam.csv'
-    df = pd.read_csv(filename)
-    for field in FIELDS:
-        print('counting values for - {}'.format(field))
-        count = df.groupby(FIELDS[field]).size()
-        header = '{},Count\n'.format(field)
-        countcsv = count.to_csv()
-        with open(field + '-tally.csv', 'w') as f:
-            f.write(header)
-            f.write(countcsv)
-    frequency_tables(df)
+    if usecube and missions:
+        raise ValueError('the cube counts records, not missions')
+    print('counting values for - {}'.format(', '.join(FIELDS)))
+    if usecube:
+        with instrument.stage('load cube'):
+            missioncube = cube.load_cube(filename)
+        with instrument.stage('tally', rowsin=len(missioncube)):
+            tallys = {
+                column: cube.query_cube(missioncube, [column])
+                for column in FIELDS.values()}
+    elif missions:
+        with instrument.stage('load missions') as timer:
+            df = rollup.load_missions(
+                filename, missionkey, duplicatekey)
+            timer.rowsout = len(df)
+        with instrument.stage('tally', rowsin=len(df)):
+            tallys = {
+                column: df.groupby(column, observed=True).size()
+                for column in FIELDS.values()}
+    else:
+        with instrument.stage('tally'):
+            tallys = tally_fields(filename, list(FIELDS.values()))
+    with instrument.stage('write tallies'):
+        for field in FIELDS:
+            print('writing tally for - {}'.format(field))
+            count = tallys[FIELDS[field]].rename_axis(field).rename('Count')
+            export.write_table(count, field + '-tally.csv')
+    if usecube:
+        with instrument.stage('crosstabs', rowsin=len(missioncube)):
+            frequency_tables(missioncube, weights='COUNT', allpairs=allpairs)
+        return
+    if not missions:
+        columns = ['MFUNC_DESC', 'MFUNC_DESC_CLASS', 'VALID_AIRCRAFT_ROOT']
+        if allpairs:
+            columns = list(FIELDS.values())
+        with instrument.stage('load') as timer:
+            df = dataset.load_dataset(filename, columns=columns)
+            timer.rowsout = len(df)
+    with instrument.stage('crosstabs', rowsin=len(df)):
+        frequency_tables(df, allpairs=allpairs)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)
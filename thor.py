@@ -0,0 +1,577 @@
+"""
+one command line for the whole analysis of the Vietnam War THOR dataset
+
+the analysis is a graph of stages, each runs once its upstream stages have
+finished and independent stages run at the same time:
+
+    load -> clean -> clusters, apriori, maps
+    load -> aggregate -> pies, tally, timeseries
+    load -> rollup -> tally, timeseries when they count missions
+    load -> density
+
+every stage is keyed by a hash of the dataset's contents, the stage's
+parameters, the source code of the modules it uses and the keys of its
+upstream stages, a stage whose key has not changed since it last ran is
+skipped, so editing one chart only re-runs that chart's stage
+each stage writes its files to its own directory under the output
+directory and only imports the modules it runs, and the dataset's
+signature is checked with cachefiles, so listing the stages or skipping
+unchanged ones never loads pandas, e.g.
+
+    python thor.py run
+    python thor.py run pies timeseries --set pies.imageformat=svg
+    python thor.py list
+"""
+
+
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import cachefiles
+import instrument
+
+
+OUTPUTDIR = 'Output'
+
+STATEDIR = '.pipeline'
+
+STAGES = {
+    'load': {
+        'after': [], 'modules': ['dataset', 'cachefiles'], 'params': {}},
+    'clean': {
+        'after': ['load'], 'modules': ['dataset'], 'params': {}},
+    'aggregate': {
+        'after': ['load'], 'modules': ['dataset', 'cube'], 'params': {}},
+    'rollup': {
+        'after': ['load'],
+        'modules': ['rollup', 'dataset', 'cube', 'export'],
+        'params': {'missionkey': None, 'duplicatekey': None}},
+    'tally': {
+        'after': ['aggregate'], 'after_if': {'missions': ['rollup']},
+        'modules': ['tallyfields', 'crosstabs', 'cube', 'rollup', 'export'],
+        'params': {'allpairs': False, 'missions': False}},
+    'pies': {
+        'after': ['aggregate'], 'modules': ['piecharts', 'charts', 'cube'],
+        'params': {'imageformat': 'png'}},
+    'timeseries': {
+        'after': ['aggregate'], 'after_if': {'missions': ['rollup']},
+        'modules': ['timeseries', 'charts', 'cube', 'rollup'],
+        'params': {'imageformat': 'png', 'missions': False}},
+    'clusters': {
+        'after': ['clean'],
+        'modules': ['geoclusters', 'spatialindex', 'kml'],
+        'params': {'engine': 'kmeans'}},
+    'apriori': {
+        'after': ['clean'], 'modules': ['apriori'],
+        'params': {'min_support': 0.1, 'min_confidence': 0.5,
+                   'engine': 'apriori', 'segmentby': None}},
+    'maps': {
+        'after': ['clean'],
+        'modules': ['operationsmap', 'spatialindex', 'kml', 'export'],
+        'params': {}},
+    'density': {
+        'after': ['load'],
+        'modules': ['densitymap', 'spatialindex', 'kml'],
+        'params': {'weights': None, 'splitby': None, 'animate': None}},
+}
+
+
+def run_load(filename):
+    """
+    build the columnar cache of the dataset
+    """
+    import dataset
+    dataset.load_dataset(filename, columns=['MSNDATE'])
+
+
+def run_clean(filename):
+    """
+    check the mission dates and co-ordinates and report what is dropped
+    and which missing co-ordinates can be recovered
+    """
+    import dataset
+    df = dataset.load_dataset(
+        filename,
+        columns=[
+            'MSNDATE', 'TGTLATDD_DDD_WGS84', 'TGTLONDDD_DDD_WGS84',
+            'TGTORIGCOORDS', 'TGTORIGCOORDSFORMAT'])
+    dates, invalid, rejected = dataset.clean_dates(df['MSNDATE'])
+    nocoords = (
+        df['TGTLATDD_DDD_WGS84'].isna() | df['TGTLONDDD_DDD_WGS84'].isna())
+    decoded = dataset.fill_missing_coords(df)[1]
+    report = {
+        'missions': len(df),
+        'invalid_dates': rejected,
+        'missing_coords': int(nocoords.sum()),
+        'recovered_coords': decoded,
+        'first_date': str(dates.min().date()),
+        'last_date': str(dates.max().date())}
+    with open('cleaning-report.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def run_aggregate(filename):
+    """
+    build the aggregate cube of the dataset
+    """
+    import cube
+    cube.load_cube(filename)
+
+
+def run_rollup(filename, missionkey, duplicatekey):
+    """
+    build the mission table and report the likely duplicate records
+    """
+    import rollup
+    rollup.main(missionkey, duplicatekey, filename)
+
+
+def run_tally(filename, allpairs, missions, missionkey=None,
+              duplicatekey=None):
+    """
+    tally every field and write the frequency tables, from the cube or the
+    mission table
+    """
+    import tallyfields
+    tallyfields.main(
+        usecube=not missions, allpairs=allpairs, missions=missions,
+        missionkey=missionkey, duplicatekey=duplicatekey, filename=filename)
+
+
+def run_pies(filename, imageformat):
+    """
+    draw the pie charts
+    """
+    import piecharts
+    piecharts.main(usecube=True, imageformat=imageformat, filename=filename)
+
+
+def run_timeseries(filename, imageformat, missions, missionkey=None,
+                   duplicatekey=None):
+    """
+    draw the time series charts, from the cube or the mission table
+    """
+    import timeseries
+    timeseries.main(
+        usecube=not missions, imageformat=imageformat, missions=missions,
+        missionkey=missionkey, duplicatekey=duplicatekey, filename=filename)
+
+
+def run_clusters(filename, engine):
+    """
+    cluster the target co-ordinates
+    """
+    import geoclusters
+    geoclusters.main(engine, filename)
+
+
+def run_apriori(filename, min_support, min_confidence, engine, segmentby):
+    """
+    mine association rules
+    """
+    import apriori
+    apriori.main(min_support, min_confidence, engine, segmentby, filename)
+
+
+def run_maps(filename):
+    """
+    write the KML maps
+    """
+    import operationsmap
+    operationsmap.main(filename=filename)
+
+
+def run_density(filename, weights, splitby, animate):
+    """
+    write the KML density map and the animated map if asked for
+    """
+    import densitymap
+    densitymap.main(weights, splitby, animate, filename)
+
+
+RUN = {
+    'load': run_load, 'clean': run_clean, 'aggregate': run_aggregate,
+    'rollup': run_rollup, 'tally': run_tally, 'pies': run_pies,
+    'timeseries': run_timeseries, 'clusters': run_clusters,
+    'apriori': run_apriori, 'maps': run_maps, 'density': run_density}
+
+
+def file_digest(filename, blocksize=2 ** 23):
+    """
+    sha256 of a file's contents
+
+    the digest of the dataset is remembered next to its columnar cache so
+    it is only read again when its size or modification time changes
+
+    Args:
+        filename(str): path to the file
+        blocksize(int): bytes to read at a time
+
+    Returns:
+        digest(str): hex digest
+    """
+    digestfile = cachefiles.cache_paths(filename, '.sha256')[0]
+    signature = cachefiles.source_signature(filename)
+    if os.path.exists(digestfile):
+        with open(digestfile, 'r') as f:
+            try:
+                cached = json.load(f)
+            except ValueError:
+                cached = {}
+        if cached.get('signature') == signature:
+            return cached['digest']
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    os.makedirs(os.path.dirname(digestfile), exist_ok=True)
+    with open(digestfile, 'w') as f:
+        json.dump({'signature': signature, 'digest': sha.hexdigest()}, f)
+    return sha.hexdigest()
+
+
+def local_imports(modules, sourcedir):
+    """
+    add every one of our modules that some modules import, directly or
+    through each other, including imports inside functions
+
+    Args:
+        modules(list): module names, e.g. 'charts'
+        sourcedir(str): directory holding our modules
+
+    Returns:
+        modules(set): the modules and every local module they import
+    """
+    found = set()
+    waiting = list(modules)
+    while waiting:
+        module = waiting.pop()
+        if module in found:
+            continue
+        found.add(module)
+        with open(os.path.join(sourcedir, module + '.py'), 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                name = name.split('.')[0]
+                if os.path.exists(os.path.join(sourcedir, name + '.py')):
+                    waiting.append(name)
+    return found
+
+
+def code_digest(modules):
+    """
+    sha256 of the source code of some of our modules and every local
+    module they import, so an edit to a shared module like export.py
+    re-runs every stage using it
+
+    Args:
+        modules(list): module names, e.g. 'charts'
+
+    Returns:
+        digest(str): hex digest
+    """
+    sha = hashlib.sha256()
+    sourcedir = os.path.dirname(os.path.abspath(__file__))
+    for module in sorted(local_imports(list(modules) + ['thor'], sourcedir)):
+        with open(os.path.join(sourcedir, module + '.py'), 'rb') as f:
+            sha.update(module.encode() + b'\0' + f.read())
+    return sha.hexdigest()
+
+
+def upstream_stages(stage, params):
+    """
+    the stages a stage depends on with its parameters
+
+    stages in 'after_if' are only upstream when the parameter they are
+    listed under is set, e.g. tally only needs rollup to count missions
+
+    Args:
+        stage(str): name of the stage
+        params(dict): keys are stage names, values are the parameters of
+                      that stage
+
+    Returns:
+        upstream(list): names of the upstream stages
+    """
+    upstream = list(STAGES[stage]['after'])
+    for name, stages in STAGES[stage].get('after_if', {}).items():
+        if params[stage][name]:
+            upstream += stages
+    return upstream
+
+
+def with_upstream(stages, params):
+    """
+    add every stage the given stages depend on
+
+    Args:
+        stages(list): names of the stages asked for
+        params(dict): keys are stage names, values are the parameters of
+                      that stage
+
+    Returns:
+        stages(list): the stages and their upstream stages, upstream first
+
+    Raises:
+        ValueError: if a stage does not exist
+    """
+    ordered = []
+
+    def visit(stage):
+        if stage not in STAGES:
+            raise ValueError('unknown stage {}, choose from {}'.format(
+                stage, ', '.join(STAGES)))
+        if stage in ordered:
+            return
+        for upstream in upstream_stages(stage, params):
+            visit(upstream)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def stage_keys(stages, params, inputdigest):
+    """
+    work out the key of every stage
+
+    Args:
+        stages(list): stages in upstream first order
+        params(dict): keys are stage names, values are the parameters of
+                      that stage
+        inputdigest(str): digest of the dataset
+
+    Returns:
+        keys(dict): keys are stage names, values are hex digests
+    """
+    keys = {}
+    for stage in stages:
+        spec = {
+            'stage': stage,
+            'input': inputdigest,
+            'params': params[stage],
+            'code': code_digest(STAGES[stage]['modules']),
+            'after': [
+                keys[upstream] for upstream in upstream_stages(stage, params)]}
+        keys[stage] = hashlib.sha256(
+            json.dumps(spec, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def is_current(outputdir, stage, key):
+    """
+    check if a stage already ran with the same key and its files are there
+
+    Args:
+        outputdir(str): the output directory
+        stage(str): name of the stage
+        key(str): the stage's key for this run
+
+    Returns:
+        current(bool): True if the stage can be skipped
+    """
+    statefile = os.path.join(outputdir, STATEDIR, stage + '.json')
+    if not os.path.exists(statefile):
+        return False
+    with open(statefile, 'r') as f:
+        try:
+            state = json.load(f)
+        except ValueError:
+            return False
+    stagedir = os.path.join(outputdir, stage)
+    return state.get('key') == key and all(
+        os.path.exists(os.path.join(stagedir, output))
+        for output in state.get('outputs', []))
+
+
+def run_stage(stage, filename, stagedir, params):
+    """
+    run one stage in a fresh directory of its own, called in a worker
+    process
+
+    Args:
+        stage(str): name of the stage
+        filename(str): absolute path to the dataset CSV file
+        stagedir(str): absolute path of the directory for its files
+        params(dict): the stage's parameters
+
+    Returns:
+        stage(str): name of the stage
+        outputs(list): files the stage wrote
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    # files from an earlier run of the stage must not outlive it
+    shutil.rmtree(stagedir, ignore_errors=True)
+    os.makedirs(stagedir)
+    os.chdir(stagedir)
+    RUN[stage](filename, **params)
+    outputs = []
+    for directory, subdirs, files in os.walk(stagedir):
+        for name in files:
+            outputs.append(os.path.relpath(
+                os.path.join(directory, name), stagedir))
+    return stage, sorted(outputs)
+
+
+def run_pipeline(filename, stages=None, outputdir=OUTPUTDIR, settings=None,
+                 workers=None, force=False):
+    """
+    run stages and everything they depend on, skipping unchanged stages
+
+    Args:
+        filename(str): path to the dataset CSV file
+        stages(list): names of the stages to run, None for all of them
+        outputdir(str): directory for the output of every stage
+        settings(dict): keys are stage names, values are dicts of
+                        parameters overriding the stage's defaults
+        workers(int): number of stages to run at once, defaults to the
+                      number of cores
+        force(bool): run every stage even if it is unchanged
+
+    Returns:
+        ran(list): the stages that ran
+        skipped(list): the stages that were unchanged
+    """
+    filename = os.path.abspath(filename)
+    outputdir = os.path.abspath(outputdir)
+    params = {}
+    for stage in STAGES:
+        params[stage] = dict(STAGES[stage]['params'])
+        for name, value in (settings or {}).get(stage, {}).items():
+            if name not in params[stage]:
+                raise ValueError('unknown setting {} for stage {}'.format(
+                    name, stage))
+            params[stage][name] = value
+    stages = with_upstream(stages or list(STAGES), params)
+    with instrument.stage('hash input'):
+        inputdigest = file_digest(filename)
+    keys = stage_keys(stages, params, inputdigest)
+    os.makedirs(os.path.join(outputdir, STATEDIR), exist_ok=True)
+    waiting = list(stages)
+    running = {}
+    ran = []
+    skipped = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        while waiting or running:
+            for stage in list(waiting):
+                upstream = upstream_stages(stage, params)
+                if any(name in waiting or name in running.values()
+                       for name in upstream):
+                    continue
+                waiting.remove(stage)
+                if not force and is_current(outputdir, stage, keys[stage]):
+                    print('{} is unchanged, skipping'.format(stage))
+                    skipped.append(stage)
+                    continue
+                print('running {}'.format(stage))
+                runparams = dict(params[stage])
+                if 'rollup' in upstream:
+                    # count the missions of the table the rollup stage built
+                    runparams.update(params['rollup'])
+                future = pool.submit(
+                    run_stage, stage, filename,
+                    os.path.join(outputdir, stage), runparams)
+                running[future] = stage
+            if not running:
+                continue
+            done, pending = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                stage, outputs = future.result()
+                statefile = os.path.join(outputdir, STATEDIR, stage + '.json')
+                with open(statefile, 'w') as f:
+                    json.dump(
+                        {'key': keys[stage], 'params': params[stage],
+                         'outputs': outputs}, f, indent=2)
+                print('finished {}'.format(stage))
+                ran.append(stage)
+    return ran, skipped
+
+
+def parse_settings(assignments):
+    """
+    read stage settings given as stage.name=value
+
+    values are read as JSON where possible, e.g. 0.05, null or "text",
+    otherwise they are kept as text
+
+    Args:
+        assignments(list): the settings from the command line
+
+    Returns:
+        settings(dict): keys are stage names, values are dicts of settings
+    """
+    settings = {}
+    for assignment in assignments or []:
+        name, equals, value = assignment.partition('=')
+        stage, dot, setting = name.partition('.')
+        if not equals or not dot:
+            raise ValueError(
+                'settings look like stage.name=value, not {}'.format(
+                    assignment))
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        settings.setdefault(stage, {})[setting] = value
+    return settings
+
+
+def main(argv=None):
+    """
+    main program code
+
+    Args:
+        argv(list): command line arguments, defaults to sys.argv
+    """
+    parser = argparse.ArgumentParser(
+        description='run the Vietnam War THOR dataset analysis')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    runparser = subparsers.add_parser(
+        'run', help='run stages and the stages they depend on')
+    runparser.add_argument(
+        'stages', nargs='*',
+        help='stages to run, all of them if none are given')
+    runparser.add_argument('--input', default='thor_data_vietnam.csv')
+    runparser.add_argument('--output', default=OUTPUTDIR)
+    runparser.add_argument(
+        '--set', action='append', metavar='STAGE.NAME=VALUE',
+        help='change a stage parameter, e.g. apriori.min_support=0.05')
+    runparser.add_argument('--workers', type=int, default=None)
+    runparser.add_argument(
+        '--force', action='store_true', help='run unchanged stages too')
+    subparsers.add_parser('list', help='list the stages')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'list':
+        for stage, spec in STAGES.items():
+            after = ', '.join(spec['after']) or '-'
+            for name, stages in spec.get('after_if', {}).items():
+                after += ', {} if {}'.format(', '.join(stages), name)
+            print('{:<12} after: {:<26} params: {}'.format(
+                stage, after, spec['params']))
+        return
+    ran, skipped = run_pipeline(
+        args.input, args.stages, args.output, parse_settings(args.set),
+        args.workers, args.force)
+    print('ran {} stages, skipped {} unchanged stages'.format(
+        len(ran), len(skipped)))
+
+
+if __name__ == '__main__':
+    instrument.run_main(main)
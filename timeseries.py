@@ -4,125 +4,205 @@ create Time Series graphs from the Vietnam War THOR dataset
 Thomas Whittam
 """
 
-import datetime
-import re
+import charts
+import cube
+import dataset
+import instrument
+import rollup
 
-import pandas as pd
-import matplotlib.pyplot as plt
 
-
-def clean_date(datestr):
+def time_series_matrix(df, dimension=None, freq='D', top=None,
+                       categories=None, weights=None):
     """
-    clean the date string from yyyymmdd to yyyy-mm-dd
+    count missions per date broken down by the values of a column
+
+    one grouped pass over (MSNDATE, dimension) pivoted to a dense
+    date x category matrix, dates with no missions are filled with 0
+
+    Args:
+        df(pandas dataframe): missions with cleaned datetime64 MSNDATE
+        dimension(str): column to break the counts down by, None gives a
+                        single 'Total' column
+        freq(str): 'D' for daily, 'W' for weekly or 'MS' for monthly counts
+        top(int): only keep this many categories with the most missions
+        categories(dict or list): only keep these categories in this order,
+                                  a dict also renames them to its values
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the aggregate cube, None counts the rows
+
+    Returns:
+        matrix(pandas dataframe): index is the first day of each period,
+                                  one column per category
     """
-    datestr = str(datestr)
-    if re.match(r'^(\d{8})', datestr):
-        cleandate = '{}-{}-{}'.format(datestr[0:4], datestr[4:6], datestr[6:9])
-        try:
-            datetime.date(
-                int(datestr[0:4]), int(datestr[4:6]), int(datestr[6:9]))
-        except ValueError:
-            cleandate = 'INVALID'
-        return cleandate
+    keys = ['MSNDATE'] if dimension is None else ['MSNDATE', dimension]
+    grouped = df.groupby(keys, observed=True)
+    if weights is None:
+        counts = grouped.size()
+    else:
+        counts = grouped[weights].sum()
+    if dimension is None:
+        matrix = counts.to_frame('Total')
+    else:
+        matrix = counts.unstack(fill_value=0)
+        matrix.columns = list(matrix.columns)
+    if categories is not None:
+        matrix = matrix.reindex(columns=list(categories), fill_value=0)
+        if isinstance(categories, dict):
+            matrix = matrix.rename(columns=categories)
+    if top is not None:
+        totals = matrix.sum().sort_values(ascending=False, kind='stable')
+        matrix = matrix[totals.index[:top]]
+    if freq == 'W':
+        # weeks run from sunday to saturday and are labelled with their
+        # sunday, like densitymap.PERIODS, pandas would label them with the
+        # sunday they end on
+        matrix = matrix.resample('W-SUN', label='left', closed='left').sum()
     else:
-        return datestr
+        matrix = matrix.resample(freq).sum()
+    matrix.index.name = 'MSNDATE'
+    return matrix
 
 
-def single_time_series(outputfilename, count, title):
+def single_time_series(outputfilename, count, title,
+                       ylabel="No of Missions per day"):
     """
     generate time series line chart
 
     Args:
-        outputfilename(str): filename to save the pie chart as
-        dataframe(pandas.core.series.Series): the raw data in a pandas series
+        outputfilename(str): filename to save the chart as, .png or .svg
+        count(pandas series): missions indexed by date
         title(str): chart title
+        ylabel(str): label for the y axis
     """
-    countdict = count.to_dict()
-    dates = list(countdict.keys())
-    missions = list(countdict.values())
-    plt.figure(figsize=(25, 10))
-    plt.plot_date(x=dates, y=missions, linestyle='solid')
-    plt.title(title)
-    plt.xlabel("Dates")
-    plt.ylabel("No of Missions per day")
-    plt.savefig(outputfilename)
-    plt.clf()
-
-
-def multiple_time_series(outputfilename, seriesdict, title):
+    charts.render_chart(
+        charts.time_series_spec(outputfilename, count, title, ylabel))
+
+
+def multiple_time_series(outputfilename, seriesdict, title,
+                         ylabel="No of Missions per day"):
     """
     generate time series line chart with multiple lines
 
     Args:
-        outputfilename(str): filename to save the pie chart as
+        outputfilename(str): filename to save the chart as, .png or .svg
         seriesdict(dict): dictionary of counts to plot key is name, value is
-                          the series data to plot as a line on the graph
+                          the series data to plot as a line on the graph,
+                          a matrix from time_series_matrix also works with
+                          one line per column
         title(str): chart title
+        ylabel(str): label for the y axis
     """
-    plt.figure(figsize=(25, 10))
-    for line in seriesdict:
-        countdict = seriesdict[line].to_dict()
-        dates = list(countdict.keys())
-        missions = list(countdict.values())
-        plt.plot_date(x=dates, y=missions, linestyle='solid', label=line)
-    plt.title(title)
-    plt.legend()
-    plt.xlabel("Dates")
-    plt.ylabel("No of Missions per day")
-    plt.savefig(outputfilename)
-    plt.clf()
-
-
-def main():
+    charts.render_chart(
+        charts.time_series_spec(outputfilename, seriesdict, title, ylabel))
+
+
+def breakdown_time_series(outputfilename, df, dimension, title, freq='D',
+                          top=None, categories=None, weights=None):
+    """
+    chart the missions per period for each value of a column
+
+    Args:
+        outputfilename(str): filename to save the chart as
+        df(pandas dataframe): missions with cleaned datetime64 MSNDATE
+        dimension(str): column to break the counts down by
+        title(str): chart title
+        freq(str): 'D' for daily, 'W' for weekly or 'MS' for monthly counts
+        top(int): only plot this many categories with the most missions
+        categories(dict or list): only plot these categories,
+                                  a dict also renames them to its values
+        weights(str): column holding the number of missions in each row,
+                      e.g. 'COUNT' in the aggregate cube, None counts the rows
+    """
+    periods = {'D': 'day', 'W': 'week', 'MS': 'month'}
+    matrix = time_series_matrix(
+        df, dimension, freq, top, categories, weights)
+    multiple_time_series(
+        outputfilename, matrix, title,
+        ylabel='No of Missions per {}'.format(periods.get(freq, freq)))
+
+
+def main(usecube=False, imageformat='png', missions=False,
+         missionkey=None, duplicatekey=None,
+         filename='thor_data_vietnam.csv'):
     """
     main program code
+
+    the time series are counted here and the charts drawn in parallel
+
+    Args:
+        usecube(bool): answer from the aggregate cube instead of counting
+                       the raw missions
+        imageformat(str): 'png' or 'svg'
+        missions(bool): count the missions in the rollup.py mission table
+                        instead of the source records
+        missionkey(list): columns identifying a mission, defaults to
+                          rollup.KEYS['mission']
+        duplicatekey(list): columns identifying a duplicate record,
+                            defaults to rollup.KEYS['duplicate']
+        filename(str): path to the dataset CSV file
     """
-    filename = 'thor_data_vietnam.csv'
-    df = pd.read_csv(filename)
+    if usecube and missions:
+        raise ValueError('the cube counts records, not missions')
     print('calculating time series for entire war')
-    df['MSNDATE'] = df['MSNDATE'].apply(clean_date)
-    df = df[df.MSNDATE != 'INVALID']
-    df['MSNDATE'] = pd.to_datetime(df['MSNDATE'], format='%Y-%m-%d')
-    count = df.groupby(['MSNDATE']).size()
-    single_time_series(
-        'timeseries.png', count,
-        'Missions per day, Vietnam War (1965-1975) Total')
+    if usecube:
+        with instrument.stage('load cube') as timer:
+            df = cube.clean_cube_dates(cube.load_cube(filename))
+            timer.rowsout = len(df)
+        weights = 'COUNT'
+    else:
+        with instrument.stage('load') as timer:
+            columns = ['MSNDATE', 'TGTCOUNTRY', 'COUNTRYFLYINGMISSION']
+            if missions:
+                df = rollup.load_missions(
+                    filename, missionkey, duplicatekey)[columns]
+            else:
+                df = dataset.load_dataset(filename, columns=columns)
+            timer.rowsout = len(df)
+        with instrument.stage('clean dates', rowsin=len(df)) as timer:
+            df['MSNDATE'], invalid, rejected = dataset.clean_dates(
+                df['MSNDATE'])
+            print('removing {} missions with invalid dates {}'.format(
+                invalid.sum(), rejected))
+            df = df[~invalid]
+            timer.rowsout = len(df)
+        weights = None
+    specs = []
+    with instrument.stage('total time series', rowsin=len(df)):
+        count = time_series_matrix(df, weights=weights)
+        specs.append(charts.time_series_spec(
+            'timeseries.{}'.format(imageformat), count['Total'],
+            'Missions per day, Vietnam War (1965-1975) Total'))
     print('calculating time series for target countries')
-    northvietnam = df[df['TGTCOUNTRY'] == 'NORTH VIETNAM']
-    nvcount = northvietnam.groupby(['MSNDATE']).size()
-    southvietnam = df[df['TGTCOUNTRY'] == 'SOUTH VIETNAM']
-    svcount = southvietnam.groupby(['MSNDATE']).size()
-    laos = df[df['TGTCOUNTRY'] == 'LAOS']
-    lcount = laos.groupby(['MSNDATE']).size()
-    cambodia = df[df['TGTCOUNTRY'] == 'CAMBODIA']
-    ccount = cambodia.groupby(['MSNDATE']).size()
-    targetcountry = {'North Vietnam': nvcount,
-                     'South Vietnam': svcount,
-                     'Laos': lcount,
-                     'Cambodia': ccount}
-    multiple_time_series(
-        'target country time series.png', targetcountry,
-        'Missions per day, Vietnam War (1965-1975) per Target Country')
+    with instrument.stage('target country time series', rowsin=len(df)):
+        targetcountry = time_series_matrix(
+            df, 'TGTCOUNTRY',
+            categories={'NORTH VIETNAM': 'North Vietnam',
+                        'SOUTH VIETNAM': 'South Vietnam',
+                        'LAOS': 'Laos',
+                        'CAMBODIA': 'Cambodia'},
+            weights=weights)
+        specs.append(charts.time_series_spec(
+            'target country time series.{}'.format(imageformat),
+            targetcountry,
+            'Missions per day, Vietnam War (1965-1975) per Target Country'))
     print('calculating time series for allied countries')
-    australia = df[df['COUNTRYFLYINGMISSION'] == 'AUSTRALIA']
-    auscount = australia.groupby(['MSNDATE']).size()
-    southkorea = df[df['COUNTRYFLYINGMISSION'] == 'KOREA (SOUTH)']
-    skcount = southkorea.groupby(['MSNDATE']).size()
-    laos2 = df[df['COUNTRYFLYINGMISSION'] == 'LAOS']
-    l2count = laos2.groupby(['MSNDATE']).size()
-    usa = df[df['COUNTRYFLYINGMISSION'] == 'UNITED STATES OF AMERICA']
-    usacount = usa.groupby(['MSNDATE']).size()
-    southvietnam2 = df[df['COUNTRYFLYINGMISSION'] == 'VIETNAM (SOUTH)']
-    sv2count = southvietnam2.groupby(['MSNDATE']).size()
-    countryflying = {'Australia': auscount,
-                     'South Vietnam': sv2count,
-                     'Laos': l2count,
-                     'South Korea': skcount,
-                     'United States of America': usacount}
-    multiple_time_series(
-        'flying country time series.png', countryflying,
-        'Missions per day, Vietnam War (1965-1975) per Country Flying Mission')
+    with instrument.stage('flying country time series', rowsin=len(df)):
+        countryflying = time_series_matrix(
+            df, 'COUNTRYFLYINGMISSION',
+            categories={
+                'AUSTRALIA': 'Australia',
+                'VIETNAM (SOUTH)': 'South Vietnam',
+                'LAOS': 'Laos',
+                'KOREA (SOUTH)': 'South Korea',
+                'UNITED STATES OF AMERICA': 'United States of America'},
+            weights=weights)
+        specs.append(charts.time_series_spec(
+            'flying country time series.{}'.format(imageformat),
+            countryflying,
+            'Missions per day, Vietnam War (1965-1975) '
+            'per Country Flying Mission'))
+    charts.render_charts(specs)
 
 
 if __name__ == '__main__':
-    main()
+    instrument.run_main(main)